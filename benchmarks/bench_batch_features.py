@@ -0,0 +1,87 @@
+'''
+Microbenchmark of the vectorized feature computation (batch_features.py)
+against the per-summoner path of the LeagueAnalyzer.
+
+The histories are either generated randomly or replayed from a participant
+store built by an earlier run of build_training_data.py. Both paths have to
+return exactly the same features, otherwise the benchmark fails.
+
+Usage:
+    python bench_batch_features.py [summoners] [depth]
+    python bench_batch_features.py --replay ../data_collection/participants.sqlite [summoners] [depth]
+'''
+
+import os
+import sys
+import math
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_collection'))
+
+from batch_features import batch_features, feature_rows, pad_histories
+from build_training_data import LeagueAnalyzer
+from participant_store import ParticipantStore
+
+
+def synthetic_histories(summoners, depth, seed=0):
+    '''Returns (histories, champ ids) of random summoners playing a small pool of champions'''
+    rng = random.Random(seed)
+    histories = []
+    champ_ids = []
+    for _ in range(summoners):
+        pool = rng.sample(range(1, 160), 5)
+        histories.append([{'champ': rng.choice(pool), 'kda': round(rng.uniform(0, 12), 2), 'win': rng.random() < 0.5}
+                          for _ in range(rng.randint(0, depth))])
+        champ_ids.append(rng.choice(pool))
+    return histories, champ_ids
+
+
+def replayed_histories(filename, summoners, depth):
+    '''Returns (histories, champ ids) of the summoners of the newest matches in a participant store'''
+    store = ParticipantStore(filename)
+    rows = store._connection.execute('SELECT puuid, champ, game_creation FROM participants ORDER BY game_creation DESC LIMIT ?', (summoners,)).fetchall()
+    histories = []
+    champ_ids = []
+    for puuid, champ, game_creation in rows:
+        records = store.by_puuid(puuid, end_time=game_creation // 1000 - 1)[:depth]
+        histories.append([record.details() for record in records])
+        champ_ids.append(champ)
+    store.close()
+    return histories, champ_ids
+
+
+def same(a, b):
+    return a == b or (isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b))
+
+
+def main(histories, champ_ids):
+    analyzer = LeagueAnalyzer(api_key='offline', match_cache_file=None, participant_store_file=None, use_feature_store=False, mastery_cache_file=None,
+                              debug_level=LeagueAnalyzer.DEBUG_LEVEL_WARNING)
+    attributes = [attribute for attribute in analyzer.PLAYER_ATTRIBUTES if attribute != 'champMastery']
+
+    start = time.perf_counter()
+    scalar = [analyzer.get_performance(details, champ_id) for details, champ_id in zip(histories, champ_ids)]
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = feature_rows(batch_features(*pad_histories(histories), champ_ids), attributes)
+    batch_time = time.perf_counter() - start
+
+    mismatches = sum(not all(same(a[attribute], b[attribute]) for attribute in attributes) for a, b in zip(scalar, batched))
+    print(f'{len(histories)} summoners, {sum(map(len, histories))} past matches')
+    print(f'per summoner: {scalar_time * 1000:.1f} ms')
+    print(f'batched:      {batch_time * 1000:.1f} ms ({scalar_time / batch_time:.1f}x)')
+    print(f'mismatches:   {mismatches}')
+    return mismatches == 0
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    replay = None
+    if args[:1] == ['--replay']:
+        replay, args = args[1], args[2:]
+    summoners = int(args[0]) if len(args) > 0 else 10000
+    depth = int(args[1]) if len(args) > 1 else 20
+    histories, champ_ids = replayed_histories(replay, summoners, depth) if replay else synthetic_histories(summoners, depth)
+    sys.exit(0 if main(histories, champ_ids) else 1)
@@ -0,0 +1,211 @@
+'''
+End-to-end benchmarks of the data collection against the local Riot API
+stand-in (fake_riot_api.py).
+
+Every scenario runs in its own process and working directory, so caches start
+cold and the peak memory (max RSS) belongs to that scenario alone. The API
+requests are counted by the server.
+
+    analysis    LeagueAnalyzer.start_analysis_process() on the newest matches
+    async       AsyncLeagueAnalyzer.start_analysis_process() on the same matches,
+                its games must be identical to those of the analysis scenario
+    gather      gather_match_ids.main() from the first summoner of the world
+
+Reported per scenario: items per second (analyzed matches / collected match
+ids), API requests per item, peak memory and the time spent waiting for the
+rate limiter. Use --json to keep the numbers for later comparison.
+
+Usage:
+    python bench_pipeline.py --matches 200 --latency-ms 20
+    python bench_pipeline.py --scenario analysis --batch-window 20 --workers 8 --warm
+    python bench_pipeline.py --scenario async --concurrent-games 4 --latency-ms 20
+    python bench_pipeline.py --replay recording.sqlite --app-limits 20:1,100:120 --error-rate-503 0.01
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_COLLECTION_DIR = os.path.join(BENCHMARK_DIR, '..', 'data_collection')
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fake_riot_api import UNLIMITED, FakeRiotApi, Recording, SyntheticWorld
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / (1024 if sys.platform == 'darwin' else 1), 1)
+
+
+def prepare(workdir):
+    '''Runs in the scenario process: imports data_collection/ with its root url pointing at the fake API'''
+    sys.path.insert(0, DATA_COLLECTION_DIR)
+    os.chdir(workdir)
+    with open('config.ini', 'w') as f:
+        f.write('[DEFAULT]\nAPI_KEY = RGAPI-benchmark\n')
+
+
+def point_riotwatcher_at(api_url):
+    # LolWatcher resets the root url whenever it is created
+    from riotwatcher._apis.UrlConfig import UrlConfig
+    UrlConfig.root_url = api_url
+
+
+def run_analysis(workdir, api_url, match_ids, options, results):
+    prepare(workdir)
+    from build_training_data import LeagueAnalyzer
+    from rate_limiter import RateLimitScheduler
+    with open('matches.txt', 'w') as f:
+        f.write('\n'.join(match_ids) + '\n')
+    rate_limiter = RateLimitScheduler(RateLimitScheduler.parse_header(options['app_limits']))
+    analyzer = LeagueAnalyzer(api_key='RGAPI-benchmark', debug_level=LeagueAnalyzer.DEBUG_LEVEL_ERROR, rate_limiter=rate_limiter,
+                              max_age_days=options['days'] + 1, bulk_masteries=options['bulk_masteries'])
+    point_riotwatcher_at(api_url)
+    start = time.perf_counter()
+    analyzer.start_analysis_process(os.path.abspath('matches.txt'), os.path.abspath(f'output_{options["run"]}.csv'),
+                                    batch_window=options['batch_window'], workers=options['workers'])
+    seconds = time.perf_counter() - start
+    results.put({'items': len(match_ids), 'seconds': seconds, 'peak_memory_mb': peak_memory_mb(), 'rate_limit_wait': round(rate_limiter.total_wait, 2)})
+
+
+def run_async_analysis(workdir, api_url, match_ids, options, results):
+    prepare(workdir)
+    from async_build_training_data import AsyncLeagueAnalyzer
+    from build_training_data import LeagueAnalyzer
+    from rate_limiter import RateLimitScheduler
+    with open('matches.txt', 'w') as f:
+        f.write('\n'.join(match_ids) + '\n')
+    rate_limiter = RateLimitScheduler(RateLimitScheduler.parse_header(options['app_limits']))
+    # the aiohttp session builds its urls from api_url, RiotWatcher isn't used
+    analyzer = AsyncLeagueAnalyzer(api_key='RGAPI-benchmark', debug_level=LeagueAnalyzer.DEBUG_LEVEL_ERROR, rate_limiter=rate_limiter,
+                                   max_age_days=options['days'] + 1, bulk_masteries=options['bulk_masteries'], api_url=api_url,
+                                   concurrent_games=options['concurrent_games'])
+    start = time.perf_counter()
+    analyzer.start_analysis_process(os.path.abspath('matches.txt'), os.path.abspath('output_async.csv'))
+    seconds = time.perf_counter() - start
+    results.put({'items': len(match_ids), 'seconds': seconds, 'peak_memory_mb': peak_memory_mb(), 'rate_limit_wait': round(rate_limiter.total_wait, 2)})
+
+
+def read_games(filename):
+    '''Returns the rows of an output csv by match id'''
+    with open(filename) as f:
+        rows = [line.rstrip('\n').split(';') for line in f]
+    return {row[0]: row for row in rows[1:]}
+
+
+def run_gather(workdir, api_url, seed_name, options, results):
+    prepare(workdir)
+    import gather_match_ids
+    point_riotwatcher_at(api_url)
+    gather_match_ids.RATE_LIMITER.DEFAULT_LIMITS = gather_match_ids.RATE_LIMITER.parse_header(options['app_limits'])
+    gather_match_ids.QUEUE_TYPE = 420
+    gather_match_ids.SEED_USER_NAME = seed_name
+    gather_match_ids.SEARCH_DEPTH = options['depth']
+    gather_match_ids.PAST_MATCHES_COUNT = options['fan_out']
+    gather_match_ids.WORKERS = options['workers']
+    start = time.perf_counter()
+    gather_match_ids.main()
+    seconds = time.perf_counter() - start
+    with open('manymatches.txt') as f:
+        collected = sum(1 for line in f if line.strip())
+    results.put({'items': collected, 'seconds': seconds, 'peak_memory_mb': peak_memory_mb(), 'rate_limit_wait': round(gather_match_ids.RATE_LIMITER.total_wait, 2)})
+
+
+def run_scenario(api, target, args):
+    '''Runs target(*args, results) in a new process and returns its measurements plus the API requests it sent'''
+    requests_before = api.stats()['requests']
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=(*args, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'{target.__name__} failed with exit code {process.exitcode}')
+    measurement = results.get()
+    measurement['requests'] = api.stats()['requests'] - requests_before
+    measurement['items_per_second'] = round(measurement['items'] / measurement['seconds'], 2)
+    measurement['requests_per_item'] = round(measurement['requests'] / max(1, measurement['items']), 2)
+    measurement['seconds'] = round(measurement['seconds'], 2)
+    return measurement
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the data collection against a local Riot API')
+    parser.add_argument('--scenario', choices=['analysis', 'async', 'gather', 'all'], default='all')
+    parser.add_argument('--matches', type=int, default=100, help='matches to analyze')
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--world-matches', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--match-padding', type=int, default=0)
+    parser.add_argument('--replay', help='serve recorded responses, unknown requests from the synthetic world')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--app-limits', default=UNLIMITED)
+    parser.add_argument('--method-limits')
+    parser.add_argument('--error-rate-429', type=float, default=0.0)
+    parser.add_argument('--error-rate-503', type=float, default=0.0)
+    parser.add_argument('--batch-window', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrent-games', type=int, default=1, help='games analyzed at the same time by the async scenario')
+    parser.add_argument('--bulk-masteries', action='store_true')
+    parser.add_argument('--depth', type=int, default=1, help='search depth of gather_match_ids')
+    parser.add_argument('--fan-out', type=int, default=5, help='matches per summoner of gather_match_ids')
+    parser.add_argument('--warm', action='store_true', help='run the analysis a second time with the caches of the first run')
+    parser.add_argument('--json', help='append the results to this file as json lines')
+    args = parser.parse_args()
+
+    world = SyntheticWorld(args.players, args.world_matches, args.days, args.seed, match_padding=args.match_padding)
+    api = FakeRiotApi(world, Recording(args.replay) if args.replay else None, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      app_limits=args.app_limits, method_limits=args.method_limits, error_rate_429=args.error_rate_429,
+                      error_rate_503=args.error_rate_503, seed=args.seed)
+    api_url = api.start()
+    options = {key: getattr(args, key) for key in ('days', 'batch_window', 'workers', 'concurrent_games', 'bulk_masteries', 'depth', 'fan_out', 'app_limits')}
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.scenario in ('analysis', 'all'):
+            workdir = os.path.join(tmpdir, 'analysis')
+            os.makedirs(workdir)
+            match_ids = world.match_ids[-args.matches:]
+            for run in ('cold', 'warm') if args.warm else ('cold',):
+                measurement = run_scenario(api, run_analysis, (workdir, api_url, match_ids, dict(options, run=run)))
+                results.append(dict(scenario=f'analysis ({run})', **measurement))
+        if args.scenario in ('async', 'all'):
+            workdir = os.path.join(tmpdir, 'async')
+            os.makedirs(workdir)
+            measurement = run_scenario(api, run_async_analysis, (workdir, api_url, world.match_ids[-args.matches:], options))
+            games = read_games(os.path.join(workdir, 'output_async.csv'))
+            if args.scenario == 'all':
+                # both scenarios start with cold caches, so the games must match exactly
+                measurement['identical_games'] = games == read_games(os.path.join(tmpdir, 'analysis', 'output_cold.csv'))
+            results.append(dict(scenario='async', **measurement))
+        if args.scenario in ('gather', 'all'):
+            workdir = os.path.join(tmpdir, 'gather')
+            os.makedirs(workdir)
+            measurement = run_scenario(api, run_gather, (workdir, api_url, world.name(0), options))
+            results.append(dict(scenario='gather', **measurement))
+    api.stop()
+
+    print(f'{"scenario":<18}{"items":>8}{"seconds":>10}{"items/s":>10}{"requests":>10}{"req/item":>10}{"peak MB":>10}{"rl wait":>10}')
+    for result in results:
+        print(f'{result["scenario"]:<18}{result["items"]:>8}{result["seconds"]:>10}{result["items_per_second"]:>10}{result["requests"]:>10}'
+              f'{result["requests_per_item"]:>10}{result["peak_memory_mb"]:>10}{result["rate_limit_wait"]:>10}')
+    for result in results:
+        if 'identical_games' in result:
+            print(f'{result["scenario"]}: games identical to the analysis scenario: {result["identical_games"]}')
+    print(f'API: {api.stats()}')
+    if args.json:
+        with open(args.json, 'a') as f:
+            for result in results:
+                f.write(json.dumps(dict(result, options=vars(args), timestamp=int(time.time()))) + '\n')
+
+
+if __name__ == '__main__':
+    main()
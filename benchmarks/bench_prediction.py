@@ -0,0 +1,133 @@
+'''
+Latency benchmark of the champ-select prediction service (prediction.py)
+against the local Riot API stand-in (fake_riot_api.py).
+
+Every simulated lobby takes the blue side of one of the newest matches of the
+synthetic world, announces its 5 players with POST /lobby, waits for the
+picks (--pick-seconds) and then asks for the verdict with POST /predict.
+Lobbies run concurrently. With --no-prefetch the /lobby call is skipped, which
+shows the latency of a predictor that only starts fetching once the picks are
+locked.
+
+Reported: p50/p99/max latency of /predict as seen by the client, the share of
+predictions within the p99 target and the API requests per lobby.
+
+Usage:
+    python bench_prediction.py --lobbies 100 --latency-ms 30 --pick-seconds 2
+    python bench_prediction.py --lobbies 100 --latency-ms 30 --no-prefetch
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'prediction'))
+
+from fake_riot_api import UNLIMITED, FakeRiotApi, SyntheticWorld
+from bench_pipeline import point_riotwatcher_at
+# prediction.py puts data_collection/ on the path
+from prediction import ChampSelectPredictor, PredictionServer, load_model
+from build_training_data import LeagueAnalyzer
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, json.dumps(payload).encode(), {'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        return json.load(response)
+
+
+def lobbies_of(world, count):
+    '''Returns (puuids, champion ids) of the blue side of the newest matches'''
+    lobbies = []
+    for match_id in world.match_ids[-count:]:
+        participants = world.match(match_id)['info']['participants'][:5]
+        lobbies.append(([participant['puuid'] for participant in participants], [participant['championId'] for participant in participants]))
+    return lobbies
+
+
+def run_lobby(server_url, lobby, pick_seconds, prefetch):
+    puuids, champions = lobby
+    if prefetch:
+        post(f'{server_url}/lobby', {'puuids': puuids})
+    time.sleep(pick_seconds)
+    start = time.perf_counter()
+    post(f'{server_url}/predict', {'puuids': puuids, 'champions': champions})
+    return time.perf_counter() - start
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the prediction service against a local Riot API')
+    parser.add_argument('--lobbies', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10, help='lobbies in champ-select at the same time')
+    parser.add_argument('--pick-seconds', type=float, default=1.0, help='time between the lobby forming and the locked picks')
+    parser.add_argument('--no-prefetch', action='store_true')
+    parser.add_argument('--model', help='compiled model artifact directory or pickled classifier with predict_proba()')
+    parser.add_argument('--p99-target-ms', type=float, default=250)
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--world-matches', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--app-limits', default=UNLIMITED)
+    parser.add_argument('--json', help='append the results to this file as json lines')
+    args = parser.parse_args()
+
+    world = SyntheticWorld(args.players, args.world_matches, args.days, args.seed)
+    api = FakeRiotApi(world, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, app_limits=args.app_limits, seed=args.seed)
+    api_url = api.start()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        analyzer = LeagueAnalyzer(api_key='RGAPI-benchmark', debug_level=LeagueAnalyzer.DEBUG_LEVEL_ERROR, max_age_days=args.days + 1,
+                                  match_cache_file=os.path.join(tmpdir, 'match_cache.sqlite'), participant_store_file=os.path.join(tmpdir, 'participants.sqlite'),
+                                  mastery_cache_file=os.path.join(tmpdir, 'mastery_cache.sqlite'))
+        analyzer.rate_limiter.DEFAULT_LIMITS = analyzer.rate_limiter.parse_header(args.app_limits)
+        point_riotwatcher_at(api_url)
+        predictor = ChampSelectPredictor(analyzer, load_model(args.model), workers=args.concurrency * 5, p99_target_ms=args.p99_target_ms)
+        server = PredictionServer(predictor, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        lobbies = lobbies_of(world, args.lobbies)
+        requests_before = api.stats()['requests']
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            latencies = list(executor.map(lambda lobby: run_lobby(server.url, lobby, args.pick_seconds, not args.no_prefetch), lobbies))
+        seconds = time.perf_counter() - start
+        requests = api.stats()['requests'] - requests_before
+        server.shutdown()
+        predictor.close()
+    api.stop()
+
+    target = args.p99_target_ms / 1000
+    result = {
+        'lobbies': len(lobbies),
+        'prefetch': not args.no_prefetch,
+        'seconds': round(seconds, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'max_ms': round(max(latencies) * 1000, 2),
+        'within_target': round(sum(latency <= target for latency in latencies) / len(latencies), 3),
+        'requests_per_lobby': round(requests / len(lobbies), 2),
+        'server': predictor.health()
+    }
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(dict(result, options=vars(args), timestamp=int(time.time()))) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+'''
+Benchmark of the compiled model artifact (model_artifact.py) against the
+pickled TreeEnsemble of train.py.
+
+    cold start      import, load and first prediction in a fresh process
+                    (the interpreter startup itself is not counted), and
+                    the same without importing numpy, which both need
+    single team     latency of predict_proba() for one team row
+    batch           rows per second of predict_proba() for batches of rows
+
+Without --artifact and --model a model is trained on a synthetic team
+dataset first (--trees, --depth). Both models must predict the same
+probabilities, which is checked on the benchmark rows.
+
+Usage:
+    python bench_scoring.py --trees 300 --depth 6
+    python bench_scoring.py --artifact ../training_and_validation/model --model ../training_and_validation/model.pkl
+'''
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+TRAINING_DIR = os.path.join(BENCHMARK_DIR, '..', 'training_and_validation')
+sys.path.insert(0, TRAINING_DIR)
+
+import numpy as np
+
+from model_artifact import CompiledModel, export
+
+COLD_START = {
+    'artifact': 'from model_artifact import CompiledModel\nmodel = CompiledModel.load({path!r})',
+    'pickle': 'import pickle\nwith open({path!r}, "rb") as f:\n    model = pickle.load(f)'
+}
+ATTRIBUTES = ['winrate', 'champ_winrate', 'avgKda', 'champ_avgKda', 'streak', 'consistency', 'champMastery']
+
+
+def synthetic_model(dirname, rows, trees, depth, seed):
+    '''Trains a model on a synthetic team csv and returns the pickle and artifact paths'''
+    from boosting import HistogramBoosting
+    from team_dataset import bin_dataset, prepare
+
+    rng = np.random.default_rng(seed)
+    columns = [f'summoner_{summoner}_{attribute}' for summoner in range(1, 6) for attribute in ATTRIBUTES]
+    X = rng.normal(size=(rows, len(columns)))
+    win = rng.random(rows) < 1 / (1 + np.exp(-X[:, 0::7].sum(axis=1) - 0.5 * X[:, 1::7].sum(axis=1)))
+    filename = os.path.join(dirname, 'teams.csv')
+    with open(filename, 'w') as f:
+        f.write(';'.join(['id'] + columns + ['win']) + '\n')
+        for index, (row, won) in enumerate(zip(X, win)):
+            values = ['EMPTY' if rng.random() < 0.02 else f'{value:.4f}' for value in row]
+            f.write(';'.join([f'EUW1_{index // 2}_{"AB"[index % 2]}'] + values + [str(int(won))]) + '\n')
+    dataset = prepare(filename)
+    bin_dataset(dataset)
+    model = HistogramBoosting(trees=trees, max_depth=depth, seed=seed).fit(dataset)
+    model_file, artifact_dir = os.path.join(dirname, 'model.pkl'), os.path.join(dirname, 'model')
+    with open(model_file, 'wb') as f:
+        pickle.dump(model, f)
+    export(model, artifact_dir)
+    return model_file, artifact_dir
+
+
+def cold_start(kind, path, columns, runs):
+    '''Returns the median seconds of import, load and first prediction in a fresh process, with and without the numpy import'''
+    code = '\n'.join([
+        'import sys, time, json',
+        'start = time.perf_counter()',
+        'import numpy',
+        'loaded = time.perf_counter()',
+        f'sys.path.insert(0, {TRAINING_DIR!r})',
+        COLD_START[kind].format(path=path),
+        f'model.predict_proba([[0.0] * {columns}])',
+        'print(json.dumps([time.perf_counter() - start, time.perf_counter() - loaded]))'])
+    times = sorted(json.loads(subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout) for _ in range(runs))
+    return times[len(times) // 2]
+
+
+def latencies(model, rows, calls):
+    '''Returns p50 and p99 of predict_proba() for single rows in milliseconds'''
+    times = []
+    for index in range(calls):
+        row = rows[index % len(rows)]
+        start = time.perf_counter()
+        model.predict_proba([row])
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return round(times[len(times) // 2] * 1000, 4), round(times[min(len(times) - 1, int(0.99 * len(times)))] * 1000, 4)
+
+
+def throughput(model, X, repeat=3):
+    '''Returns rows per second of predict_proba() for the whole batch X'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model.predict_proba(X)
+        best = min(best, time.perf_counter() - start)
+    return round(len(X) / best)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the compiled model artifact against the pickled model')
+    parser.add_argument('--artifact', help='compiled model artifact directory of train.py')
+    parser.add_argument('--model', help='pickled model of train.py')
+    parser.add_argument('--trees', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--rows', type=int, default=20000, help='rows of the synthetic training data')
+    parser.add_argument('--calls', type=int, default=2000, help='single team predictions per model')
+    parser.add_argument('--batches', default='1000,10000', help='batch sizes for the throughput')
+    parser.add_argument('--cold-runs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='append the results to this file as json lines')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        model_file, artifact_dir = args.model, args.artifact
+        if model_file is None or artifact_dir is None:
+            model_file, artifact_dir = synthetic_model(tmpdir, args.rows, args.trees, args.depth, args.seed)
+        with open(model_file, 'rb') as f:
+            pickled = pickle.load(f)
+        compiled = CompiledModel.load(artifact_dir)
+
+        rng = np.random.default_rng(args.seed)
+        X = rng.normal(size=(max(int(size) for size in args.batches.split(',')), len(compiled.columns))).astype(np.float32)
+        X[rng.random(X.shape) < 0.02] = np.nan
+        if not np.array_equal(compiled.predict_proba(X[:1000]), pickled.predict_proba(X[:1000])):
+            raise SystemExit('The compiled artifact predicts different probabilities than the pickled model')
+
+        rows = X[:1000].tolist()
+        result = {'trees': compiled.trees, 'depth': compiled.depth, 'model_id': compiled.model_id}
+        for name, model, kind, path in (('artifact', compiled, 'artifact', artifact_dir), ('pickle', pickled, 'pickle', model_file)):
+            p50, p99 = latencies(model, rows, args.calls)
+            total, without_numpy = cold_start(kind, path, len(compiled.columns), args.cold_runs)
+            result[name] = {
+                'cold_start_ms': round(total * 1000, 2),
+                'cold_start_without_numpy_ms': round(without_numpy * 1000, 2),
+                'single_p50_ms': p50,
+                'single_p99_ms': p99,
+                'batch_rows_per_second': {size: throughput(model, X[:int(size)]) for size in args.batches.split(',')}
+            }
+    print(json.dumps(result, indent=2))
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(dict(result, options=vars(args), timestamp=int(time.time()))) + '\n')
+
+
+if __name__ == '__main__':
+    main()
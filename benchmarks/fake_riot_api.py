@@ -0,0 +1,452 @@
+'''
+Local stand-in for the parts of the Riot API used by data_collection/.
+
+The server answers the match, matchlist, champion mastery, summoner and league
+endpoints under http://host:port/{platform}/lol/..., so RiotWatcher can be
+pointed at it by replacing its root url:
+
+    from riotwatcher._apis.UrlConfig import UrlConfig
+    UrlConfig.root_url = 'http://127.0.0.1:8080/{platform}'   # after creating the LolWatcher
+
+and the AsyncLeagueAnalyzer with api_url='http://127.0.0.1:8080/{platform}'.
+
+Responses come from one of two sources:
+
+- a SyntheticWorld: a deterministic population of summoners and matches
+  spread over the last days, generated from a seed
+- a Recording: payloads recorded from the real API (--record) and replayed
+  byte for byte (--replay). Requests that weren't recorded fall back to the
+  synthetic world if one is given, otherwise they are answered with 404.
+
+On top of that the server can inject latency, enforce application and method
+rate limits (answering with 429 and Retry-After like the real API) and inject
+429 and 503 errors at random.
+
+Usage:
+    python fake_riot_api.py --port 8080 --players 2000 --matches 20000 --latency-ms 30 --app-limits 20:1,100:120
+    python fake_riot_api.py --port 8080 --record recording.sqlite --api-key RGAPI-...
+    python fake_riot_api.py --port 8080 --replay recording.sqlite
+'''
+
+import re
+import json
+import math
+import time
+import random
+import sqlite3
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+UPSTREAM_URL = 'https://{platform}.api.riotgames.com'
+# effectively unlimited, but reported so the RateLimitScheduler doesn't fall back to the limits of a development key
+UNLIMITED = '1000000:1'
+DIVISIONS = ('I', 'II', 'III', 'IV')
+TIERS = ('IRON', 'BRONZE', 'SILVER', 'GOLD', 'PLATINUM', 'EMERALD', 'DIAMOND')
+LEAGUE_PAGE_SIZE = 205
+
+
+class SyntheticWorld:
+    '''Deterministic summoners and matches, the newest match is created a few minutes before the world'''
+
+    def __init__(self, players=2000, matches=20000, days=10, seed=0, queue=420, champions=160, match_padding=0):
+        self.SEED = seed
+        self.QUEUE = queue
+        self.CHAMPIONS = champions
+        # bytes of filler per participant, real match documents are 30-60 KB
+        self.MATCH_PADDING = match_padding
+        self.players = players
+        self.now = int(time.time())
+        rng = random.Random(seed)
+        spacing = days * 86400 * 1000 // max(1, matches)
+        self.match_ids = [f'EUW1_{6000000000 + index}' for index in range(matches)]
+        self.index_of = {match_id: index for index, match_id in enumerate(self.match_ids)}
+        self.creation = [(self.now - 600) * 1000 - (matches - index) * spacing for index in range(matches)]
+        self.participants = [rng.sample(range(players), 10) for _ in range(matches)]
+        # match indices of every player, oldest first
+        self.history = [[] for _ in range(players)]
+        for index, participants in enumerate(self.participants):
+            for player in participants:
+                self.history[player].append(index)
+
+    def puuid(self, player):
+        return f'puuid-{player:07d}'
+
+    def summoner_id(self, player):
+        return f'sid-{player:07d}'
+
+    def name(self, player):
+        return f'Player{player}'
+
+    def player_of(self, key):
+        number = re.search(r'(\d+)$', key)
+        player = int(number.group(1)) if number else -1
+        return player if 0 <= player < self.players else None
+
+    def champion_pool(self, player):
+        return random.Random(f'{self.SEED}:pool:{player}').sample(range(1, self.CHAMPIONS + 1), 5)
+
+    def summoner(self, player):
+        return {'id': self.summoner_id(player), 'puuid': self.puuid(player), 'name': self.name(player), 'summonerLevel': 100 + player % 400}
+
+    def match(self, match_id):
+        index = self.index_of.get(match_id)
+        if index is None:
+            return None
+        rng = random.Random(f'{self.SEED}:match:{index}')
+        blue_wins = rng.random() < 0.5
+        participants = []
+        for position, player in enumerate(self.participants[index]):
+            participant = {
+                'puuid': self.puuid(player),
+                'summonerId': self.summoner_id(player),
+                'summonerName': self.name(player),
+                'championId': rng.choice(self.champion_pool(player)),
+                'teamId': 100 if position < 5 else 200,
+                'win': (position < 5) == blue_wins,
+                'challenges': {'kda': round(rng.uniform(0.3, 9), 4)}
+            }
+            if self.MATCH_PADDING:
+                participant['padding'] = 'x' * self.MATCH_PADDING
+            participants.append(participant)
+        return {
+            'metadata': {'matchId': match_id, 'participants': [participant['puuid'] for participant in participants]},
+            'info': {'gameCreation': self.creation[index], 'gameDuration': 1800, 'queueId': self.QUEUE, 'participants': participants}
+        }
+
+    def matchlist(self, puuid, start_time=None, end_time=None, queue=None, start=0, count=20):
+        player = self.player_of(puuid)
+        if player is None:
+            return None
+        if queue is not None and queue != self.QUEUE:
+            return []
+        matchlist = []
+        for index in reversed(self.history[player]):
+            created = self.creation[index] // 1000
+            if end_time is not None and created > end_time:
+                continue
+            if start_time is not None and created < start_time:
+                break
+            matchlist.append(self.match_ids[index])
+        return matchlist[start:start + count]
+
+    def mastery(self, summoner_id, champion):
+        # summoner ids and puuids both end with the number of the player
+        player = self.player_of(summoner_id)
+        if player is None or champion not in self.champion_pool(player):
+            return None
+        points = random.Random(f'{self.SEED}:mastery:{player}:{champion}').randint(1000, 400000)
+        return {'championId': champion, 'championPoints': points, 'championLevel': min(7, 1 + points // 30000), 'summonerId': summoner_id}
+
+    def masteries(self, summoner_id):
+        player = self.player_of(summoner_id)
+        if player is None:
+            return None
+        masteries = [self.mastery(summoner_id, champion) for champion in self.champion_pool(player)]
+        return sorted(masteries, key=lambda mastery: -mastery['championPoints'])
+
+    def league_entry(self, player, tier, division):
+        entry = {'summonerId': self.summoner_id(player), 'puuid': self.puuid(player), 'summonerName': self.name(player), 'tier': tier, 'rank': division}
+        rng = random.Random(f'{self.SEED}:league:{player}')
+        entry.update({'leaguePoints': rng.randint(0, 99), 'wins': rng.randint(10, 200), 'losses': rng.randint(10, 200)})
+        return entry
+
+    def league_entries(self, tier, division, page=1):
+        if tier not in TIERS or division not in DIVISIONS:
+            return None
+        # players are spread over the tiers and divisions in order of their number
+        group = TIERS.index(tier) * len(DIVISIONS) + DIVISIONS.index(division)
+        players = [player for player in range(self.players) if player % (len(TIERS) * len(DIVISIONS)) == group]
+        page_players = players[(page - 1) * LEAGUE_PAGE_SIZE:page * LEAGUE_PAGE_SIZE]
+        return [self.league_entry(player, tier, division) for player in page_players]
+
+    def apex_league(self, tier):
+        players = range(min(self.players, 50))
+        return {'tier': tier, 'name': 'Synthetic League', 'entries': [self.league_entry(player, tier, 'I') for player in players]}
+
+
+class Recording:
+    '''Recorded responses of the real API keyed by request path and query'''
+
+    def __init__(self, filename):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, status INTEGER NOT NULL, body BLOB NOT NULL)')
+        self._connection.commit()
+
+    @staticmethod
+    def key(path, query):
+        return path + '?' + '&'.join(f'{name}={value}' for name, value in sorted(query.items()))
+
+    def get(self, key):
+        with self._lock:
+            return self._connection.execute('SELECT status, body FROM responses WHERE key = ?', (key,)).fetchone()
+
+    def put(self, key, status, body):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO responses (key, status, body) VALUES (?, ?, ?)', (key, status, body))
+            self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+
+class RateLimitWindows:
+    '''Server side view of a rate limit like "20:1,100:120"'''
+
+    def __init__(self, header):
+        self.header = header
+        self.windows = [(int(limit), int(window), deque()) for limit, window in (pair.split(':') for pair in header.split(',') if pair)]
+
+    def hit(self, now):
+        '''Counts a request, returns the seconds to wait if it exceeds a window (the request is then not counted)'''
+        retry_after = 0
+        for limit, window, grants in self.windows:
+            while grants and grants[0] <= now - window:
+                grants.popleft()
+            if len(grants) >= limit:
+                retry_after = max(retry_after, grants[0] + window - now)
+        if retry_after > 0:
+            return retry_after
+        for _, _, grants in self.windows:
+            grants.append(now)
+        return 0
+
+    def counts(self):
+        return ','.join(f'{len(grants)}:{window}' for _, window, grants in self.windows)
+
+
+ROUTES = [
+    ('match.matchlist_by_puuid', re.compile(r'^/lol/match/v5/matches/by-puuid/([^/]+)/ids$')),
+    ('match.by_id', re.compile(r'^/lol/match/v5/matches/([^/]+)$')),
+    ('champion_mastery.by_summoner_by_champion', re.compile(r'^/lol/champion-mastery/v4/champion-masteries/by-summoner/([^/]+)/by-champion/(\d+)$')),
+    ('champion_mastery.by_summoner', re.compile(r'^/lol/champion-mastery/v4/champion-masteries/by-summoner/([^/]+)$')),
+    ('champion_mastery.by_puuid_by_champion', re.compile(r'^/lol/champion-mastery/v4/champion-masteries/by-puuid/([^/]+)/by-champion/(\d+)$')),
+    ('champion_mastery.by_puuid', re.compile(r'^/lol/champion-mastery/v4/champion-masteries/by-puuid/([^/]+)$')),
+    ('summoner.by_name', re.compile(r'^/lol/summoner/v4/summoners/by-name/([^/]+)$')),
+    ('summoner.by_puuid', re.compile(r'^/lol/summoner/v4/summoners/by-puuid/([^/]+)$')),
+    ('summoner.by_id', re.compile(r'^/lol/summoner/v4/summoners/([^/]+)$')),
+    ('league.entries', re.compile(r'^/lol/league/v4/entries/([^/]+)/([^/]+)/([^/]+)$')),
+    ('league.apex', re.compile(r'^/lol/league/v4/(challenger|grandmaster|master)leagues/by-queue/([^/]+)$')),
+]
+
+
+class FakeRiotApi:
+    def __init__(self, world=None, recording=None, upstream=None, api_key=None, latency_ms=0, jitter_ms=0,
+                 app_limits=UNLIMITED, method_limits=None, error_rate_429=0.0, error_rate_503=0.0, seed=0, host='127.0.0.1', port=0):
+        self.world = world
+        self.recording = recording
+        # with an upstream url every request is forwarded to the real API and recorded
+        self.UPSTREAM = upstream
+        self.API_KEY = api_key
+        self.LATENCY = latency_ms / 1000
+        self.JITTER = jitter_ms / 1000
+        self.APP_LIMITS = app_limits
+        self.METHOD_LIMITS = method_limits
+        self.ERROR_RATE_429 = error_rate_429
+        self.ERROR_RATE_503 = error_rate_503
+        self.random = random.Random(seed)
+
+        self._lock = threading.Lock()
+        self._app_windows = {}
+        self._method_windows = {}
+        self.requests = {}
+        self.statuses = {}
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/{{platform}}'
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are separate writes, with Nagle's algorithm every reused connection waits for the delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                status, headers, body = api.handle(self.path)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        '''Serves in a background thread and returns the root url for RiotWatcher'''
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def route(self, path):
+        for method, pattern in ROUTES:
+            match = pattern.match(path)
+            if match:
+                return method, match.groups()
+        return None, ()
+
+    def rate_limit(self, platform, method, now):
+        '''Returns (headers, retry-after or 0, type of the exceeded limit)'''
+        with self._lock:
+            app = self._app_windows.setdefault(platform, RateLimitWindows(self.APP_LIMITS))
+            retry_after = app.hit(now)
+            if retry_after:
+                return {'X-App-Rate-Limit': app.header, 'X-App-Rate-Limit-Count': app.counts()}, retry_after, 'application'
+            headers = {'X-App-Rate-Limit': app.header, 'X-App-Rate-Limit-Count': app.counts()}
+            if self.METHOD_LIMITS:
+                windows = self._method_windows.setdefault((platform, method), RateLimitWindows(self.METHOD_LIMITS))
+                retry_after = windows.hit(now)
+                headers.update({'X-Method-Rate-Limit': windows.header, 'X-Method-Rate-Limit-Count': windows.counts()})
+                if retry_after:
+                    return headers, retry_after, 'method'
+            return headers, 0, None
+
+    def handle(self, raw_path):
+        '''Returns (status, headers, body) of a request'''
+        url = urlsplit(raw_path)
+        _, platform, path = url.path.split('/', 2) if url.path.count('/') >= 2 else ('', '', url.path)
+        path = '/' + path
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        method, _ = self.route(path)
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+        delay = self.LATENCY + (self.random.uniform(0, self.JITTER) if self.JITTER else 0)
+        if delay:
+            time.sleep(delay)
+
+        headers, retry_after, limit_type = self.rate_limit(platform, method, time.time())
+        if retry_after:
+            headers.update({'Retry-After': str(math.ceil(retry_after)), 'X-Rate-Limit-Type': limit_type})
+            return self._response(429, headers, {'status': {'message': 'Rate limit exceeded', 'status_code': 429}})
+        with self._lock:
+            injected = self.random.random()
+        if injected < self.ERROR_RATE_429:
+            # 429 of the underlying service, without Retry-After
+            return self._response(429, headers, {'status': {'message': 'Rate limit exceeded', 'status_code': 429}})
+        if injected < self.ERROR_RATE_429 + self.ERROR_RATE_503:
+            return self._response(503, headers, {'status': {'message': 'Service unavailable', 'status_code': 503}})
+
+        status, body = self.lookup(platform, path, query, method)
+        headers['Content-Type'] = 'application/json;charset=utf-8'
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        return status, headers, body
+
+    def _response(self, status, headers, payload):
+        with self._lock:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        headers['Content-Type'] = 'application/json;charset=utf-8'
+        return status, headers, json.dumps(payload).encode()
+
+    def lookup(self, platform, path, query, method):
+        '''Returns (status, body) from the upstream API, the recording or the synthetic world'''
+        key = Recording.key(f'/{platform}{path}', query)
+        if self.UPSTREAM is not None:
+            status, body = self.forward(platform, path, query)
+            if self.recording is not None and status in (200, 404):
+                self.recording.put(key, status, body)
+            return status, body
+        if self.recording is not None:
+            recorded = self.recording.get(key)
+            if recorded is not None:
+                return recorded[0], bytes(recorded[1])
+        payload = self.synthetic(method, path, query) if self.world is not None else None
+        if payload is None:
+            return 404, json.dumps({'status': {'message': 'Data not found', 'status_code': 404}}).encode()
+        return 200, json.dumps(payload, separators=(',', ':')).encode()
+
+    def forward(self, platform, path, query):
+        url = self.UPSTREAM.format(platform=platform) + path
+        if query:
+            url += '?' + '&'.join(f'{name}={value}' for name, value in query.items())
+        request = urllib.request.Request(url, headers={'X-Riot-Token': self.API_KEY or ''})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as err:
+            return err.code, err.read()
+
+    def synthetic(self, method, path, query):
+        world = self.world
+        _, args = self.route(path)
+        integer = lambda name: int(query[name]) if name in query else None
+        if method == 'match.matchlist_by_puuid':
+            return world.matchlist(args[0], integer('startTime'), integer('endTime'), integer('queue'), integer('start') or 0, integer('count') or 20)
+        if method == 'match.by_id':
+            return world.match(args[0])
+        if method in ('champion_mastery.by_summoner_by_champion', 'champion_mastery.by_puuid_by_champion'):
+            return world.mastery(args[0], int(args[1]))
+        if method in ('champion_mastery.by_summoner', 'champion_mastery.by_puuid'):
+            return world.masteries(args[0])
+        if method in ('summoner.by_name', 'summoner.by_puuid', 'summoner.by_id'):
+            player = world.player_of(args[0])
+            return world.summoner(player) if player is not None else None
+        if method == 'league.entries':
+            return world.league_entries(args[1], args[2], integer('page') or 1)
+        if method == 'league.apex':
+            return world.apex_league(args[0].upper())
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {'requests': sum(self.requests.values()), 'by_method': dict(self.requests), 'by_status': dict(self.statuses)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Riot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--matches', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=10, help='matches are spread over the last DAYS days')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--match-padding', type=int, default=0, help='filler bytes per participant to get realistic payload sizes')
+    parser.add_argument('--replay', help='serve the responses recorded in this file, unknown requests from the synthetic world')
+    parser.add_argument('--record', help='forward all requests to the real API and record the responses in this file')
+    parser.add_argument('--api-key', help='API key used for --record')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--app-limits', default=UNLIMITED, help='e.g. 20:1,100:120')
+    parser.add_argument('--method-limits', help='e.g. 2000:10')
+    parser.add_argument('--error-rate-429', type=float, default=0.0)
+    parser.add_argument('--error-rate-503', type=float, default=0.0)
+    args = parser.parse_args()
+
+    world = None if args.record else SyntheticWorld(args.players, args.matches, args.days, args.seed, match_padding=args.match_padding)
+    recording = Recording(args.record or args.replay) if (args.record or args.replay) else None
+    api = FakeRiotApi(world, recording, UPSTREAM_URL if args.record else None, args.api_key, args.latency_ms, args.jitter_ms,
+                      args.app_limits, args.method_limits, args.error_rate_429, args.error_rate_503, args.seed, args.host, args.port)
+    print(f'Serving the Riot API on {api.url}')
+    if world is not None:
+        print(f'Seed summoner: {world.name(0)}, newest match: {world.match_ids[-1]}')
+    try:
+        api.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(api.stats()))
+
+
+if __name__ == '__main__':
+    main()
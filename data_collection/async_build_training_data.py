@@ -0,0 +1,325 @@
+'''
+Asynchronous sibling of the LeagueAnalyzer from build_training_data.py.
+
+The LeagueAnalyzer looks at the 10 summoners of a game one after another and
+every matchlist, match and mastery request blocks until its response arrives,
+so most of the wall time is spent waiting on the network. The
+AsyncLeagueAnalyzer fetches the histories and masteries of all 10 summoners at
+the same time. All requests share one pooled aiohttp session and one global
+concurrency limit.
+
+The AsyncLeagueAnalyzer wraps a LeagueAnalyzer (created from the same
+arguments, or passed as analyzer=) and uses its configuration, caches, stores
+and feature calculation, so the analyzed games are the same dicts and the
+output csv stays compatible. Only the requests are its own coroutines; the
+LeagueAnalyzer itself stays usable by synchronous callers like the
+BatchPlanner.
+
+Usage:
+    analyzer = AsyncLeagueAnalyzer(max_concurrency=20)
+    analyzer.start_analysis_process('matches_002.txt', 'output.csv')
+
+To run against a local stand-in of the Riot API, pass
+api_url='http://127.0.0.1:8080/{platform}' (see benchmarks/bench_pipeline.py
+--scenario async).
+'''
+
+import time
+import asyncio
+
+import aiohttp
+import requests
+
+from riotwatcher import ApiError
+
+from build_training_data import LeagueAnalyzer
+from participant_store import ParticipantStore
+from rate_limiter import RETRYABLE_STATUS_CODES, backoff_delay
+from telemetry import StageTimer
+
+
+class AsyncLeagueAnalyzer:
+    # Base url of the Riot API, {platform} is replaced by the platform or regional route
+    API_URL = 'https://{platform}.api.riotgames.com'
+
+    # match-v5 is served by regional routes instead of platforms
+    REGIONAL_ROUTES = {
+        'br1': 'americas', 'la1': 'americas', 'la2': 'americas', 'na1': 'americas',
+        'oc1': 'sea', 'ph2': 'sea', 'sg2': 'sea', 'th2': 'sea', 'tw2': 'sea', 'vn2': 'sea',
+        'eun1': 'europe', 'euw1': 'europe', 'ru': 'europe', 'tr1': 'europe',
+        'jp1': 'asia', 'kr': 'asia'
+    }
+
+    def __init__(self, *args, api_url=API_URL, max_concurrency=20, concurrent_games=1, analyzer=None, **kwargs):
+        # configuration, caches, stores and feature calculation; the arguments are those of the LeagueAnalyzer
+        self.analyzer = analyzer if analyzer is not None else LeagueAnalyzer(*args, **kwargs)
+        self.telemetry = self.analyzer.telemetry
+        self.rate_limiter = self.analyzer.rate_limiter
+        self.API_URL = api_url
+        self.MAX_CONCURRENCY = max_concurrency
+        self.CONCURRENT_GAMES = concurrent_games
+        self.session = None
+        self.semaphore = None
+        # match id -> task of the request in flight, shared by all summoners and games asking for it
+        self.pending_matches = {}
+        # summoner id -> task of the mastery list request in flight
+        self.pending_mastery_lists = {}
+
+    async def open_session(self):
+        '''Creates the pooled HTTP session, must be called inside the running event loop'''
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.MAX_CONCURRENCY)
+            self.session = aiohttp.ClientSession(connector=connector, headers={'X-Riot-Token': self.analyzer.API_KEY})
+            self.semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+
+    async def close_session(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.semaphore = None
+
+    async def request(self, platform, path, method, params=None):
+        '''Sends a GET request to the Riot API and returns the decoded json.
+
+        Request slots are reserved from the shared RateLimitScheduler, which is
+        fed by the rate limit headers of every response. Transient errors are
+        repeated with jittered backoff, everything else is raised as ApiError.
+        '''
+        await self.open_session()
+        url = self.API_URL.format(platform=platform) + path
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.rate_limiter.reserve_delay(platform, method))
+            start = time.perf_counter()
+            try:
+                async with self.semaphore:
+                    async with self.session.get(url, params=params) as resp:
+                        self.rate_limiter.record_response(platform, None, method, resp.status, resp.headers)
+                        if resp.status == 200:
+                            payload = await resp.json()
+                            self.telemetry.record_request(method, resp.status, time.perf_counter() - start)
+                            return payload
+                        err = self.api_error(url, resp)
+                        self.telemetry.record_request(method, resp.status, time.perf_counter() - start)
+            except aiohttp.ClientError as client_error:
+                self.telemetry.record_request(method, type(client_error).__name__, time.perf_counter() - start)
+                if attempt >= self.analyzer.MAX_RETRIES:
+                    raise
+                await self.backoff(attempt, method)
+                attempt += 1
+                continue
+            self.analyzer.handle_api_error(err)
+            if resp.status not in RETRYABLE_STATUS_CODES or attempt >= self.analyzer.MAX_RETRIES:
+                raise err
+            if resp.status != 429 or 'Retry-After' not in resp.headers:
+                await self.backoff(attempt, method)
+            attempt += 1
+
+    async def backoff(self, attempt, method):
+        delay = backoff_delay(attempt)
+        self.telemetry.inc('api_retries_total', endpoint=method)
+        self.telemetry.inc('api_backoff_seconds_total', delay, endpoint=method)
+        await asyncio.sleep(delay)
+
+    def api_error(self, url, resp):
+        '''Converts an aiohttp response into the ApiError raised by RiotWatcher'''
+        response = requests.Response()
+        response.status_code = resp.status
+        response.url = url
+        response.headers.update(resp.headers)
+        return ApiError(f'{resp.status} Error for url: {url}', response=response)
+
+    async def get_match(self, match_id):
+        '''Retrieves details of a specific match, concurrent callers share one request'''
+        task = self.pending_matches.get(match_id)
+        if task is None:
+            task = self.pending_matches[match_id] = asyncio.ensure_future(self.fetch_match(match_id))
+            task.add_done_callback(lambda _: self.pending_matches.pop(match_id, None))
+        else:
+            self.analyzer.inflight_matches.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def fetch_match(self, match_id):
+        '''Retrieves details of a specific match from the match cache or Riot API'''
+        match_cache = self.analyzer.match_cache
+        if match_cache is not None:
+            cached_match = match_cache.get(match_id)
+            if cached_match is not None:
+                return cached_match
+        route = self.REGIONAL_ROUTES.get(self.analyzer.SERVER_REGION, self.analyzer.SERVER_REGION)
+        req_match = await self.request(route, f'/lol/match/v5/matches/{match_id}', 'match.by_id')
+        if match_cache is not None:
+            match_cache.put(match_id, req_match)
+        return req_match
+
+    async def get_past_match_ids(self, puuid, excluded_matches, end_time, start_time=None):
+        '''Return a list of id's from past matches of a summoner identified by his puuid
+        that were created between start_time (default: MATCHES_MAX_AGE) and end_time'''
+        analyzer, feature_store = self.analyzer, self.analyzer.feature_store
+        if start_time is None: start_time = analyzer.MATCHES_MAX_AGE
+        matchlist = feature_store.matchlist(puuid, start_time, end_time, analyzer.MATCH_HISTORY_SEARCH_DEPTH, analyzer.QUEUE_TYPE) if feature_store is not None else None
+        if matchlist is None:
+            route = self.REGIONAL_ROUTES.get(analyzer.SERVER_REGION, analyzer.SERVER_REGION)
+            matchlist = await self.request(route, f'/lol/match/v5/matches/by-puuid/{puuid}/ids', 'match.matchlist_by_puuid', {
+                'startTime': start_time,
+                'endTime': end_time,
+                'queue': analyzer.QUEUE_TYPE,
+                'count': analyzer.MATCH_HISTORY_SEARCH_DEPTH
+            })
+            if feature_store is not None:
+                feature_store.record_matchlist(puuid, start_time, end_time, analyzer.MATCH_HISTORY_SEARCH_DEPTH, analyzer.QUEUE_TYPE, matchlist)
+        return [i for i in matchlist if i not in excluded_matches]
+
+    async def get_champion_mastery(self, sId, championId):
+        '''Retrieves a summoner's mastery points (proprietary Riot Games metric) for a specific champion'''
+        mastery_cache = self.analyzer.mastery_cache
+        if mastery_cache is None:
+            return await self.fetch_champion_mastery(sId, championId)
+        points = mastery_cache.get(sId, championId)
+        if points is None and self.analyzer.BULK_MASTERIES:
+            task = self.pending_mastery_lists.get(sId)
+            if task is None:
+                task = self.pending_mastery_lists[sId] = asyncio.ensure_future(self.fetch_mastery_list(sId))
+                task.add_done_callback(lambda _: self.pending_mastery_lists.pop(sId, None))
+            await asyncio.shield(task)
+            points = mastery_cache.get(sId, championId)
+            if points is None:
+                # the mastery list is complete, it only leaves out champions that were never played
+                points = 0
+                mastery_cache.put(sId, championId, points)
+        if points is None:
+            points = await self.fetch_champion_mastery(sId, championId)
+            mastery_cache.put(sId, championId, points)
+        return points
+
+    async def fetch_champion_mastery(self, sId, championId):
+        '''Requests the mastery points of a summoner on a champion, 0 if the champion was never played (404)'''
+        try:
+            mastery = await self.request(self.analyzer.SERVER_REGION, f'/lol/champion-mastery/v4/champion-masteries/by-summoner/{sId}/by-champion/{championId}', 'champion_mastery.by_summoner_by_champion')
+        except ApiError as err:
+            if err.response is not None and err.response.status_code == 404:
+                return 0
+            raise
+        return mastery['championPoints']
+
+    async def fetch_mastery_list(self, sId):
+        '''Stores the mastery points of a summoner on all champions in the mastery cache'''
+        self.analyzer.mastery_cache.put_list(sId, await self.request(self.analyzer.SERVER_REGION, f'/lol/champion-mastery/v4/champion-masteries/by-summoner/{sId}', 'champion_mastery.by_summoner'))
+
+    async def get_match_participants(self, match_id):
+        '''Returns the compact participant records of a match, fetching it only if it isn't in the participant store'''
+        participant_store, feature_store = self.analyzer.participant_store, self.analyzer.feature_store
+        if participant_store is None:
+            return ParticipantStore.records_of_match(await self.get_match(match_id))
+        participants = participant_store.get_match(match_id)
+        if participants is None:
+            participants = participant_store.add_match(await self.get_match(match_id))
+            if feature_store is not None:
+                feature_store.add_records(participants)
+        return participants
+
+    async def get_details_by_matchlist(self, match_ids_list, puuid):
+        '''Retrieves the details of a summoner in all given matches concurrently'''
+        matches = await asyncio.gather(*(self.get_match_participants(match_id) for match_id in match_ids_list))
+        return [self.analyzer.get_participant_details(participants, puuid) for participants in matches]
+
+    async def get_records_by_matchlist(self, match_ids_list, puuid):
+        '''Retrieves the participant records of a summoner in all given matches concurrently'''
+        matches = await asyncio.gather(*(self.get_match_participants(match_id) for match_id in match_ids_list))
+        return [self.analyzer.get_participant_record(participants, puuid) for participants in matches]
+
+    async def get_history(self, puuid, excluded_matches, end_time, stages):
+        # with feature windows the widest window is fetched once, excluded matches are removed per window
+        with stages('matchlist'):
+            past_match_ids = await self.get_past_match_ids(puuid, [] if self.analyzer.FEATURE_WINDOWS else excluded_matches, end_time)
+        with stages('history'):
+            if self.analyzer.FEATURE_WINDOWS:
+                return await self.get_records_by_matchlist(past_match_ids, puuid)
+            return await self.get_details_by_matchlist(past_match_ids, puuid)
+
+    async def get_mastery(self, summoner_data, stages):
+        with stages('mastery'):
+            return await self.get_champion_mastery(summoner_data['sid'], summoner_data['champ'])
+
+    async def analyze_summoner(self, summoner_data, excluded_matches, end_time, stages):
+        '''Analyzes a summoner's past matches while fetching the champion mastery at the same time'''
+        history, mastery = await asyncio.gather(
+            self.get_history(summoner_data['puuid'], excluded_matches, end_time, stages),
+            self.get_mastery(summoner_data, stages))
+        with stages('features'):
+            if self.analyzer.FEATURE_WINDOWS:
+                champion_performance = self.analyzer.window_features(history, excluded_matches, summoner_data['champ'])
+            else:
+                champion_performance = self.analyzer.get_performance(history, summoner_data['champ'])
+        champion_performance['champMastery'] = mastery
+        return champion_performance
+
+    async def analyze_game(self, match_id, stages=None):
+        '''Analyzes a game like LeagueAnalyzer.analyze_game() but all 10 summoners at the same time.
+        The stages of the summoners overlap, so their sum in stages can exceed the time of the game.'''
+        stages = stages if stages is not None else StageTimer()
+        with stages('participants'):
+            participants = await self.get_match_participants(match_id)
+        end_time = int(participants[0].game_creation / 1000)
+        summoners_and_champ = [participant.summoner() for participant in participants]
+
+        # we don't want to include the current match in past-game analysis
+        excluded_matches = [match_id]
+
+        summoners = await asyncio.gather(*(self.analyze_summoner(summoner, excluded_matches, end_time, stages) for summoner in summoners_and_champ))
+        return self.analyzer.build_game_row({'id': match_id}, summoners_and_champ, summoners)
+
+    async def analyze_match(self, match_id):
+        '''Analyzes match_id via analyze_game() plus Error-handling and Debugging'''
+        debug_level = self.analyzer.DEBUG_LEVEL
+        if debug_level <= LeagueAnalyzer.DEBUG_LEVEL_INFO: print(f'[{match_id}] Going to analyze match')
+        # the stages of the 10 summoners overlap, they are summed up over the summoners like in the sync analyzer
+        stages = StageTimer()
+        try:
+            myGame = await self.analyze_game(match_id, stages)
+        except (ApiError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+            # the requests are already retried, a game whose requests still fail is skipped
+            status = LeagueAnalyzer.error_status(err)
+            print(f'[{match_id}] Skipping match after error {status}')
+            self.telemetry.inc('games_total', outcome='error')
+            self.telemetry.record_stages('game', match_id, stages, status=status)
+            return None
+        self.telemetry.inc('games_total', outcome='analyzed')
+        self.telemetry.record_stages('game', match_id, stages)
+        if debug_level <= LeagueAnalyzer.DEBUG_LEVEL_INFO: print(f'[{match_id}] Analysis completed ({self.analyzer.inflight_matches.coalesced} match requests coalesced so far)')
+        return myGame
+
+    async def analyze_games(self, window, writer):
+        '''Analyzes a window of (line number, match id) concurrently and writes the games in input order'''
+        analyzed_matches = await asyncio.gather(*(self.analyze_match(match_id) for _, match_id in window))
+        for (line_nr, _), analyzed_match in zip(window, analyzed_matches):
+            if analyzed_match is None:
+                writer.skip(line_nr)
+                continue
+            writer.write(analyzed_match, line_nr)
+
+    async def run_analysis(self, inputfile, writer):
+        '''Analyzes CONCURRENT_GAMES games at a time and writes them in input order'''
+        try:
+            window = []
+            for line_nr, match_id in self.analyzer.read_match_ids(inputfile, writer):
+                window.append((line_nr, match_id))
+                if len(window) == self.CONCURRENT_GAMES:
+                    await self.analyze_games(window, writer)
+                    self.telemetry.maybe_export()
+                    window = []
+            if window:
+                await self.analyze_games(window, writer)
+        finally:
+            await self.close_session()
+            self.telemetry.export()
+
+    def start_analysis_process(self, inputfile= 'matches_002.txt', outputfile = f'output_{int(time.time())}.csv', rejectfile=None, fsync_every=50, output_format='csv'):
+        with self.analyzer.open_writer(outputfile, rejectfile, fsync_every, output_format) as writer:
+            asyncio.run(self.run_analysis(inputfile, writer))
+
+
+if __name__ == '__main__':
+    analyzer = AsyncLeagueAnalyzer()
+    analyzer.start_analysis_process()
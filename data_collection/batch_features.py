@@ -0,0 +1,135 @@
+'''
+Vectorized computation of the summoner features for many summoners at once.
+
+LeagueAnalyzer.get_collected_info_by_champ() and its helpers process the
+history of one summoner at a time in pure Python. The functions in this
+module compute the same features for a whole batch of summoners with NumPy.
+
+The histories are passed in a padded layout, newest match first:
+
+    champs   int    [summoners, depth]  champion id of every past match
+    kdas     float  [summoners, depth]  kda of every past match
+    wins     bool   [summoners, depth]  outcome of every past match
+    lengths  int    [summoners]         number of valid matches per row
+
+pad_histories() builds this layout from the lists of details returned by
+get_details_by_matchlist().
+
+The results equal the scalar path bit for bit, including the rounding and the
+fallback of champ_avgKda to avgKda when the champion kda is NaN. To get there,
+means and standard deviations are computed on dense blocks of rows that have
+the same number of values, so NumPy sums them in the same order as it does
+for a single list.
+'''
+
+import numpy as np
+
+
+def pad_histories(histories, depth=None):
+    '''Converts lists of match details ({'champ', 'kda', 'win'}) into the padded layout'''
+    lengths = np.array([len(history) for history in histories], dtype=np.int64)
+    depth = depth or max(1, int(lengths.max(initial=0)))
+    champs = np.zeros((len(histories), depth), dtype=np.int64)
+    kdas = np.zeros((len(histories), depth), dtype=np.float64)
+    wins = np.zeros((len(histories), depth), dtype=bool)
+    for row, history in enumerate(histories):
+        for column, match in enumerate(history[:depth]):
+            champs[row, column] = match['champ']
+            kdas[row, column] = match['kda']
+            wins[row, column] = match['win']
+    return champs, kdas, wins, np.minimum(lengths, depth)
+
+
+def _grouped(values, mask, func):
+    '''Applies func(rows, axis=1) to the masked values of every row, NaN for rows without values.
+    Rows with the same number of values are processed as one dense block.'''
+    counts = mask.sum(axis=1)
+    result = np.full(len(values), np.nan)
+    for count in np.unique(counts):
+        if count == 0:
+            continue
+        rows = np.nonzero(counts == count)[0]
+        block = values[rows][mask[rows]].reshape(len(rows), count)
+        result[rows] = func(block, axis=1)
+    return result
+
+
+def trimmed_average(values, mask):
+    '''Batched LeagueAnalyzer.trimmed_average(): the average of the masked values of every row
+    trimmed by 2 standard deviations, 0.0 for empty rows'''
+    mean = _grouped(values, mask, np.mean)[:, None]
+    sd = _grouped(values, mask, np.std)[:, None]
+    with np.errstate(invalid='ignore'):
+        kept = mask & (values > mean - 2 * sd) & (values < mean + 2 * sd)
+    # no trimming if it would reduce the sample size to 0
+    kept = np.where(kept.any(axis=1)[:, None], kept, mask)
+    average = np.round(_grouped(values, kept, np.mean), 3)
+    return np.where(mask.any(axis=1), average, 0.0)
+
+
+def winrate(wins, games):
+    '''Batched LeagueAnalyzer.get_winrate()'''
+    return np.round((wins / np.maximum(1, games)) * 100).astype(np.int64)
+
+
+def streak(wins, valid):
+    '''Batched LeagueAnalyzer.count_streak(): latest unbroken streak of wins (positive) or losses (negative)'''
+    first = wins[:, :1]
+    broken = ~((wins == first) & valid)
+    length = np.where(broken.any(axis=1), broken.argmax(axis=1), wins.shape[1])
+    return np.where(first[:, 0], length, -length)
+
+
+def batch_features(champs, kdas, wins, lengths, champ_ids, masteries=None):
+    '''Computes the PLAYER_ATTRIBUTES of every summoner of a batch.
+
+    Args:
+        champs, kdas, wins, lengths: padded histories, see pad_histories().
+        champ_ids (array): champion id every summoner plays in the analyzed game.
+        masteries (array, optional): champion mastery points of every summoner.
+
+    Returns:
+        dict: one array per attribute plus 'empty', a mask of the summoners
+        without past matches. Their attributes are 'EMPTY' in the scalar path.
+    '''
+    champ_ids = np.asarray(champ_ids)
+    valid = np.arange(champs.shape[1])[None, :] < lengths[:, None]
+    on_champ = valid & (champs == champ_ids[:, None])
+
+    games = valid.sum(axis=1)
+    win_count = (wins & valid).sum(axis=1)
+    champ_games = on_champ.sum(axis=1)
+    champ_win_count = (wins & on_champ).sum(axis=1)
+
+    avg_kda = trimmed_average(kdas, valid)
+    champ_avg_kda = trimmed_average(kdas, on_champ)
+    # if a player hasn't played the current champion recently we can't
+    # calculate champion-specific kda and use general kda instead
+    champ_avg_kda = np.where(np.isnan(champ_avg_kda), avg_kda, champ_avg_kda)
+
+    features = {
+        'winrate': winrate(win_count, games),
+        'champ_winrate': winrate(champ_win_count, champ_games),
+        'avgKda': avg_kda,
+        'champ_avgKda': champ_avg_kda,
+        'streak': streak(wins, valid),
+        'consistency': np.round((champ_games / np.maximum(1, games)) * 100).astype(np.int64),
+        'empty': games == 0
+    }
+    if masteries is not None:
+        features['champMastery'] = np.asarray(masteries)
+    return features
+
+
+def feature_rows(features, attributes):
+    '''Converts the result of batch_features() into one dict per summoner like LeagueAnalyzer.get_performance()'''
+    columns = {attribute: features[attribute].tolist() for attribute in attributes if attribute in features}
+    rows = []
+    for row, empty in enumerate(features['empty']):
+        if empty:
+            rows.append({attribute: 'EMPTY' for attribute in attributes})
+        else:
+            rows.append({attribute: values[row] for attribute, values in columns.items() if attribute != 'champMastery'})
+        if 'champMastery' in columns:
+            rows[-1]['champMastery'] = columns['champMastery'][row]
+    return rows
@@ -0,0 +1,210 @@
+'''
+Request coalescing for the LeagueAnalyzer.
+
+The recent histories of the 10 participants of a game overlap (duo partners,
+repeated opponents) and so do the histories of neighbouring games in the
+match-id file, because gather_match_ids.py crawls them from shared players.
+Analyzing game by game fetches those matches over and over again.
+
+The BatchPlanner analyzes a window of games in three steps:
+
+1. fetch the matchlists of all summoners of all games in the window
+2. take the union of all match ids needed and fetch each one only once
+3. compute the features of all summoners of the window from that shared set
+   in one vectorized batch (see batch_features.py), or per feature window if
+   the analyzer has additional ones
+
+SingleFlight makes sure that concurrent callers asking for the same key
+while it is being fetched wait for the one request in flight instead of
+sending their own.
+'''
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from riotwatcher import ApiError
+
+from batch_features import batch_features, feature_rows, pad_histories
+from telemetry import StageTimer
+
+
+class SingleFlight:
+    '''Deduplicates concurrent calls for the same key'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        '''Calls func(*args, **kwargs) unless a call for key is already in flight, then waits for its result'''
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+
+class BatchPlanner:
+    def __init__(self, analyzer, workers=1):
+        self.analyzer = analyzer
+        self.WORKERS = workers
+        self.games = 0
+        self.planned_requests = 0
+        self.sent_requests = 0
+
+    def _map(self, func, items):
+        '''Applies func to all items, concurrently if more than one worker is configured'''
+        if self.WORKERS <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(self.WORKERS) as executor:
+            return list(executor.map(func, items))
+
+    def _try(self, func, *args):
+        '''Returns func(*args), or the ApiError raised by it'''
+        try:
+            return func(*args)
+        except ApiError as err:
+            return err
+
+    def analyze_games(self, match_ids):
+        '''Analyzes a window of games and returns their game dicts (None for games that failed).
+
+        The results are the same as calling analyzer.analyze_game() for every
+        match id, but every match is only fetched once for the whole window.
+        '''
+        analyzer = self.analyzer
+        stages = StageTimer()
+        api_calls_before = analyzer.api_calls
+
+        # 1. the games themselves and the matchlists of all their summoners
+        with stages('participants'):
+            games = dict(zip(match_ids, self._map(lambda match_id: self._try(analyzer.get_match_participants, match_id), match_ids)))
+        summoners = []
+        for match_id, participants in games.items():
+            if isinstance(participants, ApiError):
+                continue
+            end_time = int(participants[0].game_creation / 1000)
+            for participant in participants:
+                summoners.append((match_id, end_time, participant))
+        with stages('matchlist'):
+            # with feature windows the widest window is fetched and the game itself is excluded per window
+            matchlists = self._map(lambda summoner: self._try(analyzer.get_past_match_ids, summoner[2].puuid, [] if analyzer.FEATURE_WINDOWS else [summoner[0]], summoner[1]), summoners)
+
+        # 2. fetch every match needed by the window only once
+        needed = {match_id for matchlist in matchlists if not isinstance(matchlist, ApiError) for match_id in matchlist}
+        needed.difference_update(games)
+        with stages('history'):
+            fetched = dict(zip(needed, self._map(lambda match_id: self._try(analyzer.get_match_participants, match_id), needed)))
+        fetched.update(games)
+
+        # champion masteries are the same for a summoner and champion within the window
+        mastery_keys = list({(participant.summoner_id, participant.champ) for _, _, participant in summoners})
+        with stages('mastery'):
+            masteries = dict(zip(mastery_keys, self._map(lambda key: self._try(analyzer.get_champion_mastery, *key), mastery_keys)))
+
+        # 3. compute all features from the shared set
+        histories = {}
+        for (match_id, _, participant), matchlist in zip(summoners, matchlists):
+            histories.setdefault(match_id, []).append((participant, matchlist))
+
+        collected = []
+        history_length = 0
+        for match_id in match_ids:
+            if isinstance(games[match_id], ApiError) or any(isinstance(matchlist, ApiError) for _, matchlist in histories[match_id]):
+                collected.append(None)
+                continue
+            history_length += sum(len(matchlist) for _, matchlist in histories[match_id])
+            collected.append(self.collect_game(match_id, histories[match_id], fetched, masteries))
+        with stages('features'):
+            analyzed_games = self.analyze_collected(match_ids, collected)
+        analyzed = sum(game is not None for game in analyzed_games)
+        analyzer.telemetry.inc('games_total', analyzed, outcome='analyzed')
+        analyzer.telemetry.inc('games_total', len(match_ids) - analyzed, outcome='error')
+        analyzer.telemetry.record_stages('window', match_ids[0], stages, games=len(match_ids))
+
+        # without coalescing every game needs its match, 10 matchlists, the history matches and 10 masteries.
+        # Sent are only the requests that reached the API, not those answered by the caches and stores
+        self.games += len(match_ids)
+        self.planned_requests += len(match_ids) + len(summoners) + history_length + len(summoners)
+        self.sent_requests += analyzer.api_calls - api_calls_before
+        return analyzed_games
+
+    def collect_game(self, match_id, history, fetched, masteries):
+        '''Returns the summoners, their match details and masteries of a game, None if something is missing'''
+        summoners_and_champ = []
+        details = []
+        summoner_masteries = []
+        for participant, matchlist in history:
+            matches = [fetched[past_match_id] for past_match_id in matchlist]
+            mastery = masteries[(participant.summoner_id, participant.champ)]
+            if any(isinstance(match, ApiError) for match in matches) or isinstance(mastery, ApiError):
+                print(f'[{match_id}] Skipping match after an error in the history of a summoner')
+                return None
+            summoners_and_champ.append(participant.summoner())
+            if self.analyzer.FEATURE_WINDOWS:
+                details.append([self.analyzer.get_participant_record(participants, participant.puuid) for participants in matches])
+            else:
+                details.append([self.analyzer.get_participant_details(participants, participant.puuid) for participants in matches])
+            summoner_masteries.append(mastery)
+        return summoners_and_champ, details, summoner_masteries
+
+    def analyze_collected(self, match_ids, collected):
+        '''Computes the features of all summoners of all collected games in one batch'''
+        if self.analyzer.FEATURE_WINDOWS:
+            return self.analyze_windows(match_ids, collected)
+        summoners_and_champ = [summoner for game in collected if game is not None for summoner in game[0]]
+        if not summoners_and_champ:
+            return [None] * len(match_ids)
+        histories = [details for game in collected if game is not None for details in game[1]]
+        summoner_masteries = [mastery for game in collected if game is not None for mastery in game[2]]
+        features = batch_features(*pad_histories(histories), [summoner['champ'] for summoner in summoners_and_champ], summoner_masteries)
+        summoners = iter(feature_rows(features, self.analyzer.PLAYER_ATTRIBUTES))
+
+        analyzed_games = []
+        for match_id, game in zip(match_ids, collected):
+            if game is None:
+                analyzed_games.append(None)
+                continue
+            game_summoners = [next(summoners) for _ in game[0]]
+            analyzed_games.append(self.analyzer.build_game_row({'id': match_id}, game[0], game_summoners))
+        return analyzed_games
+
+    def analyze_windows(self, match_ids, collected):
+        '''Computes the features of every feature window from the participant records of the collected games'''
+        analyzed_games = []
+        for match_id, game in zip(match_ids, collected):
+            if game is None:
+                analyzed_games.append(None)
+                continue
+            game_summoners = []
+            for summoner, records, mastery in zip(*game):
+                features = self.analyzer.window_features(records, [match_id], summoner['champ'])
+                features['champMastery'] = mastery
+                game_summoners.append(features)
+            analyzed_games.append(self.analyzer.build_game_row({'id': match_id}, game[0], game_summoners))
+        return analyzed_games
+
+    def stats(self):
+        '''Returns how many requests per game were saved by coalescing'''
+        saved = self.planned_requests - self.sent_requests
+        return {
+            'games': self.games,
+            'planned_requests': self.planned_requests,
+            'sent_requests': self.sent_requests,
+            'saved_per_game': round(saved / self.games, 2) if self.games else 0.0
+        }
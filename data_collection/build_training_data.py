@@ -2,12 +2,24 @@ import os
 import csv
 import time
 import datetime
+import threading
 import configparser
 
 import numpy as np
+import requests
 
 from riotwatcher import LolWatcher, ApiError
 
+from feature_store import FeatureStore
+from mastery_cache import MasteryCache
+from match_cache import MatchCache
+from participant_store import ParticipantStore
+from batch_planner import BatchPlanner, SingleFlight
+from columnar_dataset import ColumnarDatasetWriter
+from dataset_writer import CsvDatasetWriter
+from rate_limiter import RateLimitScheduler, call_with_retries
+from telemetry import StageTimer, Telemetry
+
 
 class LeagueAnalyzer:
     # Constants for debug levels
@@ -22,40 +34,116 @@ class LeagueAnalyzer:
     # Full list of queue types at: https://static.developer.riotgames.com/docs/lol/queues.json
     QUEUE_TYPE_RANKED_SOLO = 420
 
-    def __init__(self, config_file="config.ini", api_key=None, server_region='euw1', max_age_days=14, search_depth=3, queue_type=QUEUE_TYPE_RANKED_SOLO, debug_level=DEBUG_LEVEL_INFO):
+    def __init__(self, config_file="config.ini", api_key=None, server_region='euw1', max_age_days=14, search_depth=3, queue_type=QUEUE_TYPE_RANKED_SOLO, debug_level=DEBUG_LEVEL_INFO, match_cache_file='match_cache.sqlite', match_cache_size_mb=2048, participant_store_file='participants.sqlite', use_feature_store=True, rate_limiter=None, max_retries=5, mastery_cache_file='mastery_cache.sqlite', mastery_ttl_hours=24, bulk_masteries=False, telemetry=None, telemetry_file=None, feature_windows=None):
         # cutoff creation date during match analysis (to exclude matches in the future)
         self.DEBUG_LEVEL = debug_level
         self.SERVER_REGION = server_region
         # Calculate cutoff UNIX timestamp based on max_age_days
-        self.MATCHES_MAX_AGE = int(time.mktime((datetime.date.today() - datetime.timedelta(days=max_age_days)).timetuple()))
+        self.MATCHES_MAX_AGE = self.age_cutoff(max_age_days)
+        # kept for long-running callers (prediction.py) that compute the cutoff per request
+        self.MAX_AGE_DAYS = max_age_days
         self.MATCH_HISTORY_SEARCH_DEPTH = search_depth
+        # (depth, max age in days, column suffix) of every feature window, the first one is the unsuffixed
+        # (search_depth, max_age_days) window. Additional windows are computed from one history fetched
+        # at the widest depth and age, their start times are computed per call, see window_features()
+        self.FEATURE_WINDOWS = []
+        if feature_windows:
+            self.FEATURE_WINDOWS = [(search_depth, max_age_days, None)]
+            for depth, age_days in feature_windows:
+                if (depth, age_days) != (search_depth, max_age_days):
+                    self.FEATURE_WINDOWS.append((depth, age_days, self.window_suffix(depth, age_days)))
+            self.MATCH_HISTORY_SEARCH_DEPTH = max(depth for depth, _, _ in self.FEATURE_WINDOWS)
+            self.MAX_AGE_DAYS = max(age_days for _, age_days, _ in self.FEATURE_WINDOWS)
+            self.MATCHES_MAX_AGE = self.age_cutoff(self.MAX_AGE_DAYS)
         
         self.QUEUE_TYPE = queue_type
         self.PLAYER_ATTRIBUTES = ['winrate', 'champ_winrate', 'avgKda', 'champ_avgKda', 'streak', 'consistency', 'champMastery']
+        # attributes of every summoner in the output, the mastery doesn't depend on the window
+        self.FEATURE_COLUMNS = self.PLAYER_ATTRIBUTES + [f'{attribute}_{suffix}' for _, _, suffix in self.FEATURE_WINDOWS[1:]
+                                                         for attribute in self.PLAYER_ATTRIBUTES if attribute != 'champMastery']
 
         self.API_KEY = api_key
 
         self.load_config(config_file)
         self.current_match_creation_date = 0
-        self.lol_watcher = LolWatcher(self.API_KEY)
+        # request counts and latencies, retries, rate limit waits, cache hit rates and stage timings of every game.
+        # Exported to telemetry_file (Prometheus textfile if it ends with .prom, JSON lines otherwise)
+        self.telemetry = telemetry if telemetry is not None else Telemetry(telemetry_file)
+        # request slots are handed out ahead of time based on the rate limit headers of the API
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimitScheduler(debug=debug_level <= self.DEBUG_LEVEL_DEBUG, telemetry=self.telemetry)
+        if self.rate_limiter.telemetry is None: self.rate_limiter.telemetry = self.telemetry
+        self.MAX_RETRIES = max_retries
+        # requests that reached call_api(), retries of a request not counted (read by the BatchPlanner)
+        self.api_calls = 0
+        self._api_calls_lock = threading.Lock()
+        self.lol_watcher = LolWatcher(self.API_KEY, rate_limiter=self.rate_limiter)
+        # finished matches never change, so they are kept on disk across runs (None disables the cache)
+        self.match_cache = MatchCache(match_cache_file, match_cache_size_mb) if match_cache_file else None
+        # concurrent callers asking for the same match wait for the request in flight
+        self.inflight_matches = SingleFlight()
+        # compact (match, puuid) records, answers participants of known matches without the match json
+        self.participant_store = ParticipantStore(participant_store_file) if participant_store_file else None
+        # answers matchlists of summoners whose history is already known without calling the API
+        self.feature_store = FeatureStore(self.participant_store, summarize=self.get_performance) if self.participant_store is not None and use_feature_store else None
+        # mastery points change slowly, cached values are used until they are older than mastery_ttl_hours
+        self.mastery_cache = MasteryCache(mastery_cache_file, mastery_ttl_hours) if mastery_cache_file else None
+        # fetch the whole mastery list of a summoner with one request instead of one request per champion
+        self.BULK_MASTERIES = bulk_masteries
+        self.inflight_masteries = SingleFlight()
+        self.register_telemetry_sources()
+
+    @staticmethod
+    def age_cutoff(max_age_days, as_of=None):
+        '''Returns the UNIX timestamp max_age_days before today (or before the day of the UNIX timestamp as_of)'''
+        day = datetime.date.fromtimestamp(as_of) if as_of is not None else datetime.date.today()
+        return int(time.mktime((day - datetime.timedelta(days=max_age_days)).timetuple()))
+
+    @staticmethod
+    def window_suffix(depth, max_age_days):
+        '''Returns the column suffix of a feature window, e.g. d10_a7 for the last 10 games of the last 7 days'''
+        return f'd{depth}_a{max_age_days}'
+
+    def register_telemetry_sources(self):
+        '''Exports the hit rates of the caches and stores with the telemetry'''
+        if self.match_cache is not None:
+            self.telemetry.register('match_cache', self.match_cache.stats)
+        if self.mastery_cache is not None:
+            self.telemetry.register('mastery_cache', self.mastery_cache.stats)
+        if self.participant_store is not None:
+            # stats() of the participant store counts the matches on disk, too slow to run on every export
+            self.telemetry.register('participant_store', lambda: {'hits': self.participant_store.hits, 'misses': self.participant_store.misses})
+        if self.feature_store is not None:
+            self.telemetry.register('feature_store', self.feature_store.stats)
+        self.telemetry.register('coalescing', lambda: {'match_requests_coalesced': self.inflight_matches.coalesced, 'mastery_requests_coalesced': self.inflight_masteries.coalesced})
 
     def load_config(self, filename):
         config = configparser.ConfigParser()
         config.read('config.ini')
         if self.API_KEY == None: self.API_KEY = config['DEFAULT']['API_KEY']
 
+    @staticmethod
+    def error_status(err):
+        '''Returns the HTTP status of an ApiError, or the name of the error if there is no response (connection errors, timeouts)'''
+        response = getattr(err, 'response', None)
+        return response.status_code if response is not None else type(err).__name__
+
     def handle_api_error(self, err):
         '''Handles different Riot API errors and prints appropriate messages'''
-        if err.response.status_code == 429:
-            print('this retry-after is handled by default by the RiotWatcher library')
-            print('future requests wait until the retry-after time passes')
-        elif err.response.status_code == 404:
-            print('Match not found.')
-        elif err.response.status_code == 503:
+        status = self.error_status(err)
+        if status == 429:
+            print('Rate limit exceeded, the scheduler holds back requests until the retry-after time passes')
+        elif status == 404:
+            print('Not found (e.g. match, or mastery of a champion that was never played).')
+        elif status == 503:
             print('Small server of indie company is too busy...')
         else:
-            print('Something weird happened, wait 15 sec and try again...')
-            time.sleep(15)
+            print(f'Something weird happened ({status}), retrying the request...')
+
+    def call_api(self, func, *args, **kwargs):
+        '''Calls a RiotWatcher method and repeats only this request on transient errors'''
+        with self._api_calls_lock:
+            self.api_calls += 1
+        return call_with_retries(func, *args, max_retries=self.MAX_RETRIES, on_error=self.handle_api_error, telemetry=self.telemetry, **kwargs)
 
     
     def update_status(self, status_message):
@@ -63,7 +151,7 @@ class LeagueAnalyzer:
         print(f'\r{status_message}', end='', flush=True)
 
 
-    def analyze_game(self, match_id):
+    def analyze_game(self, match_id, stages=None):
         """Analyzes a League of Legends game by retrieving information about summoners and their champions.
 
         Args:
@@ -85,12 +173,17 @@ class LeagueAnalyzer:
         Raises:
             ApiError: If there is an error while retrieving data from the League of Legends API.
 
+        The time spent in each stage ('participants', 'matchlist', 'history',
+        'mastery', 'features') is summed up in the StageTimer stages.
+
         Note:
             - This function depends on other helper methods within the LeagueAnalyzer class to retrieve the necessary information.
             - The summoners are numbered from 1 to 10 based on their order in the game. Only available summoners will have their data analyzed.
             - The 'win' key represents the result of the game. 0 represents a win for summoners 1-5. 1 represents a win for summoners 6-10, and 'ERR' indicates an error in determining the result.
         """
-        summoners_and_champ = self.get_summoners_and_champ(match_id) # returns summoner details numbered 0-9
+        stages = stages if stages is not None else StageTimer()
+        with stages('participants'):
+            summoners_and_champ = self.get_summoners_and_champ(match_id) # returns summoner details numbered 0-9
 
         # we don't want to include the current match in past-game analysis
         excluded_matches = [match_id]
@@ -100,40 +193,112 @@ class LeagueAnalyzer:
         summoners = []
         for summoner_count, summoner in enumerate(summoners_and_champ, start=1):
             if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_DEBUG: print(f'[{summoner_count}/10] Analyzing summoner')
-            summoners.append(self.analyze_summoner(summoner, excluded_matches))
+            summoners.append(self.analyze_summoner(summoner, excluded_matches, stages))
+
+        return self.build_game_row(game, summoners_and_champ, summoners)
 
 
+    def build_game_row(self, game, summoners_and_champ, summoners):
+        '''Adds the analyzed summoners and the outcome of the match to the game dict'''
         if summoners_and_champ[4]['win']==summoners_and_champ[5]['win']:
             win = "ERR"
         else:
             win = 0 if summoners_and_champ[4]['win'] else 1
 
         for summoner_nr, summoner in enumerate(summoners, start=1):
-            for attribute in self.PLAYER_ATTRIBUTES:
+            for attribute in self.FEATURE_COLUMNS:
                 key = f'summoner_{summoner_nr}_{attribute}'
                 game[key] = summoner[attribute]
         game['win'] = win
         return game
 
 
-    def analyze_summoner(self, summoner_data, excluded_matches):
+    def analyze_summoner(self, summoner_data, excluded_matches, stages=None):
         '''Analyzes a summoner's past matches and calculates various performance metrics'''
-        past_match_ids = self.get_past_match_ids(summoner_data['puuid'], excluded_matches)
-        details = self.get_details_by_matchlist(past_match_ids, summoner_data['puuid'])
+        stages = stages if stages is not None else StageTimer()
+        if self.FEATURE_WINDOWS:
+            # the widest window is fetched once, excluded matches are removed per window
+            with stages('matchlist'):
+                past_match_ids = self.get_past_match_ids(summoner_data['puuid'], [])
+            with stages('history'):
+                records = self.get_records_by_matchlist(past_match_ids, summoner_data['puuid'])
+            with stages('features'):
+                champion_performance = self.window_features(records, excluded_matches, summoner_data['champ'])
+        else:
+            with stages('matchlist'):
+                past_match_ids = self.get_past_match_ids(summoner_data['puuid'], excluded_matches)
+            with stages('history'):
+                details = self.get_details_by_matchlist(past_match_ids, summoner_data['puuid'])
+            with stages('features'):
+                champion_performance = self.get_performance(details, summoner_data['champ'])
+        with stages('mastery'):
+            champion_performance['champMastery'] = self.get_champion_mastery(summoner_data['sid'], summoner_data['champ'])
+        return champion_performance
+
+
+    def get_performance(self, details, champ_id):
+        '''Calculates the performance metrics of a summoner's past matches, 'EMPTY' if there are none'''
         if len(details) > 0:
-            champion_performance = self.get_collected_info_by_champ(details, summoner_data['champ'])
+            champion_performance = self.get_collected_info_by_champ(details, champ_id)
         else:
             champion_performance = {}
             for a in self.PLAYER_ATTRIBUTES:
                 champion_performance[a] = 'EMPTY'
                 if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_DEBUG: print('- NO PAST MATCHES FOR THIS SUMMONER -'*2)
-        champion_performance['champMastery'] = self.get_champion_mastery(summoner_data['sid'], summoner_data['champ'])
         return champion_performance
 
 
+    def window_features(self, records, excluded_matches, champ_id, as_of=None):
+        '''Calculates the performance metrics of every feature window from the participant records
+        of the widest window (newest first), with the suffixed attribute names of the window.
+
+        A window takes the newest `depth` records created after its start time (max age days
+        before today, or before the UNIX timestamp as_of) and drops the excluded matches
+        afterwards, which is what the matchlist request of an analyzer configured with that
+        depth and age returns. The features are identical to a separate run with that
+        search_depth and max_age_days.'''
+        features = {}
+        for depth, age_days, suffix in self.FEATURE_WINDOWS:
+            start_time = self.age_cutoff(age_days, as_of)
+            # matchlist times are in seconds, creation times in milliseconds
+            window = [record for record in records if record.game_creation >= start_time * 1000][:depth]
+            details = [record.details() for record in window if record.match_id not in excluded_matches]
+            for attribute, value in self.get_performance(details, champ_id).items():
+                if suffix is None:
+                    features[attribute] = value
+                elif attribute != 'champMastery':
+                    features[f'{attribute}_{suffix}'] = value
+        return features
+
     def get_champion_mastery(self, sId, championId):
         '''Retrieves a summoner's mastery points (proprietary Riot Games metric) for a specific champion'''
-        return self.lol_watcher.champion_mastery.by_summoner_by_champion(self.SERVER_REGION, sId, championId)['championPoints']
+        if self.mastery_cache is None:
+            return self.fetch_champion_mastery(sId, championId)
+        points = self.mastery_cache.get(sId, championId)
+        if points is None and self.BULK_MASTERIES:
+            self.inflight_masteries.do(sId, self.fetch_mastery_list, sId)
+            points = self.mastery_cache.get(sId, championId)
+            if points is None:
+                # the mastery list is complete, it only leaves out champions that were never played
+                points = 0
+                self.mastery_cache.put(sId, championId, points)
+        if points is None:
+            points = self.fetch_champion_mastery(sId, championId)
+            self.mastery_cache.put(sId, championId, points)
+        return points
+
+    def fetch_champion_mastery(self, sId, championId):
+        '''Requests the mastery points of a summoner on a champion, 0 if the champion was never played (404)'''
+        try:
+            return self.call_api(self.lol_watcher.champion_mastery.by_summoner_by_champion, self.SERVER_REGION, sId, championId)['championPoints']
+        except ApiError as err:
+            if err.response is not None and err.response.status_code == 404:
+                return 0
+            raise
+
+    def fetch_mastery_list(self, sId):
+        '''Stores the mastery points of a summoner on all champions in the mastery cache'''
+        self.mastery_cache.put_list(sId, self.call_api(self.lol_watcher.champion_mastery.by_summoner, self.SERVER_REGION, sId))
 
     def get_summoners_and_champ(self, match_id):
         '''Retrieves information about summoners and their champions in a certain
@@ -141,36 +306,40 @@ class LeagueAnalyzer:
         participated in the given match. Dictionary attributes include per 
         summoner: puuid, championId, summonerId and whether they won.'''
 
-        match = self.get_match(match_id)
-        self.current_match_creation_date = int(match['info']['gameCreation'] / 1000)
-        summoners_and_champs = []
-        for summoner in match['info']['participants']:
-            summoners_and_champs.append({
-                'puuid': summoner['puuid'],
-                'champ': summoner['championId'],
-                'sid': summoner['summonerId'],
-                'win': summoner['win']
-            })
-        return summoners_and_champs
-
-
-
-    def get_past_match_ids(self, puuid, excluded_matches):
-        '''Return a list of id's from past matches of a summoner identified by his puuid'''
-        matchlist = self.lol_watcher.match.matchlist_by_puuid(self.SERVER_REGION, puuid, start_time = self.MATCHES_MAX_AGE, queue = self.QUEUE_TYPE, count = self.MATCH_HISTORY_SEARCH_DEPTH, end_time = self.current_match_creation_date)
-        matchlist = [i for i in matchlist if not i in excluded_matches or excluded_matches.remove(i)]
+        participants = self.get_match_participants(match_id)
+        self.current_match_creation_date = int(participants[0].game_creation / 1000)
+        return [participant.summoner() for participant in participants]
+
+
+
+    def get_past_match_ids(self, puuid, excluded_matches, end_time=None, start_time=None):
+        '''Return a list of id's from past matches of a summoner identified by his puuid
+        that were created before end_time (default: creation of the current match)
+        and after start_time (default: MATCHES_MAX_AGE)'''
+        if end_time is None: end_time = self.current_match_creation_date
+        if start_time is None: start_time = self.MATCHES_MAX_AGE
+        matchlist = self.feature_store.matchlist(puuid, start_time, end_time, self.MATCH_HISTORY_SEARCH_DEPTH, self.QUEUE_TYPE) if self.feature_store is not None else None
+        if matchlist is None:
+            matchlist = self.call_api(self.lol_watcher.match.matchlist_by_puuid, self.SERVER_REGION, puuid, start_time = start_time, queue = self.QUEUE_TYPE, count = self.MATCH_HISTORY_SEARCH_DEPTH, end_time = end_time)
+            if self.feature_store is not None:
+                self.feature_store.record_matchlist(puuid, start_time, end_time, self.MATCH_HISTORY_SEARCH_DEPTH, self.QUEUE_TYPE, matchlist)
+        # excluded_matches is shared by all summoners of a game and must not be consumed here
+        matchlist = [i for i in matchlist if i not in excluded_matches]
         return matchlist
 
 
     def get_match(self, match_id):
-        '''Retrieves details of a specific match from Riot API'''
-        while True:
-            try:
-                req_match = self.lol_watcher.match.by_id(self.SERVER_REGION, match_id)
-            except ApiError as err:
-                self.handle_api_error(err)
-                continue
-            break
+        '''Retrieves details of a specific match from the match cache or Riot API'''
+        return self.inflight_matches.do(match_id, self.fetch_match, match_id)
+
+    def fetch_match(self, match_id):
+        if self.match_cache is not None:
+            cached_match = self.match_cache.get(match_id)
+            if cached_match is not None:
+                return cached_match
+        req_match = self.call_api(self.lol_watcher.match.by_id, self.SERVER_REGION, match_id)
+        if self.match_cache is not None:
+            self.match_cache.put(match_id, req_match)
         return req_match
 
 
@@ -179,6 +348,32 @@ class LeagueAnalyzer:
         return next((participant for participant in match['info']['participants'] if participant['puuid'] == puuid), None)
 
 
+    def get_match_participants(self, match_id):
+        '''Returns the compact participant records of a match. The match is only
+        fetched if its participants aren't in the participant store yet'''
+        if self.participant_store is None:
+            return ParticipantStore.records_of_match(self.get_match(match_id))
+        participants = self.participant_store.get_match(match_id)
+        if participants is None:
+            participants = self.participant_store.add_match(self.get_match(match_id))
+            if self.feature_store is not None:
+                self.feature_store.add_records(participants)
+        return participants
+
+
+    def get_participant_record(self, participants, puuid):
+        '''Returns the participant record of a specific participant of a match'''
+        return next(participant for participant in participants if participant.puuid == puuid)
+
+    def get_participant_details(self, participants, puuid):
+        '''Returns champion, kda and outcome of a specific participant of a match'''
+        return self.get_participant_record(participants, puuid).details()
+
+    def get_records_by_matchlist(self, match_ids_list, puuid):
+        '''Returns the participant records (with creation time) of a summoner for a list of match ids'''
+        return [self.get_participant_record(self.get_match_participants(match_id), puuid) for match_id in match_ids_list]
+
+
     def get_details_by_matchlist(self, match_ids_list, puuid):
         """Retrieves match details for a given list of match IDs and a summoner's PUUID.    
 
@@ -196,13 +391,8 @@ class LeagueAnalyzer:
         matches_total = len(match_ids_list)
         for match_count, match_id in enumerate(match_ids_list, start=1):
             if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_DEBUG: self.update_status(f'[{match_count}/{matches_total}] GetDetailsByMatchlist')
-            match_details = self.get_match(match_id)
-            this_participant = self.extract_participant_from_match(match_details, puuid)
-            details_of_player.append({
-                'champ': this_participant['championId'],
-                'kda': this_participant['challenges']['kda'],
-                'win': this_participant['win']
-            })
+            participants = self.get_match_participants(match_id)
+            details_of_player.append(self.get_participant_details(participants, puuid))
         if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_DEBUG: print('')
         return details_of_player
 
@@ -321,15 +511,28 @@ class LeagueAnalyzer:
     def analyze_match(self, match_id):
         '''Analyzes match_id via analyze_game() plus Error-handling and Debugging'''
         if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO: print(f'[{match_id}] Going to analyze match')
-        while True:
-            try:
-                myGame = self.analyze_game(match_id)
-            except ApiError as err:
-                self.handle_api_error(err)
-                continue
-            break
-        
+        if self.match_cache is not None:
+            hits_before, misses_before = self.match_cache.hits, self.match_cache.misses
+        stages = StageTimer()
+        try:
+            myGame = self.analyze_game(match_id, stages)
+        except (ApiError, requests.ConnectionError, requests.Timeout) as err:
+            # transient errors are already retried per request, what's left won't go away by retrying the game
+            status = self.error_status(err)
+            print(f'[{match_id}] Skipping match after error {status}')
+            self.telemetry.inc('games_total', outcome='error')
+            self.telemetry.record_stages('game', match_id, stages, status=status)
+            return None
+        self.telemetry.inc('games_total', outcome='analyzed')
+        self.telemetry.record_stages('game', match_id, stages)
+
         if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO: print(f'[{match_id}] Analysis completed')
+        # only the running counters, stats() of the caches counts their entries on disk
+        if self.match_cache is not None and self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO:
+            hits, misses = self.match_cache.hits - hits_before, self.match_cache.misses - misses_before
+            print(f'[{match_id}] Match cache: {hits} hits, {misses} misses -> {hits} API calls saved (total: {self.match_cache.hits} hits, {self.match_cache.misses} misses)')
+        if self.mastery_cache is not None and self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO:
+            print(f'[{match_id}] Mastery cache: {self.mastery_cache.hits} hits, {self.mastery_cache.misses} misses, {self.mastery_cache.stale} stale')
         if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO: self.update_status(f'[{match_id}] Successfully added to csv')
         return myGame
 
@@ -341,14 +544,85 @@ class LeagueAnalyzer:
                 w.writeheader()
             w.writerow(data)
 
-    def start_analysis_process(self, inputfile= 'matches_002.txt', outputfile = f'output_{int(time.time())}.csv'):
-        firstrun = True
-        matchlist_file = open(os.path.join(os.path.dirname(__file__), inputfile))
-        matches_from_file = matchlist_file.readlines()
-        for match_id in matches_from_file:
-            analyzed_match = self.analyze_match(match_id.strip())
-            self.write_to_csv(outputfile, analyzed_match, firstrun)
-            firstrun = False
+    def read_match_ids(self, inputfile, writer):
+        '''Lazily yields (line number, match id) of all matches that aren't analyzed yet.
+
+        Lines before the checkpoint of a previous run and match ids that are
+        already contained in its output are skipped.
+        '''
+        checkpoint = writer.load_checkpoint()
+        completed_ids = writer.completed_ids()
+        if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO and (checkpoint or completed_ids):
+            print(f'Resuming after line {checkpoint.get("input_line", 0)} ({len(completed_ids)} matches already analyzed)')
+        with open(os.path.join(os.path.dirname(__file__), inputfile)) as matchlist_file:
+            for line_nr, line in enumerate(matchlist_file, start=1):
+                match_id = line.strip()
+                if line_nr <= writer.input_line or not match_id or match_id in completed_ids:
+                    continue
+                yield line_nr, match_id
+
+    def analyze_window(self, planner, window, writer):
+        '''Analyzes a window of (line number, match id) with the BatchPlanner and writes the games'''
+        if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO: print(f'[{window[0][1]}..{window[-1][1]}] Going to analyze {len(window)} matches')
+        analyzed_matches = planner.analyze_games([match_id for _, match_id in window])
+        for (line_nr, _), analyzed_match in zip(window, analyzed_matches):
+            if analyzed_match is None:
+                writer.skip(line_nr)
+                continue
+            writer.write(analyzed_match, line_nr)
+        if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO: print(f'Request coalescing: {planner.stats()}')
+        if self.mastery_cache is not None and self.DEBUG_LEVEL <= self.DEBUG_LEVEL_DEBUG: print(f'Mastery cache: {self.mastery_cache.stats()}')
+
+    def open_writer(self, outputfile, rejectfile=None, fsync_every=50, output_format='csv'):
+        '''Returns the dataset writer for output_format 'csv' or 'columnar'.
+        The columnar dataset is written to a directory named like outputfile without extension.'''
+        if output_format == 'columnar':
+            return ColumnarDatasetWriter(os.path.splitext(outputfile)[0], fsync_every)
+        if output_format != 'csv':
+            raise ValueError(f'Unknown output format {output_format}')
+        return CsvDatasetWriter(outputfile, rejectfile, fsync_every=fsync_every)
+
+    def start_analysis_process(self, inputfile= 'matches_002.txt', outputfile = f'output_{int(time.time())}.csv', rejectfile=None, fsync_every=50, batch_window=1, workers=1, output_format='csv'):
+        '''Analyzes all matches of the input file and streams them into the output csv.
+
+        Progress is checkpointed next to the output file, so restarting with the
+        same outputfile continues where a crashed run stopped. Games with an 'ERR'
+        outcome or 'EMPTY' summoners are written to rejectfile (default:
+        <outputfile>.rejected.csv).
+
+        With batch_window > 1 the games are analyzed in windows by the
+        BatchPlanner, which fetches every match needed by a window only once,
+        using `workers` threads.
+
+        With output_format='columnar' a typed, memory-mappable dataset is
+        written instead of the csv (see columnar_dataset.py), one row group
+        every fsync_every games. Rejected games stay in it with masked values.
+
+        The telemetry is exported every few seconds and when the run ends.
+        '''
+        try:
+            with self.open_writer(outputfile, rejectfile, fsync_every, output_format) as writer:
+                if batch_window > 1:
+                    planner = BatchPlanner(self, workers)
+                    window = []
+                    for line_nr, match_id in self.read_match_ids(inputfile, writer):
+                        window.append((line_nr, match_id))
+                        if len(window) == batch_window:
+                            self.analyze_window(planner, window, writer)
+                            self.telemetry.maybe_export()
+                            window = []
+                    if window:
+                        self.analyze_window(planner, window, writer)
+                    return
+                for line_nr, match_id in self.read_match_ids(inputfile, writer):
+                    analyzed_match = self.analyze_match(match_id)
+                    if analyzed_match is None:
+                        writer.skip(line_nr)
+                    else:
+                        writer.write(analyzed_match, line_nr)
+                    self.telemetry.maybe_export()
+        finally:
+            self.telemetry.export()
 
 if __name__ == '__main__':
     analyzer = LeagueAnalyzer()
@@ -0,0 +1,321 @@
+'''
+Typed, memory-mappable columnar output of the LeagueAnalyzer.
+
+The csv output stores every number as text and mixes 'EMPTY' and 'ERR' into
+numeric columns, so every later stage has to parse the whole file again. The
+columnar output is a directory with one raw little-endian file per column
+and a schema:
+
+    output/
+        schema.json                     columns, dtypes, row groups and checkpoint
+        id.bin                          match ids as fixed width bytes (S32)
+        summoner_1_winrate.bin          int16
+        summoner_1_winrate.mask.bin     bool, True where the value is missing ('EMPTY')
+        ...
+        win.bin                         int8, 0: team A won, 1: team B won
+        win.mask.bin                    True where the outcome is unknown ('ERR')
+
+Rows are appended in row groups of `fsync_every` rows. The column files of a
+row group are written first, then the schema with the new row count and the
+checkpoint is written and fsynced, once per row group. When a crashed run is
+resumed, anything behind the row count of the schema is cut off, and row
+groups whose column data didn't reach the disk are dropped together with
+their checkpoint, so their games are analyzed again. Unlike the csv writer, rejected games stay in the dataset, their
+missing values are marked in the masks. ColumnarDataset.valid() selects the
+rows the csv writer would have accepted.
+
+Reading is zero-copy, every column is a read-only np.memmap:
+
+    dataset = ColumnarDataset('output')
+    winrates = dataset['summoner_1_winrate']
+    rows = dataset.valid()
+
+Usage (convert an existing csv output):
+    python columnar_dataset.py output.csv output
+'''
+
+import os
+import re
+import sys
+import csv
+import json
+import math
+
+import numpy as np
+
+from dataset_writer import WINDOW_SUFFIX, is_window_column
+
+SCHEMA_VERSION = 1
+ID_DTYPE = 'S32'
+ATTRIBUTE_DTYPES = {
+    'winrate': 'int16',
+    'champ_winrate': 'int16',
+    'avgKda': 'float64',
+    'champ_avgKda': 'float64',
+    'streak': 'int16',
+    'consistency': 'int16',
+    'champMastery': 'int64',
+    'win': 'int8'
+}
+MISSING_VALUES = ('EMPTY', 'ERR', '', None)
+# Checkpoints of the latest row groups kept in the schema to resume after a lost row group
+GROUP_CHECKPOINTS = 16
+
+
+def is_missing(value):
+    '''Returns whether a value of the analyzer output is missing: 'EMPTY', 'ERR', empty or NaN'''
+    return value in MISSING_VALUES or isinstance(value, float) and math.isnan(value)
+
+
+def column_dtype(name):
+    '''Returns the dtype of a column of the analyzer output, e.g. summoner_3_avgKda -> float64'''
+    if name == 'id':
+        return ID_DTYPE
+    attribute = WINDOW_SUFFIX.sub('', re.sub(r'^summoner_\d+_', '', name))
+    return ATTRIBUTE_DTYPES.get(attribute, 'float64')
+
+
+class ColumnarDatasetWriter:
+    '''Drop-in replacement for CsvDatasetWriter writing a columnar dataset directory'''
+
+    def __init__(self, dirname, fsync_every=1000):
+        self.DIRNAME = dirname
+        self.SCHEMA_FILENAME = os.path.join(dirname, 'schema.json')
+        self.FSYNC_EVERY = fsync_every
+
+        self.schema = None
+        self.written = 0
+        self.rejected = 0
+        self.input_line = 0
+        self.last_id = None
+        self._buffer = []
+
+    def _read_schema(self):
+        if self.schema is None and os.path.exists(self.SCHEMA_FILENAME):
+            with open(self.SCHEMA_FILENAME) as f:
+                self.schema = json.load(f)
+            self._recover(self.schema)
+        return self.schema
+
+    def _complete_rows(self, schema):
+        '''Returns the number of rows that all column and mask files contain'''
+        rows = schema['rows']
+        for column in schema['columns']:
+            for filename, dtype in ((column['file'], column['dtype']), (column.get('mask'), 'bool')):
+                if filename is not None:
+                    size = os.path.getsize(self._path(filename)) if os.path.exists(self._path(filename)) else 0
+                    rows = min(rows, size // np.dtype(dtype).itemsize)
+        return rows
+
+    def _recover(self, schema):
+        '''Drops the row groups whose column data didn't reach the disk before the schema did'''
+        complete = self._complete_rows(schema)
+        if complete >= schema['rows']:
+            return
+        rows, groups = 0, 0
+        for count in schema['row_groups']:
+            if rows + count > complete:
+                break
+            rows, groups = rows + count, groups + 1
+        # the checkpoints belong to the last len(checkpoints) row groups. Without the checkpoint of the
+        # last complete group the run resumes from the start and skips the ids already in the dataset
+        checkpoints = schema.get('group_checkpoints', [])
+        checkpoints = checkpoints[:max(0, len(checkpoints) - (len(schema['row_groups']) - groups))]
+        schema.update(rows=rows, row_groups=schema['row_groups'][:groups], group_checkpoints=checkpoints,
+                      checkpoint=checkpoints[-1] if checkpoints and groups else {})
+        self._write_schema()
+
+    def _path(self, filename):
+        return os.path.join(self.DIRNAME, filename)
+
+    def load_checkpoint(self):
+        '''Returns the checkpoint of a previous run or an empty dict'''
+        schema = self._read_schema()
+        if schema is None:
+            return {}
+        checkpoint = schema['checkpoint']
+        self.input_line = checkpoint.get('input_line', 0)
+        self.last_id = checkpoint.get('last_id')
+        self.written = checkpoint.get('written', 0)
+        self.rejected = checkpoint.get('rejected', 0)
+        return checkpoint
+
+    def completed_ids(self):
+        '''Returns the ids of all games of a previous run and drops rows that were only partially written'''
+        schema = self._read_schema()
+        if schema is None:
+            return set()
+        self._truncate(schema)
+        dataset = ColumnarDataset(self.DIRNAME)
+        return {match_id.decode() for match_id in dataset['id']}
+
+    def _truncate(self, schema):
+        for column in schema['columns']:
+            for filename, dtype in ((column['file'], column['dtype']), (column.get('mask'), 'bool')):
+                if filename is None or not os.path.exists(self._path(filename)):
+                    continue
+                size = schema['rows'] * np.dtype(dtype).itemsize
+                if os.path.getsize(self._path(filename)) > size:
+                    os.truncate(self._path(filename), size)
+
+    def _create_schema(self, game):
+        os.makedirs(self.DIRNAME, exist_ok=True)
+        columns = []
+        for name in game:
+            column = {'name': name, 'dtype': column_dtype(name), 'file': f'{name}.bin'}
+            if name != 'id':
+                column['mask'] = f'{name}.mask.bin'
+            columns.append(column)
+        # group_checkpoints holds the checkpoint after every row group, used to resume after a lost row group
+        self.schema = {'version': SCHEMA_VERSION, 'byteorder': 'little', 'rows': 0, 'row_groups': [], 'group_checkpoints': [], 'columns': columns, 'checkpoint': {}}
+
+    def is_rejected(self, game):
+        return game['win'] in MISSING_VALUES or any(value in MISSING_VALUES for name, value in game.items() if isinstance(value, str) and not is_window_column(name))
+
+    def write(self, game, input_line=None):
+        '''Buffers an analyzed game, a row group is appended every fsync_every games'''
+        if self._read_schema() is None:
+            self._create_schema(game)
+        if self.is_rejected(game):
+            self.rejected += 1
+        else:
+            self.written += 1
+        self._buffer.append(game)
+        self.last_id = game['id']
+        if input_line is not None:
+            self.input_line = input_line
+        if len(self._buffer) >= self.FSYNC_EVERY:
+            self.sync()
+
+    def skip(self, input_line):
+        '''Records that an input line was processed without producing a row'''
+        self.input_line = input_line
+
+    def _append_row_group(self):
+        for column in self.schema['columns']:
+            name = column['name']
+            dtype = np.dtype(column['dtype']).newbyteorder('<')
+            if name == 'id':
+                ids = [str(game['id']).encode() for game in self._buffer]
+                if max(map(len, ids)) > dtype.itemsize:
+                    raise ValueError(f'Match id longer than {dtype.itemsize} bytes: {max(ids, key=len)}')
+                values = np.array(ids, dtype=dtype)
+                mask = None
+            else:
+                raw = [game.get(name) for game in self._buffer]
+                mask = np.array([is_missing(value) for value in raw], dtype=bool)
+                values = np.array([0 if missing else value for value, missing in zip(raw, mask)]).astype(dtype)
+            # not fsynced per file, the schema is the only fsync of a row group (see _recover())
+            with open(self._path(column['file']), 'ab') as f:
+                f.write(values.tobytes())
+            if mask is not None:
+                with open(self._path(column['mask']), 'ab') as f:
+                    f.write(mask.tobytes())
+        self.schema['rows'] += len(self._buffer)
+        self.schema['row_groups'].append(len(self._buffer))
+        self._buffer = []
+
+    def sync(self):
+        '''Appends the buffered games as a row group and writes the schema with the checkpoint'''
+        if self.schema is None:
+            return
+        appended = bool(self._buffer)
+        if appended:
+            self._append_row_group()
+        self.schema['checkpoint'] = {
+            'input_line': self.input_line,
+            'last_id': self.last_id,
+            'written': self.written,
+            'rejected': self.rejected
+        }
+        if appended:
+            self.schema['group_checkpoints'] = (self.schema.get('group_checkpoints', []) + [self.schema['checkpoint']])[-GROUP_CHECKPOINTS:]
+        self._write_schema()
+
+    def _write_schema(self):
+        tmp_filename = f'{self.SCHEMA_FILENAME}.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.schema, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.SCHEMA_FILENAME)
+
+    def close(self):
+        self.sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ColumnarDataset:
+    '''Read-only, memory mapped view of a dataset written by the ColumnarDatasetWriter'''
+
+    def __init__(self, dirname):
+        self.DIRNAME = dirname
+        with open(os.path.join(dirname, 'schema.json')) as f:
+            self.schema = json.load(f)
+        self.rows = self.schema['rows']
+        self.columns = {column['name']: column for column in self.schema['columns']}
+
+    def __len__(self):
+        return self.rows
+
+    def _map(self, filename, dtype):
+        dtype = np.dtype(dtype).newbyteorder('<')
+        if self.rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.DIRNAME, filename), dtype=dtype, mode='r', shape=(self.rows,))
+
+    def __getitem__(self, name):
+        '''Returns the values of a column, missing values are 0'''
+        column = self.columns[name]
+        return self._map(column['file'], column['dtype'])
+
+    def mask(self, name):
+        '''Returns True for every row in which the value of the column is missing'''
+        column = self.columns[name]
+        if 'mask' not in column:
+            return np.zeros(self.rows, dtype=bool)
+        return self._map(column['mask'], 'bool')
+
+    def masked(self, name):
+        return np.ma.MaskedArray(self[name], mask=self.mask(name))
+
+    def valid(self):
+        '''Returns the indices of all rows without missing values (the rows of the csv output)'''
+        missing = np.zeros(self.rows, dtype=bool)
+        for name in self.columns:
+            missing |= self.mask(name)
+        return np.nonzero(~missing)[0]
+
+    def to_pandas(self, rows=None):
+        '''Returns the dataset as a DataFrame, missing values are NaN'''
+        import pandas as pd
+        rows = slice(None) if rows is None else rows
+        data = {}
+        for name in self.columns:
+            values = self[name][rows]
+            if name == 'id':
+                data[name] = np.char.decode(values)
+            elif self.mask(name)[rows].any():
+                data[name] = np.where(self.mask(name)[rows], np.nan, values)
+            else:
+                data[name] = np.asarray(values)
+        return pd.DataFrame(data)
+
+
+def csv_to_columnar(csvfile, dirname, fsync_every=10000):
+    '''Converts a csv output of the LeagueAnalyzer (or its rejected file) into a columnar dataset'''
+    with open(csvfile, newline='') as f, ColumnarDatasetWriter(dirname, fsync_every) as writer:
+        for row in csv.DictReader(f, delimiter=';'):
+            writer.write({name: (value if is_missing(value) or name == 'id' else float(value)) for name, value in row.items()})
+    return writer.schema['rows'] if writer.schema else 0
+
+
+if __name__ == '__main__':
+    csvfile = sys.argv[1] if len(sys.argv) > 1 else 'output.csv'
+    dirname = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(csvfile)[0]
+    print(f'{csv_to_columnar(csvfile, dirname)} rows written to {dirname}')
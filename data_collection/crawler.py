@@ -0,0 +1,273 @@
+'''
+Resumable breadth-first crawler for match ids.
+
+Starting from seed summoners the crawler alternates between summoners and
+matches:
+
+    puuid (depth d) --matchlist--> match ids (depth d) --match--> puuids (depth d+1)
+
+Matches of the last depth are only collected, never downloaded. Every
+summoner contributes its `fan_out` most recent matches.
+
+The frontier and the seen-set live in SQLite, every puuid and match id is
+only ever queued once. Work is taken from the frontier in batches, lowest
+depth first, and fetched by a pool of threads sharing one rate limiter. The
+results of a batch are committed together, so an interrupted crawl continues
+with the unfinished items of the frontier when it is started again.
+
+New match ids are appended to the output file exactly once, also across
+runs with different seeds.
+
+To discover the summoners of a match the crawler has to download it. With a
+ParticipantStore the participants of every downloaded match are recorded
+there, and build_training_data.py reads them from the same store instead of
+downloading the match again. Matches already in the store are not
+downloaded by the crawler either.
+
+Instead of a single seed summoner, seed_from_league() seeds the crawl with a
+few hundred summoners per request from the ranked league listings.
+
+With a Telemetry (telemetry.py) the crawler records its requests and the
+time every batch spends fetching and committing, exported every few seconds
+and at the end of run().
+
+Usage:
+    crawler = MatchCrawler(lol_watcher, 'euw1', max_depth=2, fan_out=5, workers=8)
+    crawler.add_seeds([puuid])                  # or crawler.seed_from_league('GOLD', ['I', 'II'])
+    crawler.run()
+    crawler.export('manymatches.txt')
+'''
+
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from riotwatcher import ApiError
+
+from rate_limiter import call_with_retries
+from telemetry import StageTimer
+
+PENDING = 0
+DONE = 1
+FAILED = 2
+
+# endpoints of the tiers without divisions
+APEX_TIERS = {'CHALLENGER': 'challenger_by_queue', 'GRANDMASTER': 'grandmaster_by_queue', 'MASTER': 'masters_by_queue'}
+
+
+class MatchCrawler:
+    DEBUG_LEVEL_ALL = 1
+    DEBUG_LEVEL_INFO = 2
+    DEBUG_LEVEL_WARNING = 3
+
+    def __init__(self, lol_watcher, region='euw1', queue=420, start_time=None, max_depth=1, fan_out=1, workers=4,
+                 filename='crawl.sqlite', match_cache=None, participant_store=None, max_retries=5, on_error=None, debug_level=DEBUG_LEVEL_INFO, telemetry=None):
+        self.lol_watcher = lol_watcher
+        self.REGION = region
+        self.QUEUE_TYPE = queue
+        self.START_TIME = start_time
+        self.MAX_DEPTH = max_depth
+        self.FAN_OUT = fan_out
+        self.WORKERS = workers
+        self.BATCH_SIZE = workers * 4
+        self.MAX_RETRIES = max_retries
+        self.DEBUG_LEVEL = debug_level
+        self.match_cache = match_cache
+        self.participant_store = participant_store
+        self.on_error = on_error
+        self.telemetry = telemetry
+        self.requests = 0
+        self._requests_lock = threading.Lock()
+
+        self._connection = sqlite3.connect(filename, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS puuids (
+            puuid TEXT PRIMARY KEY,
+            depth INTEGER NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0)''')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS matches (
+            match_id TEXT PRIMARY KEY,
+            depth INTEGER NOT NULL,
+            state INTEGER NOT NULL DEFAULT 0,
+            exported INTEGER NOT NULL DEFAULT 0)''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS puuids_frontier ON puuids (state, depth)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS matches_frontier ON matches (state, depth)')
+        self._connection.commit()
+        if telemetry is not None:
+            telemetry.register('crawl', self.stats)
+
+    def call_api(self, func, *args, **kwargs):
+        with self._requests_lock:
+            self.requests += 1
+        return call_with_retries(func, *args, max_retries=self.MAX_RETRIES, on_error=self.on_error, telemetry=self.telemetry, **kwargs)
+
+    def add_seeds(self, puuids, depth=0):
+        '''Queues summoners to start the crawl from, summoners that were already seen are ignored'''
+        self._connection.executemany('INSERT OR IGNORE INTO puuids (puuid, depth) VALUES (?, ?)', [(puuid, depth) for puuid in puuids])
+        self._connection.commit()
+
+    def fetch_matchlist(self, puuid):
+        return self.call_api(self.lol_watcher.match.matchlist_by_puuid, self.REGION, puuid, start_time=self.START_TIME, queue=self.QUEUE_TYPE, count=self.FAN_OUT)
+
+    def fetch_match(self, match_id):
+        if self.match_cache is not None:
+            match = self.match_cache.get(match_id)
+            if match is not None:
+                return match
+        match = self.call_api(self.lol_watcher.match.by_id, self.REGION, match_id)
+        if self.match_cache is not None:
+            self.match_cache.put(match_id, match)
+        return match
+
+    def participants_of(self, match_id):
+        '''Returns the puuids of all participants of a match, from the participant store if possible'''
+        if self.participant_store is None:
+            return [participant['puuid'] for participant in self.fetch_match(match_id)['info']['participants']]
+        records = self.participant_store.get_match(match_id)
+        if records is None:
+            records = self.participant_store.add_match(self.fetch_match(match_id))
+        return [record.puuid for record in records]
+
+    def league_entries(self, tier, division='I', page=1, queue='RANKED_SOLO_5x5'):
+        '''Returns the entries of one page of a ranked league, the apex tiers have only one page'''
+        if tier.upper() in APEX_TIERS:
+            if page > 1:
+                return []
+            return self.call_api(getattr(self.lol_watcher.league, APEX_TIERS[tier.upper()]), self.REGION, queue)['entries']
+        return self.call_api(self.lol_watcher.league.entries, self.REGION, queue, tier.upper(), division, page=page)
+
+    def puuid_of(self, entry):
+        # recent league entries contain the puuid, older ones only the summoner id
+        if 'puuid' in entry:
+            return entry['puuid']
+        return self.call_api(self.lol_watcher.summoner.by_id, self.REGION, entry['summonerId'])['puuid']
+
+    def seed_from_league(self, tier, divisions=('I', 'II', 'III', 'IV'), pages=1, queue='RANKED_SOLO_5x5'):
+        '''Queues the summoners of the first `pages` pages of every division of a ranked tier and returns their number'''
+        entries = []
+        for division in divisions:
+            for page in range(1, pages + 1):
+                page_entries = self.league_entries(tier, division, page, queue)
+                entries.extend(page_entries)
+                if not page_entries:
+                    break
+            if tier.upper() in APEX_TIERS:
+                break
+        with ThreadPoolExecutor(self.WORKERS) as executor:
+            puuids = self._fetch(executor, self.puuid_of, entries)
+        puuids = [puuid for puuid in puuids if not isinstance(puuid, ApiError)]
+        self.add_seeds(puuids)
+        return len(puuids)
+
+    def _try(self, func, item):
+        try:
+            return func(item)
+        except ApiError as err:
+            if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_WARNING:
+                status = err.response.status_code if err.response is not None else '?'
+                print(f'\n[{item}] Giving up after error {status}')
+            return err
+
+    def _fetch(self, executor, func, items):
+        if self.WORKERS <= 1:
+            return [self._try(func, item) for item in items]
+        return list(executor.map(lambda item: self._try(func, item), items))
+
+    def next_batch(self):
+        '''Returns ('puuids' | 'matches', [(key, depth)]) of the shallowest unfinished frontier items'''
+        puuid_depth = self._connection.execute('SELECT MIN(depth) FROM puuids WHERE state = ?', (PENDING,)).fetchone()[0]
+        match_depth = self._connection.execute('SELECT MIN(depth) FROM matches WHERE state = ? AND depth < ?', (PENDING, self.MAX_DEPTH)).fetchone()[0]
+        # matches of depth d are expanded after the summoners of depth d listed them
+        if puuid_depth is not None and (match_depth is None or puuid_depth <= match_depth):
+            return 'puuids', self._connection.execute('SELECT puuid, depth FROM puuids WHERE state = ? AND depth = ? LIMIT ?', (PENDING, puuid_depth, self.BATCH_SIZE)).fetchall()
+        if match_depth is not None:
+            return 'matches', self._connection.execute('SELECT match_id, depth FROM matches WHERE state = ? AND depth = ? LIMIT ?', (PENDING, match_depth, self.BATCH_SIZE)).fetchall()
+        return None, []
+
+    def process_puuids(self, executor, batch, stages):
+        '''Lists the matches of a batch of summoners and returns the number of new match ids'''
+        new_matches = 0
+        with stages('fetch'):
+            matchlists = self._fetch(executor, self.fetch_matchlist, [puuid for puuid, _ in batch])
+        with stages('commit'), self._connection:
+            for (puuid, depth), matchlist in zip(batch, matchlists):
+                if not isinstance(matchlist, ApiError):
+                    new_matches += self._connection.executemany('INSERT OR IGNORE INTO matches (match_id, depth) VALUES (?, ?)', [(match_id, depth) for match_id in matchlist]).rowcount
+                self._connection.execute('UPDATE puuids SET state = ? WHERE puuid = ?', (FAILED if isinstance(matchlist, ApiError) else DONE, puuid))
+        return new_matches
+
+    def process_matches(self, executor, batch, stages):
+        '''Queues the participants of a batch of matches and returns the number of new summoners'''
+        new_puuids = 0
+        with stages('fetch'):
+            participants = self._fetch(executor, self.participants_of, [match_id for match_id, _ in batch])
+        with stages('commit'), self._connection:
+            for (match_id, depth), puuids in zip(batch, participants):
+                if not isinstance(puuids, ApiError):
+                    new_puuids += self._connection.executemany('INSERT OR IGNORE INTO puuids (puuid, depth) VALUES (?, ?)', [(puuid, depth + 1) for puuid in puuids]).rowcount
+                self._connection.execute('UPDATE matches SET state = ? WHERE match_id = ?', (FAILED if isinstance(puuids, ApiError) else DONE, match_id))
+        return new_puuids
+
+    def run(self, max_matches=None):
+        '''Crawls until the frontier is empty or max_matches match ids are known'''
+        start = time.time()
+        last_update = 0
+        # stats() counts whole tables, it is run once and the counts are kept up to date with the rows of every batch
+        counts = self.stats()
+        with ThreadPoolExecutor(self.WORKERS) as executor:
+            while max_matches is None or counts['matches'] < max_matches:
+                kind, batch = self.next_batch()
+                if not batch:
+                    break
+                stages = StageTimer()
+                depth = batch[0][1]
+                if kind == 'puuids':
+                    new_matches = self.process_puuids(executor, batch, stages)
+                    counts['matches'] += new_matches
+                    counts['pending_matches'] += new_matches if depth < self.MAX_DEPTH else 0
+                    counts['pending_puuids'] -= len(batch)
+                else:
+                    new_puuids = self.process_matches(executor, batch, stages)
+                    counts['puuids'] += new_puuids
+                    counts['pending_puuids'] += new_puuids
+                    counts['pending_matches'] -= len(batch)
+                if self.telemetry is not None:
+                    self.telemetry.record_stages(f'crawl_{kind}_batch', batch[0][0], stages, depth=depth, items=len(batch))
+                    self.telemetry.maybe_export()
+                if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO and time.time() - last_update >= 1:
+                    last_update = time.time()
+                    rate = self.requests / max(time.time() - start, 1e-9)
+                    print(f'\r[depth {depth}] {counts["matches"]} matches, {counts["puuids"]} summoners, {counts["pending_puuids"] + counts["pending_matches"]} pending, {rate:.2f} requests/s', end='', flush=True)
+        if self.DEBUG_LEVEL <= self.DEBUG_LEVEL_INFO:
+            print('')
+        if self.telemetry is not None:
+            self.telemetry.export()
+
+    def export(self, filename):
+        '''Appends all match ids that weren't exported before to filename and returns their number'''
+        rows = self._connection.execute('SELECT rowid, match_id FROM matches WHERE exported = 0 ORDER BY rowid').fetchall()
+        if not rows:
+            return 0
+        match_ids = [match_id for _, match_id in rows]
+        with open(filename, 'a') as f:
+            for match_id in match_ids:
+                f.write(f'{match_id}\n')
+            f.flush()
+            os.fsync(f.fileno())
+        with self._connection:
+            self._connection.execute('UPDATE matches SET exported = 1 WHERE exported = 0 AND rowid <= ?', (rows[-1][0],))
+        return len(match_ids)
+
+    def stats(self):
+        return {
+            'puuids': self._connection.execute('SELECT COUNT(*) FROM puuids').fetchone()[0],
+            'matches': self._connection.execute('SELECT COUNT(*) FROM matches').fetchone()[0],
+            'pending_puuids': self._connection.execute('SELECT COUNT(*) FROM puuids WHERE state = ?', (PENDING,)).fetchone()[0],
+            'pending_matches': self._connection.execute('SELECT COUNT(*) FROM matches WHERE state = ? AND depth < ?', (PENDING, self.MAX_DEPTH)).fetchone()[0],
+            'requests': self.requests
+        }
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,155 @@
+'''
+Buffered, resumable writer for the semicolon separated output of the LeagueAnalyzer.
+
+One file handle is kept open for the whole run instead of reopening the csv
+for every row. Every `fsync_every` rows the buffers are flushed to disk and a
+checkpoint with the position in the input file is written, so a crashed or
+interrupted run can be restarted and continues where it stopped:
+
+    output.csv                  analyzed games
+    output.rejected.csv         games without a valid outcome ('ERR') or with 'EMPTY' summoners
+                                (columns of additional feature windows, e.g. _d10_a7, don't count)
+    output.checkpoint.json      input line and last match id that were processed
+
+Match ids that are already contained in the output or the rejected file are
+skipped on restart, including the rows written after the last checkpoint.
+'''
+
+import csv
+import json
+import os
+import re
+
+# Suffix of the columns of additional feature windows, see LeagueAnalyzer.window_features()
+WINDOW_SUFFIX = re.compile(r'_d\d+_a\d+$')
+
+
+def is_window_column(name):
+    return WINDOW_SUFFIX.search(name) is not None
+
+
+class CsvDatasetWriter:
+    def __init__(self, filename, reject_filename=None, checkpoint_filename=None, fsync_every=50):
+        base, _ = os.path.splitext(filename)
+        self.FILENAME = filename
+        self.REJECT_FILENAME = reject_filename or f'{base}.rejected.csv'
+        self.CHECKPOINT_FILENAME = checkpoint_filename or f'{base}.checkpoint.json'
+        self.FSYNC_EVERY = fsync_every
+
+        self.written = 0
+        self.rejected = 0
+        self.input_line = 0
+        self.last_id = None
+        self._pending = 0
+        self._files = {}
+        self._writers = {}
+
+    def load_checkpoint(self):
+        '''Returns the checkpoint of a previous run or an empty dict'''
+        if not os.path.exists(self.CHECKPOINT_FILENAME):
+            return {}
+        with open(self.CHECKPOINT_FILENAME) as f:
+            checkpoint = json.load(f)
+        self.input_line = checkpoint.get('input_line', 0)
+        self.last_id = checkpoint.get('last_id')
+        return checkpoint
+
+    def completed_ids(self):
+        '''Returns the ids of all games in the output and rejected file of a previous run'''
+        ids = set()
+        for filename in (self.FILENAME, self.REJECT_FILENAME):
+            if not os.path.exists(filename):
+                continue
+            self._truncate_partial_row(filename)
+            with open(filename, newline='') as f:
+                reader = csv.reader(f, delimiter=';')
+                header = next(reader, None)
+                if header is None:
+                    continue
+                id_column = header.index('id')
+                ids.update(row[id_column] for row in reader if row)
+        return ids
+
+    def _truncate_partial_row(self, filename):
+        '''Removes a row that was only partially written when the previous run crashed'''
+        with open(filename, 'rb+') as f:
+            end = f.seek(0, os.SEEK_END)
+            f.seek(end - 1 if end else 0)
+            if end == 0 or f.read(1) == b'\n':
+                return
+            # scan back block by block to the end of the last complete row, a partial header truncates to 0
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    f.truncate(start + newline + 1)
+                    return
+                end = start
+            f.truncate(0)
+
+    def is_rejected(self, game):
+        # a narrow feature window without games doesn't make the game unusable
+        return game['win'] == 'ERR' or any(value == 'EMPTY' for name, value in game.items() if not is_window_column(name))
+
+    def _writer(self, filename, fieldnames):
+        if filename not in self._writers:
+            has_header = os.path.exists(filename) and os.path.getsize(filename) > 0
+            f = open(filename, 'a', newline='', buffering=1024 * 1024)
+            writer = csv.DictWriter(f, fieldnames, delimiter=';')
+            if not has_header:
+                writer.writeheader()
+            self._files[filename] = f
+            self._writers[filename] = writer
+        return self._writers[filename]
+
+    def write(self, game, input_line=None):
+        '''Writes an analyzed game to the output or the rejected file'''
+        if self.is_rejected(game):
+            self._writer(self.REJECT_FILENAME, game.keys()).writerow(game)
+            self.rejected += 1
+        else:
+            self._writer(self.FILENAME, game.keys()).writerow(game)
+            self.written += 1
+        self.last_id = game['id']
+        if input_line is not None:
+            self.input_line = input_line
+        self._pending += 1
+        if self._pending >= self.FSYNC_EVERY:
+            self.sync()
+
+    def skip(self, input_line):
+        '''Records that an input line was processed without producing a row'''
+        self.input_line = input_line
+
+    def sync(self):
+        '''Flushes all rows to disk and writes the checkpoint'''
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        checkpoint = {
+            'input_line': self.input_line,
+            'last_id': self.last_id,
+            'written': self.written,
+            'rejected': self.rejected
+        }
+        tmp_filename = f'{self.CHECKPOINT_FILENAME}.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.CHECKPOINT_FILENAME)
+        self._pending = 0
+
+    def close(self):
+        self.sync()
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,195 @@
+'''
+Point-in-time store of the match history of every summoner the analyzer has seen.
+
+analyze_summoner() rebuilds the features of a summoner from scratch for every
+game: it requests the matchlist up to the creation of the current game and
+fetches the matches again. The same puuid shows up in many games only days
+apart, so most of those requests return what we already know.
+
+The FeatureStore keeps the known matches of every puuid ordered by creation
+time (from the ParticipantStore) together with the time ranges for which the
+matchlist is known to be complete. Whenever a matchlist is requested for such
+a range, the store answers it locally:
+
+    matchlist(puuid, start_time, end_time, count, queue)
+        -> the `count` newest known matches of the queue created between start
+           and end, if the store knows all matches in that range, else None
+
+Coverage is learned from the matchlists the analyzer requests: a matchlist
+that returns fewer than `count` matches is complete for its whole range, a
+full one is complete from the creation of its oldest match to its end. A
+range only counts as covered once all matches of the matchlist have arrived
+in the ParticipantStore.
+
+features() computes the features "as of timestamp T over the last N games /
+D days" from the same history that get_past_match_ids() would return, so they
+are identical to the features computed by get_collected_info_by_champ().
+
+Several processes may share the SQLite file (sharded_build.py). The known
+matches and the coverage of a puuid are therefore loaded and kept in memory
+together: the coverage is read first, and a range is only written once its
+matches are in the participant store, so a timeline read afterwards contains
+every match of the loaded ranges. Ranges learned later add their matches to
+the timeline before they extend the coverage.
+
+Matchlists waiting for their matches are kept for the newest `pending_puuids`
+puuids only (and the newest PENDING_PER_PUUID matchlists of each), matches
+that 404 or are never fetched would keep them forever otherwise. A dropped
+matchlist only means its range isn't learned.
+'''
+
+import bisect
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Matchlists of a puuid that wait for their matches at the same time
+PENDING_PER_PUUID = 4
+
+
+class FeatureStore:
+    def __init__(self, participant_store, filename=None, memory_puuids=100000, summarize=None, pending_puuids=10000):
+        self.participant_store = participant_store
+        self.FILENAME = filename or participant_store.FILENAME
+        self.MEMORY_PUUIDS = memory_puuids
+        self.PENDING_PUUIDS = pending_puuids
+        # function computing the features from a list of details, e.g. LeagueAnalyzer.get_performance
+        self.summarize = summarize
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.RLock()
+        # puuid -> (creation times, records, {queue: merged coverage ranges}), loaded together
+        self._histories = OrderedDict()
+        # puuid -> matchlists whose matches haven't all arrived yet, oldest puuids are dropped first
+        self._pending = OrderedDict()
+        self._connection = sqlite3.connect(self.FILENAME, timeout=30, check_same_thread=False)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS matchlist_coverage (
+            puuid TEXT NOT NULL,
+            queue INTEGER NOT NULL,
+            start_time INTEGER NOT NULL,
+            end_time INTEGER NOT NULL)''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS matchlist_coverage_puuid ON matchlist_coverage (puuid, queue)')
+        self._connection.commit()
+
+    def _load(self, puuid):
+        '''Returns the known matches and the coverage of a puuid, loading both from disk if they aren't in memory'''
+        with self._lock:
+            if puuid not in self._histories:
+                # coverage first: another process only writes a range after its matches, so the
+                # timeline read afterwards knows every match of the ranges
+                coverage = {}
+                for queue, start, end in self._connection.execute('SELECT queue, start_time, end_time FROM matchlist_coverage WHERE puuid = ?', (puuid,)):
+                    coverage.setdefault(queue, []).append((start, end))
+                records = self.participant_store.by_puuid(puuid)[::-1]
+                self._histories[puuid] = ([record.game_creation for record in records], records,
+                                          {queue: self.merge_ranges(ranges) for queue, ranges in coverage.items()})
+            self._histories.move_to_end(puuid)
+            while len(self._histories) > self.MEMORY_PUUIDS:
+                self._histories.popitem(last=False)
+            return self._histories[puuid]
+
+    def timeline(self, puuid):
+        '''Returns (creation times, records) of all known matches of a puuid, oldest first'''
+        times, records, _ = self._load(puuid)
+        return times, records
+
+    def coverage(self, puuid, queue):
+        '''Returns the merged (start_time, end_time) ranges in which all matches of a puuid are known'''
+        return self._load(puuid)[2].get(queue, [])
+
+    @staticmethod
+    def merge_ranges(ranges):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @staticmethod
+    def _insert(times, known, record):
+        if any(other.match_id == record.match_id for other in known):
+            return
+        index = bisect.bisect_right(times, record.game_creation)
+        times.insert(index, record.game_creation)
+        known.insert(index, record)
+
+    def add_records(self, records):
+        '''Adds the participants of a new match to the timelines that are loaded'''
+        with self._lock:
+            for record in records:
+                for entry in self._pending.pop(record.puuid, []):
+                    self.record_matchlist(*entry)
+                if record.puuid in self._histories:
+                    times, known, _ = self._histories[record.puuid]
+                    self._insert(times, known, record)
+
+    def record_matchlist(self, puuid, start_time, end_time, count, queue, matchlist):
+        '''Learns from a matchlist response for which time range the history of a puuid is complete.
+        The range is kept pending until all matches of the matchlist are in the participant store.'''
+        known = [self.participant_store.get(match_id, puuid) for match_id in matchlist]
+        if None in known:
+            with self._lock:
+                pending = self._pending.setdefault(puuid, [])
+                pending.append((puuid, start_time, end_time, count, queue, matchlist))
+                del pending[:-PENDING_PER_PUUID]
+                self._pending.move_to_end(puuid)
+                while len(self._pending) > self.PENDING_PUUIDS:
+                    self._pending.popitem(last=False)
+            return
+        covered_from = start_time if len(matchlist) < count else known[-1].game_creation // 1000
+        with self._lock:
+            self._connection.execute('INSERT INTO matchlist_coverage (puuid, queue, start_time, end_time) VALUES (?, ?, ?, ?)', (puuid, queue, covered_from, end_time))
+            self._connection.commit()
+            if puuid in self._histories:
+                times, records, coverage = self._histories[puuid]
+                # the matches may have been stored by another process and never passed add_records()
+                for record in known:
+                    self._insert(times, records, record)
+                coverage[queue] = self.merge_ranges(coverage.get(queue, []) + [(covered_from, end_time)])
+
+    def history(self, puuid, start_time, end_time, count, queue):
+        '''Returns the records the matchlist endpoint would return (newest first), None if the store can't tell'''
+        with self._lock:
+            times, records, coverage = self._load(puuid)
+            # matchlist times are in seconds, creation times in milliseconds
+            first = bisect.bisect_left(times, start_time * 1000)
+            last = bisect.bisect_right(times, end_time * 1000 + 999)
+            window = [record for record in reversed(records[first:last]) if record.queue == queue][:count]
+            ranges = list(coverage.get(queue, []))
+        needed_from = window[-1].game_creation // 1000 if len(window) == count else start_time
+        if any(start <= needed_from and end_time <= end for start, end in ranges):
+            self.hits += 1
+            return window
+        self.misses += 1
+        return None
+
+    def matchlist(self, puuid, start_time, end_time, count, queue):
+        '''Returns the match ids the matchlist endpoint would return, None if the store can't tell'''
+        records = self.history(puuid, start_time, end_time, count, queue)
+        return None if records is None else [record.match_id for record in records]
+
+    def features(self, puuid, champ_id, as_of, count, start_time, queue, excluded_matches=()):
+        '''Returns the features of a summoner as of timestamp as_of over the last `count` games
+        created after start_time, None if the store doesn't know the complete history'''
+        records = self.history(puuid, start_time, as_of, count, queue)
+        if records is None:
+            return None
+        details = [record.details() for record in records if record.match_id not in excluded_matches]
+        return self.summarize(details, champ_id)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / requests, 3) if requests else 0.0,
+            'puuids_in_memory': len(self._histories),
+            'pending_puuids': len(self._pending)
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
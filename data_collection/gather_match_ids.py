@@ -2,15 +2,21 @@
 This script uses the RiotWatcher API to gather a list of League of Legends Match-ID's. It follows these steps:
 
 1. It starts by obtaining the unique identifier (puuid) of a summoner based on their name (considered as a seed).
-2. Next, it retrieves the summoner's past matches using the get_past_matches function. The OLDEST_ALLOWED_DATE 
-   variable defines the maximum date for considering matches.
-3. The script extracts the puuid of all summoners who participated in the past matches and removes any duplicates 
-   from the list.
-4. It then iterates over the summoners and retrieves their respective past matches, appending them to the matches list.
-5. Any duplicate match IDs are removed from the matches list.
-6. Finally, the script writes the match IDs to a file named "manymatches.txt" by opening the file in "append" mode.
-
-Depending on player-overlap you can expect around 9*n^2 match ids where n is the number of past matches you fetch
+   With SEED_MODE = 'league' it instead takes all summoners of the first LEAGUE_PAGES pages of the LEAGUE_TIER
+   listings as seeds.
+2. The MatchCrawler (crawler.py) retrieves the PAST_MATCHES_COUNT most recent matches of every summoner it knows
+   of. The OLDEST_ALLOWED_DATE variable defines the maximum date for considering matches.
+3. It extracts the puuid of all summoners who participated in these matches and continues with them, breadth-first,
+   until SEARCH_DEPTH is reached.
+4. The crawl state (frontier and all puuids and match ids seen so far) is kept in "crawl.sqlite", so an interrupted
+   crawl continues where it stopped and summoners or matches are never requested twice.
+   The participants of every downloaded match are recorded in "participants.sqlite", where build_training_data.py
+   finds them, so no match is downloaded twice in the whole pipeline.
+5. Finally, the script appends all match IDs that weren't written before to a file named "manymatches.txt".
+
+Request counts and latencies, rate limit waits and batch timings of the crawl are exported to TELEMETRY_FILE.
+
+Depending on player-overlap you can expect around 9*n^2 match ids per depth where n is the number of past matches you fetch
 """
 
 
@@ -20,19 +26,34 @@ from riotwatcher import LolWatcher, ApiError
 import os
 import configparser
 
+from crawler import MatchCrawler
+from participant_store import ParticipantStore
+from rate_limiter import RateLimitScheduler
+from telemetry import Telemetry
+
 #API_KEY = os.getenv("LOL_API_KEY")
 
 config = configparser.ConfigParser()
 config.read('config.ini')
 API_KEY = config['DEFAULT']['API_KEY']
 
-LOL_WATCHER = LolWatcher(API_KEY)
+TELEMETRY_FILE = 'crawl_metrics.prom' # Prometheus textfile, any other extension appends JSON lines, None disables the export
+TELEMETRY = Telemetry(TELEMETRY_FILE)
+RATE_LIMITER = RateLimitScheduler(telemetry=TELEMETRY) # Hands out request slots ahead of time based on the rate limit headers
+LOL_WATCHER = LolWatcher(API_KEY, rate_limiter=RATE_LIMITER)
 QUEUE_TYPE = 400  # 420 = Ranked 5v5 Solo Queue. 400 = Normal Draft 5v5. Full list of queue types at: https://static.developer.riotgames.com/docs/lol/queues.json
 REGION = 'euw1'
-PAST_MATCHES_COUNT = 1 # number of last matches we gather
+PAST_MATCHES_COUNT = 1 # number of last matches we gather per summoner (fan-out)
+SEARCH_DEPTH = 1 # number of times we go from matches to their summoners and back to their matches
+WORKERS = 4 # threads fetching concurrently, all of them share the rate limit
+CRAWL_STATE_FILE = 'crawl.sqlite'
+SEED_MODE = 'summoner' # 'summoner': start from SEED_USER_NAME, 'league': start from the summoners of a ranked tier
 SEED_USER_NAME = 'OrangenSandwich' # Seed username we get the first few matches from
+LEAGUE_TIER = 'GOLD' # IRON ... DIAMOND (4 divisions) or MASTER, GRANDMASTER, CHALLENGER
+LEAGUE_PAGES = 1 # pages per division, one page holds about 200 summoners
 OLDEST_ALLOWED_DATE = datetime.date.today() - datetime.timedelta(days=14) # Define cutoff date for matches that are taken into account
 OLDEST_ALLOWED_DATE = int(time.mktime(OLDEST_ALLOWED_DATE.timetuple())) # Convert the datetime object into an integer Unix timestamp
+PARTICIPANT_STORE = ParticipantStore('participants.sqlite') # Shared with build_training_data.py so crawled matches are not downloaded again
 
 
 def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, length=100, fill='█', print_end="\r"):
@@ -44,66 +65,32 @@ def print_progress_bar(iteration, total, prefix='', suffix='', decimals=1, lengt
         print()
 
 
-def get_past_matches(puuid):
-    match_list = LOL_WATCHER.match.matchlist_by_puuid(REGION, puuid, start_time=OLDEST_ALLOWED_DATE, queue=QUEUE_TYPE, count=PAST_MATCHES_COUNT)
-    return match_list
-
-
-def get_match(match_id):
-    while True:
-        try:
-            req_match = LOL_WATCHER.match.by_id(REGION, match_id)
-        except ApiError as err:
-            if err.response.status_code == 429:
-                print('This retry-after is handled by default by the RiotWatcher library')
-                print('Future requests wait until the retry-after time passes')
-            elif err.response.status_code == 404:
-                print('Match not found.')
-            elif err.response.status_code == 503:
-                print('Server is too busy...')
-            else:
-                print('Something weird happened, wait 15 sec and try again...')
-                time.sleep(15)
-                continue
-        break
-    return req_match
-
-
+def handle_api_error(err):
+    if err.response.status_code == 429:
+        print('Rate limit exceeded, the scheduler holds back requests until the retry-after time passes')
+    elif err.response.status_code == 404:
+        print('Match not found.')
+    elif err.response.status_code == 503:
+        print('Server is too busy...')
+    else:
+        print(f'Something weird happened ({err.response.status_code}), retrying the request...')
 
 
 def get_summoner_puuid(region, username):
     # Get the unique identifier (puuid) of a summoner by their name
     return LOL_WATCHER.summoner.by_name(region, username)['puuid']
 
-def get_all_summoners(past_matches):
-    # Extract the puuid of all summoners in the past matches
-    summoners = []
-    for match_id in past_matches:
-        match = get_match(match_id)
-        summoners.extend([participant['puuid'] for participant in match['info']['participants']])
-    # Remove duplicates from the list of summoners
-    return list(set(summoners))
-
-def get_all_matches(summoners):
-    matches = []
-    for summoner in summoners:
-        matches.extend(get_past_matches(summoner))
-    # Remove duplicates from the list of matches
-    return list(set(matches))
-
-
-def write_matches_to_file(matches, filename):
-    with open(filename, "a") as f:
-        for match_id in matches:
-            f.write(f"{match_id}\n")
-
-
 def main():
-    puuid = get_summoner_puuid(REGION, SEED_USER_NAME)
-    past_matches = get_past_matches(puuid)
-    summoners = get_all_summoners(past_matches)
-    matches = get_all_matches(summoners)
-    write_matches_to_file(matches, "manymatches.txt")
+    crawler = MatchCrawler(LOL_WATCHER, REGION, QUEUE_TYPE, OLDEST_ALLOWED_DATE, SEARCH_DEPTH, PAST_MATCHES_COUNT, WORKERS, CRAWL_STATE_FILE, participant_store=PARTICIPANT_STORE, on_error=handle_api_error, telemetry=TELEMETRY)
+    if SEED_MODE == 'league':
+        print(f'{crawler.seed_from_league(LEAGUE_TIER, pages=LEAGUE_PAGES)} summoners of {LEAGUE_TIER} added as seeds')
+    else:
+        crawler.add_seeds([get_summoner_puuid(REGION, SEED_USER_NAME)])
+    crawler.run()
+    print(f'{crawler.export("manymatches.txt")} new match ids written')
+    print(f'Crawl: {crawler.stats()}')
+    print(f'Participant store: {PARTICIPANT_STORE.stats()}')
+    crawler.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
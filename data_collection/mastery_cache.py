@@ -0,0 +1,117 @@
+'''
+Persistent cache for champion mastery points.
+
+Every analyzed game needs the mastery of its 10 summoners on their champions,
+which is 10 requests per game. The same (summoner, champion) pairs come up
+again and again, and mastery points only grow slowly, so a value fetched a
+few hours ago is usually good enough.
+
+Entries are kept in SQLite together with the time they were fetched. get()
+only answers entries younger than the TTL; older entries count as stale and
+are fetched again. When a stale entry is replaced, the relative change of
+its points is recorded, so stats() shows how much accuracy a TTL costs:
+
+    drift = |new points - old points| / new points
+
+With bulk requests, the whole mastery list of a summoner is fetched with one
+request (champion_mastery.by_summoner) and answers all champions of that
+summoner until the entries expire.
+
+Usage:
+    cache = MasteryCache('mastery_cache.sqlite', ttl_hours=24)
+    points = cache.get(summoner_id, champion_id)
+    if points is None:
+        points = lol_watcher.champion_mastery.by_summoner_by_champion(region, summoner_id, champion_id)['championPoints']
+        cache.put(summoner_id, champion_id, points)
+    print(cache.stats())
+'''
+
+import sqlite3
+import threading
+import time
+
+
+class MasteryCache:
+    def __init__(self, filename='mastery_cache.sqlite', ttl_hours=24):
+        self.FILENAME = filename
+        # None keeps entries forever
+        self.TTL = ttl_hours * 3600 if ttl_hours is not None else None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.bulk_fetches = 0
+        self.refreshed = 0
+        self.drift_sum = 0.0
+        self._stale_points = {}
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS masteries (
+            summoner_id TEXT NOT NULL,
+            champ INTEGER NOT NULL,
+            points INTEGER NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (summoner_id, champ))''')
+        self._connection.commit()
+
+    def get(self, summoner_id, champ, now=None):
+        '''Returns the mastery points of a summoner on a champion, None if unknown or older than the TTL'''
+        now = time.time() if now is None else now
+        with self._lock:
+            row = self._connection.execute('SELECT points, fetched_at FROM masteries WHERE summoner_id = ? AND champ = ?', (summoner_id, champ)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            points, fetched_at = row
+            if self.TTL is not None and now - fetched_at > self.TTL:
+                self.stale += 1
+                self._stale_points[(summoner_id, champ)] = points
+                return None
+            self.hits += 1
+            return points
+
+    def _record_drift(self, summoner_id, champ, points):
+        old_points = self._stale_points.pop((summoner_id, champ), None)
+        if old_points is not None:
+            self.refreshed += 1
+            self.drift_sum += abs(points - old_points) / max(1, points)
+
+    def put(self, summoner_id, champ, points, now=None):
+        '''Stores the mastery points of a summoner on a champion'''
+        now = time.time() if now is None else now
+        with self._lock:
+            self._record_drift(summoner_id, champ, points)
+            self._connection.execute('INSERT OR REPLACE INTO masteries (summoner_id, champ, points, fetched_at) VALUES (?, ?, ?, ?)', (summoner_id, champ, points, now))
+            self._connection.commit()
+
+    def put_list(self, summoner_id, masteries, now=None):
+        '''Stores a mastery list as returned by champion_mastery.by_summoner'''
+        now = time.time() if now is None else now
+        with self._lock:
+            self.bulk_fetches += 1
+            rows = []
+            for mastery in masteries:
+                self._record_drift(summoner_id, mastery['championId'], mastery['championPoints'])
+                rows.append((summoner_id, mastery['championId'], mastery['championPoints'], now))
+            self._connection.executemany('INSERT OR REPLACE INTO masteries (summoner_id, champ, points, fetched_at) VALUES (?, ?, ?, ?)', rows)
+            self._connection.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.stale
+        with self._lock:
+            entries = self._connection.execute('SELECT COUNT(*) FROM masteries').fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'bulk_fetches': self.bulk_fetches,
+            'refreshed': self.refreshed,
+            'mean_drift': round(self.drift_sum / self.refreshed, 4) if self.refreshed else 0.0,
+            'entries': entries
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
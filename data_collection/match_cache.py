@@ -0,0 +1,119 @@
+'''
+Persistent on-disk store for match documents of the Riot API.
+
+Finished matches never change, so a match that has been downloaded once can
+be served from disk for every later request - no matter if it shows up again
+in another summoner's match history or in a later run of the build.
+
+Matches are stored zlib-compressed in a SQLite database keyed by their match
+id. Once the stored payloads exceed the configured size cap, the least
+recently used matches are evicted until the store is back below 90% of the cap.
+
+Usage:
+    cache = MatchCache('match_cache.sqlite', max_size_mb=2048)
+    match = cache.get(match_id)
+    if match is None:
+        match = lol_watcher.match.by_id(region, match_id)
+        cache.put(match_id, match)
+    print(cache.stats())
+'''
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class MatchCache:
+    # Fraction of the size cap the store is shrunk to once the cap is exceeded
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, filename='match_cache.sqlite', max_size_mb=2048):
+        self.FILENAME = filename
+        self.MAX_SIZE = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._accessed = {}
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS matches (
+            match_id TEXT PRIMARY KEY,
+            payload BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL)''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS matches_last_access ON matches (last_access)')
+        self._connection.commit()
+        self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM matches').fetchone()[0]
+
+    def __contains__(self, match_id):
+        with self._lock:
+            return self._connection.execute('SELECT 1 FROM matches WHERE match_id = ?', (match_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM matches').fetchone()[0]
+
+    def get(self, match_id):
+        '''Returns the stored match document or None if the match is not cached'''
+        with self._lock:
+            row = self._connection.execute('SELECT payload FROM matches WHERE match_id = ?', (match_id,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # access times are written together with the next match, so reads never hold the database lock
+            self._accessed[match_id] = time.time()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, match_id, match):
+        '''Stores a match document and evicts old matches if the size cap is exceeded'''
+        payload = zlib.compress(json.dumps(match, separators=(',', ':')).encode('utf-8'))
+        with self._lock:
+            old = self._connection.execute('SELECT size FROM matches WHERE match_id = ?', (match_id,)).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._connection.execute('INSERT OR REPLACE INTO matches (match_id, payload, size, last_access) VALUES (?, ?, ?, ?)',
+                                     (match_id, payload, len(payload), time.time()))
+            self._size += len(payload)
+            self._connection.executemany('UPDATE matches SET last_access = ? WHERE match_id = ?', [(t, m) for m, t in self._accessed.items()])
+            self._accessed = {}
+            if self._size > self.MAX_SIZE:
+                # other processes may share the store, so the size is recounted before evicting
+                self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM matches').fetchone()[0]
+            if self._size > self.MAX_SIZE:
+                self._evict(int(self.MAX_SIZE * self.EVICTION_TARGET))
+            self._connection.commit()
+
+    def _evict(self, target_size):
+        '''Deletes the least recently used matches until the store is smaller than target_size'''
+        rows = self._connection.execute('SELECT match_id, size FROM matches ORDER BY last_access')
+        evicted = []
+        for match_id, size in rows:
+            if self._size <= target_size:
+                break
+            evicted.append((match_id,))
+            self._size -= size
+        self._connection.executemany('DELETE FROM matches WHERE match_id = ?', evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        '''Returns hit/miss counters and the current size of the store'''
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / requests, 3) if requests else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self),
+            'size_mb': round(self._size / (1024 * 1024), 2)
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.executemany('UPDATE matches SET last_access = ? WHERE match_id = ?', [(t, m) for m, t in self._accessed.items()])
+            self._connection.commit()
+            self._connection.close()
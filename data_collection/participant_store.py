@@ -0,0 +1,166 @@
+'''
+Compact store of the participants of all matches the analyzer has seen.
+
+A full match document is tens of KB of json, but the analyzer only uses a few
+fields of each participant. The ParticipantStore keeps one small record per
+(match, puuid) with just those fields, so any participant of any known match
+can be answered without downloading or parsing the match again.
+
+Records are persisted in SQLite, indexed by match id and by puuid. The most
+recently used matches are additionally kept in memory.
+
+Usage:
+    store = ParticipantStore('participants.sqlite')
+    store.add_match(match)                     # a match document of match-v5
+    record = store.get(match_id, puuid)        # None if the match is unknown
+    history = store.by_puuid(puuid)            # all known matches of a summoner, newest first
+'''
+
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class ParticipantRecord:
+    '''One participant of one match'''
+    __slots__ = ('match_id', 'position', 'puuid', 'summoner_id', 'champ', 'kda', 'win', 'game_creation', 'queue')
+
+    def __init__(self, match_id, position, puuid, summoner_id, champ, kda, win, game_creation, queue):
+        self.match_id = match_id
+        self.position = position
+        self.puuid = puuid
+        self.summoner_id = summoner_id
+        self.champ = champ
+        self.kda = kda
+        self.win = win
+        self.game_creation = game_creation
+        self.queue = queue
+
+    def details(self):
+        '''Returns the participant in the format of LeagueAnalyzer.get_participant_details()'''
+        return {'champ': self.champ, 'kda': self.kda, 'win': self.win}
+
+    def summoner(self):
+        '''Returns the participant in the format of LeagueAnalyzer.get_summoners_and_champ()'''
+        return {'puuid': self.puuid, 'champ': self.champ, 'sid': self.summoner_id, 'win': self.win}
+
+    def __repr__(self):
+        return f'ParticipantRecord({self.match_id}, {self.puuid}, champ={self.champ}, kda={self.kda}, win={self.win})'
+
+
+class ParticipantStore:
+    COLUMNS = ParticipantRecord.__slots__
+
+    def __init__(self, filename='participants.sqlite', memory_matches=20000):
+        self.FILENAME = filename
+        # a match in memory takes about 4 KB (10 records with their puuid and summoner id strings),
+        # so the default keeps about 80 MB; older matches are read back from SQLite
+        self.MEMORY_MATCHES = memory_matches
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._matches = OrderedDict()
+        self._connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS participants (
+            match_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            puuid TEXT NOT NULL,
+            summoner_id TEXT,
+            champ INTEGER NOT NULL,
+            kda REAL,
+            win INTEGER NOT NULL,
+            game_creation INTEGER NOT NULL,
+            queue INTEGER,
+            PRIMARY KEY (match_id, position))''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS participants_puuid ON participants (puuid, game_creation)')
+        self._connection.commit()
+
+    @staticmethod
+    def records_of_match(match):
+        '''Extracts the compact participant records of a match document'''
+        match_id = match['metadata']['matchId']
+        info = match['info']
+        return tuple(ParticipantRecord(
+            match_id,
+            position,
+            participant['puuid'],
+            participant.get('summonerId'),
+            participant['championId'],
+            participant.get('challenges', {}).get('kda', math.nan),
+            bool(participant['win']),
+            info['gameCreation'],
+            info.get('queueId')
+        ) for position, participant in enumerate(info['participants']))
+
+    def _remember(self, match_id, records):
+        self._matches[match_id] = records
+        self._matches.move_to_end(match_id)
+        while len(self._matches) > self.MEMORY_MATCHES:
+            self._matches.popitem(last=False)
+
+    def add_match(self, match):
+        '''Stores all participants of a match document and returns their records'''
+        records = self.records_of_match(match)
+        with self._lock:
+            self._connection.executemany(f'INSERT OR REPLACE INTO participants ({", ".join(self.COLUMNS)}) VALUES ({", ".join("?" * len(self.COLUMNS))})',
+                                         [tuple(getattr(record, column) for column in self.COLUMNS) for record in records])
+            self._connection.commit()
+            self._remember(records[0].match_id, records)
+        return records
+
+    def get_match(self, match_id):
+        '''Returns the records of all participants of a match ordered by position, None if the match is unknown'''
+        with self._lock:
+            records = self._matches.get(match_id)
+            if records is None:
+                rows = self._connection.execute(f'SELECT {", ".join(self.COLUMNS)} FROM participants WHERE match_id = ? ORDER BY position', (match_id,)).fetchall()
+                if not rows:
+                    self.misses += 1
+                    return None
+                records = tuple(self._record(row) for row in rows)
+            self._remember(match_id, records)
+            self.hits += 1
+            return records
+
+    def get(self, match_id, puuid):
+        '''Returns the record of a participant of a match, None if the match is unknown'''
+        records = self.get_match(match_id)
+        if records is None:
+            return None
+        return next((record for record in records if record.puuid == puuid), None)
+
+    def by_puuid(self, puuid, start_time=None, end_time=None):
+        '''Returns the records of all known matches of a summoner, newest first.
+        start_time and end_time are unix timestamps in seconds like in the matchlist endpoint.'''
+        query = f'SELECT {", ".join(self.COLUMNS)} FROM participants WHERE puuid = ?'
+        params = [puuid]
+        if start_time is not None:
+            query += ' AND game_creation >= ?'
+            params.append(start_time * 1000)
+        if end_time is not None:
+            query += ' AND game_creation <= ?'
+            params.append(end_time * 1000 + 999)
+        with self._lock:
+            rows = self._connection.execute(query + ' ORDER BY game_creation DESC', params).fetchall()
+        return [self._record(row) for row in rows]
+
+    def _record(self, row):
+        record = ParticipantRecord(*row)
+        record.win = bool(record.win)
+        if record.kda is None: record.kda = math.nan
+        return record
+
+    def __contains__(self, match_id):
+        return self.get_match(match_id) is not None
+
+    def stats(self):
+        with self._lock:
+            matches = self._connection.execute('SELECT COUNT(DISTINCT match_id) FROM participants').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'matches': matches, 'in_memory': len(self._matches)}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
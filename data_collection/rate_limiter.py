@@ -0,0 +1,218 @@
+'''
+Proactive rate limiting for the Riot API.
+
+Riot limits every API key per routing value (e.g. 'euw1' or 'europe') by
+application limits and by per-method limits, each of them consisting of
+several windows like "20 requests per second and 100 requests per 2 minutes".
+The limits and the current counts are reported in the response headers:
+
+    X-App-Rate-Limit: 20:1,100:120
+    X-App-Rate-Limit-Count: 1:1,1:120
+    X-Method-Rate-Limit: 2000:10
+    X-Method-Rate-Limit-Count: 1:10
+
+The RateLimitScheduler keeps one bucket per window and hands out request slots
+ahead of time, so requests wait locally instead of running into 429 errors.
+It implements the RateLimiter interface of RiotWatcher and can be passed to
+LolWatcher(api_key, rate_limiter=scheduler). Asynchronous code can use
+reserve() and record_response() directly.
+
+call_with_retries() repeats a single failed request with jittered exponential
+backoff, so a transient error no longer throws away the requests that already
+succeeded.
+
+Both take an optional Telemetry (telemetry.py) to record the wait time per
+method, the latency and status of every attempt, retries and backoff time.
+'''
+
+import bisect
+import datetime
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from riotwatcher import ApiError
+from riotwatcher.RateLimiter import RateLimiter
+
+from telemetry import endpoint_name
+
+
+# Status codes worth repeating a request for
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimitBucket:
+    '''Token bucket for one rate limit window.
+
+    Every request takes one of the `limit` tokens and the token returns to the
+    bucket `window` seconds after the request was sent. Unlike a bucket with a
+    constant refill rate this never allows more than `limit` requests in any
+    window, regardless of how the window is aligned on the server side.
+    '''
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.grants = deque()
+
+    def prune(self, now):
+        while self.grants and self.grants[0] <= now - self.window:
+            self.grants.popleft()
+
+    def next_free(self, earliest, margin=0):
+        '''Returns the earliest time >= earliest at which a token is available'''
+        limit = max(1, self.limit - margin)
+        if len(self.grants) < limit:
+            return earliest
+        return max(earliest, self.grants[-limit] + self.window)
+
+    def take(self, at):
+        bisect.insort(self.grants, at)
+
+    def sync(self, count, now):
+        '''Adds the requests the server counted but we didn't (e.g. other processes using the same key)'''
+        self.prune(now)
+        used = sum(1 for grant in self.grants if grant <= now)
+        for _ in range(count - used):
+            self.take(now)
+
+
+class RateLimitScheduler(RateLimiter):
+    # Limits of a development API key, used until the first response reports the real limits
+    DEFAULT_APP_LIMITS = [(20, 1), (100, 120)]
+
+    def __init__(self, app_limits=None, margin=1, debug=False, telemetry=None):
+        self.DEFAULT_LIMITS = app_limits or self.DEFAULT_APP_LIMITS
+        # Number of tokens per bucket kept in reserve for requests in flight
+        self.MARGIN = margin
+        self.DEBUG = debug
+        self.telemetry = telemetry
+        self.app_buckets = {}
+        self.method_buckets = {}
+        self.blocked_until = {}
+        self.last_slot = {}
+        self.total_wait = 0.0
+        self._lock = threading.Lock()
+
+    def _buckets(self, region, method):
+        if region not in self.app_buckets:
+            self.app_buckets[region] = [RateLimitBucket(limit, window) for limit, window in self.DEFAULT_LIMITS]
+        return self.app_buckets[region] + self.method_buckets.get((region, method), [])
+
+    def reserve(self, region, method):
+        '''Reserves a request slot and returns the unix time at which the request may be sent.
+
+        Slots of one routing value are handed out in order, which keeps every
+        bucket sorted and makes the reservation O(number of windows).
+        '''
+        with self._lock:
+            now = time.time()
+            slot = max(now, self.last_slot.get(region, 0), self.blocked_until.get(region, 0), self.blocked_until.get((region, method), 0))
+            buckets = self._buckets(region, method)
+            for bucket in buckets:
+                bucket.prune(now)
+                slot = bucket.next_free(slot, self.MARGIN)
+            for bucket in buckets:
+                bucket.take(slot)
+            self.last_slot[region] = slot
+            self.total_wait += slot - now
+        if self.telemetry is not None:
+            self.telemetry.rate_limit_wait(slot - now, method)
+        return slot
+
+    def reserve_delay(self, region, method):
+        '''Reserves a request slot and returns the seconds to wait before sending the request'''
+        return max(0.0, self.reserve(region, method) - time.time())
+
+    def record_response(self, region, endpoint_name, method_name, status, headers):
+        '''Updates the buckets of a routing value from the rate limit headers of a response'''
+        method = f'{endpoint_name}.{method_name}' if endpoint_name else method_name
+        with self._lock:
+            now = time.time()
+            if 'X-App-Rate-Limit' in headers:
+                self.app_buckets[region] = self._update_buckets(self.app_buckets.get(region, []), headers['X-App-Rate-Limit'], headers.get('X-App-Rate-Limit-Count'), now)
+            if 'X-Method-Rate-Limit' in headers:
+                self.method_buckets[(region, method)] = self._update_buckets(self.method_buckets.get((region, method), []), headers['X-Method-Rate-Limit'], headers.get('X-Method-Rate-Limit-Count'), now)
+            if status == 429 and 'Retry-After' in headers:
+                # a method limit only blocks this method, everything else blocks the whole routing value
+                key = (region, method) if headers.get('X-Rate-Limit-Type') == 'method' else region
+                self.blocked_until[key] = max(self.blocked_until.get(key, 0), now + float(headers['Retry-After']))
+                if self.telemetry is not None: self.telemetry.inc('rate_limit_exceeded_total', type=headers.get('X-Rate-Limit-Type', 'application'))
+                if self.DEBUG: print(f'[{region}] Rate limit exceeded, blocking {key} for {headers["Retry-After"]} sec')
+
+    def _update_buckets(self, buckets, limits_header, counts_header, now):
+        '''Returns the buckets for the windows of a limits header, reusing known buckets'''
+        known = {bucket.window: bucket for bucket in buckets}
+        counts = dict((int(window), int(count)) for count, window in self.parse_header(counts_header or ''))
+        updated = []
+        for limit, window in self.parse_header(limits_header):
+            bucket = known.get(window) or RateLimitBucket(limit, window)
+            bucket.limit = limit
+            if window in counts:
+                bucket.sync(counts[window], now)
+            updated.append(bucket)
+        return updated
+
+    @staticmethod
+    def parse_header(value):
+        '''Parses a header like "20:1,100:120" into [(20, 1), (100, 120)]'''
+        return [tuple(int(number) for number in pair.split(':')) for pair in value.split(',') if ':' in pair]
+
+    def wait_until(self, region, endpoint_name, method_name):
+        '''Called by RiotWatcher before every request'''
+        slot = self.reserve(region, f'{endpoint_name}.{method_name}')
+        return datetime.datetime.fromtimestamp(slot) if slot > time.time() else None
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    '''Exponential backoff with full jitter'''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def call_with_retries(func, *args, max_retries=5, on_error=None, telemetry=None, **kwargs):
+    '''Calls func(*args, **kwargs) and repeats only this request on transient errors.
+
+    429 responses carrying a Retry-After header are not delayed here, the
+    RateLimitScheduler already holds back the next slot. Errors that are not
+    worth repeating (e.g. 404) and errors after max_retries are raised.
+    '''
+    endpoint = endpoint_name(func) if telemetry is not None else None
+    attempt = 0
+    while True:
+        if telemetry is not None:
+            start, wait_before = time.perf_counter(), telemetry.thread_wait()
+        try:
+            result = func(*args, **kwargs)
+            if telemetry is not None:
+                telemetry.record_request(endpoint, 200, _latency(telemetry, start, wait_before))
+            return result
+        except ApiError as err:
+            status = err.response.status_code if err.response is not None else None
+            if telemetry is not None:
+                telemetry.record_request(endpoint, status, _latency(telemetry, start, wait_before))
+            if on_error is not None: on_error(err)
+            if status not in RETRYABLE_STATUS_CODES or attempt >= max_retries:
+                raise
+            if status != 429 or 'Retry-After' not in err.response.headers:
+                _backoff(attempt, telemetry, endpoint)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if telemetry is not None:
+                telemetry.record_request(endpoint, type(err).__name__, _latency(telemetry, start, wait_before))
+            if attempt >= max_retries:
+                raise
+            _backoff(attempt, telemetry, endpoint)
+        if telemetry is not None: telemetry.inc('api_retries_total', endpoint=endpoint)
+        attempt += 1
+
+
+def _latency(telemetry, start, wait_before):
+    '''Seconds since start without the time the request was held back by the rate limiter'''
+    return time.perf_counter() - start - (telemetry.thread_wait() - wait_before)
+
+
+def _backoff(attempt, telemetry, endpoint):
+    delay = backoff_delay(attempt)
+    if telemetry is not None: telemetry.inc('api_backoff_seconds_total', delay, endpoint=endpoint)
+    time.sleep(delay)
@@ -63,36 +63,155 @@ summoner_9_streak;summoner_9_consistency;summoner_9_champMastery;
 summoner_10_winrate;summoner_10_champ_winrate;summoner_10_avgKda;
 summoner_10_champ_avgKda;summoner_10_streak;summoner_10_consistency;
 summoner_10_champMastery;win
+
+The file is processed as a stream of fixed-size chunks, so the memory usage
+doesn't depend on the size of the input. All values are passed through as
+text, only 'id' and 'win' are rewritten with vectorized operations. The team
+rows are emitted in input order (A before B of every game). With --sort the
+rows are sorted by id like earlier versions of this script did, using sorted
+runs on disk that are merged at the end. With --workers the chunks are
+processed in parallel, a bounded number of chunks is in flight at a time.
+
+Games with an 'ERR' outcome are dropped.
+
+Outputs of a LeagueAnalyzer with additional feature windows carry suffixed
+columns like summoner_1_winrate_d10_a7 (last 10 games of the last 7 days).
+They are passed through, or with --window d10_a7 only that window is written
+under the usual column names, a dataset of its own for train.py.
+
+Usage:
+    python separate_teams_and_outcomes.py [input.csv] [new.csv] [--chunksize 50000] [--workers 4] [--sort] [--window d10_a7]
 '''
 
+import os
+import heapq
+import argparse
+import tempfile
+import multiprocessing
+from collections import deque
+
+import numpy as np
 import pandas as pd
 
+from dataset_writer import is_window_column
+
 FILENAME = 'input.csv'
+OUTPUT_FILENAME = 'new.csv'
+CHUNKSIZE = 50000
+
+
+def team_columns(columns):
+    '''Returns the columns of team A and team B of the input, each followed by id and win'''
+    team_a_cols = [col for col in columns if "summoner_" in col and int(col.split('_')[1]) <= 5] + ['id', 'win']
+    team_b_cols = [col for col in columns if "summoner_" in col and int(col.split('_')[1]) > 5] + ['id', 'win']
+    return team_a_cols, team_b_cols
+
+
+def window_columns(columns, window):
+    '''Returns the input columns and their output names for a feature window (None: all columns unchanged).
+    Every column of the window replaces its unsuffixed column, the columns of other windows are dropped.'''
+    if window is None:
+        return list(columns), list(columns)
+    if not any(column.endswith(f'_{window}') for column in columns):
+        raise ValueError(f'The input has no columns of the feature window {window}')
+    names = [column for column in columns if not is_window_column(column)]
+    return [f'{name}_{window}' if f'{name}_{window}' in columns else name for name in names], names
+
+
+def separate_chunk(df, window=None):
+    '''Splits a chunk of games into rows of team A and team B in input order'''
+    sources, names = window_columns(df.columns, window)
+    df = df[sources].set_axis(names, axis=1)
+    df = df[df['win'] != 'ERR']
+    team_a_cols, team_b_cols = team_columns(df.columns)
+    team_a = df[team_a_cols].to_numpy(dtype=object)
+    team_b = df[team_b_cols].to_numpy(dtype=object)
+
+    # win == 0: Team A wins, win == 1: Team B wins
+    team_a[:, -2] = df['id'].to_numpy(dtype=object) + '_A'
+    team_a[:, -1] = np.where(df['win'].to_numpy() == '0', '1', '0')
+    team_b[:, -2] = df['id'].to_numpy(dtype=object) + '_B'
+    team_b[:, -1] = np.where(df['win'].to_numpy() == '1', '1', '0')
+
+    rows = np.empty((2 * len(df), len(team_a_cols)), dtype=object)
+    rows[0::2] = team_a
+    rows[1::2] = team_b
+    return pd.DataFrame(rows, columns=team_a_cols)
+
+
+def process_chunk(df, sort=False, window=None):
+    '''Returns the csv text (without header) of a separated chunk'''
+    result = separate_chunk(df, window)
+    if sort:
+        result = result.sort_values(by='id')
+    return result.to_csv(index=False, header=False, sep=';')
+
+
+def read_chunks(filename, chunksize):
+    # everything is read as text so the values are written back unchanged
+    return pd.read_csv(filename, delimiter=';', dtype=str, chunksize=chunksize)
+
+
+def processed_chunks(filename, chunksize, workers, sort, window=None):
+    '''Yields the csv text of every chunk in input order, processed by `workers` processes'''
+    if workers <= 1:
+        for chunk in read_chunks(filename, chunksize):
+            yield process_chunk(chunk, sort, window)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for chunk in read_chunks(filename, chunksize):
+            pending.append(pool.apply_async(process_chunk, (chunk, sort, window)))
+            # bound the number of chunks in memory
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
 
-df = pd.read_csv(FILENAME, delimiter=';')
 
-# Filter out rows with 'ERR' in 'win'
-df = df[df['win'] != 'ERR']
+def header_of(filename, window=None):
+    with open(filename) as f:
+        columns = f.readline().rstrip('\r\n').split(';')
+    team_a_cols, _ = team_columns(window_columns(columns, window)[1])
+    return team_a_cols
 
-# Split into Team A and Team B
-team_a_cols = [col for col in df.columns if "summoner_" in col and int(col.split('_')[1]) <= 5] + ['id', 'win']
-team_b_cols = [col for col in df.columns if "summoner_" in col and int(col.split('_')[1]) > 5] + ['id', 'win']
 
-team_a = df[team_a_cols]
-team_b = df[team_b_cols]
+def merge_runs(run_files, out, id_column):
+    '''Merges sorted runs of csv lines by id'''
+    runs = [open(run_file) for run_file in run_files]
+    try:
+        for line in heapq.merge(*runs, key=lambda line: line.split(';')[id_column]):
+            out.write(line)
+    finally:
+        for run in runs:
+            run.close()
 
-# Adjust 'id' and 'win' columns for each team
-team_a['id'] = team_a['id'] + "_A"
-team_a['win'] = team_a['win'].apply(lambda x: 1 if x == 0 else 0)
-team_b['id'] = team_b['id'] + "_B"
-team_b['win'] = team_b['win'].apply(lambda x: 1 if x == 1 else 0)
 
-# Rename columns for team_b to match team_a
-rename_dict = {col: col.replace(str(int(col.split('_')[1])), str(int(col.split('_')[1])-5)) for col in team_b.columns if 'summoner' in col}
-team_b.rename(columns=rename_dict, inplace=True)
+def separate_teams(filename=FILENAME, outputfile=OUTPUT_FILENAME, chunksize=CHUNKSIZE, workers=1, sort=False, window=None):
+    '''Streams the games of filename into one row per team in outputfile'''
+    columns = header_of(filename, window)
+    with open(outputfile, 'w', newline='') as out:
+        out.write(';'.join(columns) + '\n')
+        if not sort:
+            for text in processed_chunks(filename, chunksize, workers, sort, window):
+                out.write(text)
+            return
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(outputfile))) as tmpdir:
+            run_files = []
+            for text in processed_chunks(filename, chunksize, workers, sort, window):
+                run_files.append(os.path.join(tmpdir, f'run_{len(run_files)}.csv'))
+                with open(run_files[-1], 'w', newline='') as run:
+                    run.write(text)
+            merge_runs(run_files, out, columns.index('id'))
 
-# Combine dataframes and sort by 'id'
-result = pd.concat([team_a, team_b]).sort_values(by='id')
 
-# Write to new csv file
-result.to_csv('new.csv', index=False, sep=';')
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Splits the games of a LeagueAnalyzer output into one row per team')
+    parser.add_argument('inputfile', nargs='?', default=FILENAME)
+    parser.add_argument('outputfile', nargs='?', default=OUTPUT_FILENAME)
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help='games per chunk')
+    parser.add_argument('--workers', type=int, default=1, help='processes separating chunks in parallel')
+    parser.add_argument('--sort', action='store_true', help='sort the output by id instead of keeping the input order')
+    parser.add_argument('--window', help='only write the columns of this feature window, e.g. d10_a7')
+    args = parser.parse_args()
+    separate_teams(args.inputfile, args.outputfile, args.chunksize, args.workers, args.sort, args.window)
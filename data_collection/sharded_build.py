@@ -0,0 +1,242 @@
+'''
+Builds the training data with several worker processes, each one with its own
+API key, region and rate budget.
+
+A single LeagueAnalyzer is limited by the rate limit of one API key. This
+driver splits the match-id file into one shard per worker and runs the
+workers in parallel processes. Every worker writes its own partial output
+(including the checkpoint, so an interrupted run can be restarted with the
+same arguments). At the end the partials are merged back into the order of
+the input file, so the result doesn't depend on which worker was faster.
+
+Workers are configured in config.ini, one section per worker. Values missing
+in a section are taken from [DEFAULT]:
+
+    [DEFAULT]
+    API_KEY = RGAPI-...
+
+    [worker_1]
+    API_KEY = RGAPI-...
+    REGION = euw1
+
+    [worker_2]
+    API_KEY = RGAPI-...
+    REGION = na1
+
+Match ids are assigned to the workers of their region ('EUW1_123' -> euw1)
+round-robin. Use one worker per API key and region, workers sharing a key
+would also share its rate limit.
+
+Every worker keeps its match cache and mastery cache in its own SQLite files
+next to its partial output (shards/<worker>.*.sqlite), they are reused when
+the run is restarted. The participant store (participants.sqlite) is shared
+by all workers, so matches already known from gather_match_ids.py or the
+crawler aren't downloaded again. It is a WAL database with a busy timeout,
+several processes can write it.
+
+A resumed worker appends the matches it retries after the rows of later
+matches, so the partial outputs are sorted by input position when they are
+merged.
+
+Usage:
+    python sharded_build.py manymatches.txt output.csv
+'''
+
+import os
+import sys
+import csv
+import time
+import heapq
+import configparser
+import multiprocessing
+from queue import Empty
+
+from build_training_data import LeagueAnalyzer
+from dataset_writer import CsvDatasetWriter
+
+
+class ShardWorker(LeagueAnalyzer):
+    '''LeagueAnalyzer that reports every analyzed match to the driver'''
+
+    def __init__(self, name, progress_queue, **kwargs):
+        super().__init__(**kwargs)
+        self.NAME = name
+        self.progress_queue = progress_queue
+
+    def analyze_match(self, match_id):
+        analyzed_match = super().analyze_match(match_id)
+        self.progress_queue.put((self.NAME, match_id, analyzed_match is not None))
+        return analyzed_match
+
+
+def run_worker(name, api_key, region, shard_file, partial_file, progress_queue, config_file, cache_files):
+    analyzer = ShardWorker(name, progress_queue, config_file=config_file, api_key=api_key, server_region=region, debug_level=LeagueAnalyzer.DEBUG_LEVEL_WARNING, **cache_files)
+    analyzer.start_analysis_process(shard_file, partial_file)
+
+
+def load_workers(config_file='config.ini'):
+    '''Returns (name, api_key, region) of every worker configured in config_file'''
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    sections = config.sections() or ['DEFAULT']
+    return [(name, config[name]['API_KEY'], config[name].get('REGION', 'euw1').lower()) for name in sections]
+
+
+def region_of(match_id):
+    '''Returns the platform a match id belongs to, e.g. EUW1_6512345678 -> euw1'''
+    return match_id.split('_', 1)[0].lower()
+
+
+class ShardedBuilder:
+    def __init__(self, config_file='config.ini', workdir='shards', participant_store_file='participants.sqlite'):
+        self.CONFIG_FILE = config_file
+        self.WORKDIR = os.path.abspath(workdir)
+        # shared by all workers (and with gather_match_ids.py), None disables the store
+        self.PARTICIPANT_STORE_FILE = os.path.abspath(participant_store_file) if participant_store_file else None
+        self.workers = load_workers(config_file)
+        self.positions = {}
+
+    def split(self, inputfile):
+        '''Writes one shard file per worker and returns the number of match ids per worker'''
+        os.makedirs(self.WORKDIR, exist_ok=True)
+        workers_by_region = {}
+        for name, _, region in self.workers:
+            workers_by_region.setdefault(region, []).append(name)
+
+        shards = {name: open(self.shard_file(name), 'w') for name, _, _ in self.workers}
+        counts = dict.fromkeys(shards, 0)
+        assigned = {region: 0 for region in workers_by_region}
+        unassigned = 0
+        with open(inputfile) as f:
+            for line in f:
+                match_id = line.strip()
+                if not match_id or match_id in self.positions:
+                    continue
+                self.positions[match_id] = len(self.positions)
+                region = region_of(match_id)
+                if region not in workers_by_region:
+                    unassigned += 1
+                    continue
+                name = workers_by_region[region][assigned[region] % len(workers_by_region[region])]
+                assigned[region] += 1
+                shards[name].write(f'{match_id}\n')
+                counts[name] += 1
+        for shard in shards.values():
+            shard.close()
+        if unassigned:
+            print(f'{unassigned} match ids skipped, no worker configured for their region')
+        return counts
+
+    def shard_file(self, name):
+        return os.path.join(self.WORKDIR, f'{name}.txt')
+
+    def partial_file(self, name):
+        return os.path.join(self.WORKDIR, f'{name}.csv')
+
+    def cache_files(self, name):
+        '''Returns the SQLite files of the caches and stores of a worker as LeagueAnalyzer arguments'''
+        files = {f'{cache}_file': os.path.join(self.WORKDIR, f'{name}.{cache}.sqlite') for cache in ('match_cache', 'mastery_cache')}
+        files['participant_store_file'] = self.PARTICIPANT_STORE_FILE
+        return files
+
+    def run(self, inputfile, outputfile):
+        counts = self.split(inputfile)
+        # matches finished by a previous run are skipped by the workers
+        remaining = {name: counts[name] - len(CsvDatasetWriter(self.partial_file(name)).completed_ids()) for name in counts}
+        progress_queue = multiprocessing.Queue()
+        processes = []
+        for name, api_key, region in self.workers:
+            if remaining[name] <= 0:
+                continue
+            process = multiprocessing.Process(target=run_worker, name=name, args=(name, api_key, region, self.shard_file(name), self.partial_file(name), progress_queue, self.CONFIG_FILE, self.cache_files(name)))
+            process.start()
+            processes.append(process)
+
+        self.show_progress(processes, progress_queue, remaining)
+        failed = [process.name for process in processes if process.exitcode != 0]
+        if failed:
+            print(f'Workers {failed} failed, restart to resume before merging')
+            return False
+        self.merge(outputfile)
+        return True
+
+    def show_progress(self, processes, progress_queue, remaining):
+        '''Prints one status line with progress and throughput of all workers until they are finished'''
+        total = sum(max(0, count) for count in remaining.values())
+        done = dict.fromkeys(remaining, 0)
+        errors = 0
+        start = time.time()
+        last_update = 0
+        while any(process.is_alive() for process in processes) or not progress_queue.empty():
+            try:
+                name, _, success = progress_queue.get(timeout=1)
+                done[name] += 1
+                errors += not success
+            except Empty:
+                pass
+            if time.time() - last_update >= 1:
+                last_update = time.time()
+                finished = sum(done.values())
+                rate = finished / max(last_update - start, 1e-9)
+                eta = (total - finished) / rate if rate > 0 else float('inf')
+                per_worker = ' '.join(f'{name}:{count}' for name, count in done.items())
+                print(f'\r[{finished}/{total}] {rate:.2f} matches/s, {errors} errors, ETA {eta / 60:.0f} min | {per_worker}', end='', flush=True)
+        for process in processes:
+            process.join()
+        print('')
+
+    def merge(self, outputfile):
+        '''Merges the partial outputs in the order of the input file'''
+        base, _ = os.path.splitext(outputfile)
+        names = [name for name, _, _ in self.workers]
+        self.merge_files([self.partial_file(name) for name in names], outputfile)
+        self.merge_files([CsvDatasetWriter(self.partial_file(name)).REJECT_FILENAME for name in names], f'{base}.rejected.csv')
+
+    def merge_files(self, partial_files, outputfile):
+        header = None
+        readers = []
+        # partial file -> match ids that aren't in the input file
+        unknown = {}
+        for partial_file in partial_files:
+            if not os.path.exists(partial_file) or os.path.getsize(partial_file) == 0:
+                continue
+            with open(partial_file, newline='') as f:
+                header = f.readline()
+            readers.append(self.rows_by_position(partial_file, unknown))
+        if header is None:
+            return
+        with open(outputfile, 'w', newline='') as out:
+            out.write(header)
+            for _, line in heapq.merge(*readers):
+                out.write(line)
+        for partial_file, match_ids in unknown.items():
+            print(f'{len(match_ids)} rows of {partial_file} skipped, their match ids (e.g. {match_ids[0]}) are not in the input file. '
+                  f'Is it the partial output of a run with another input file?')
+
+    def rows_by_position(self, partial_file, unknown):
+        '''Yields (input position, raw line) of the rows of a partial output in input order.
+        Only the positions and offsets of the rows are sorted in memory, the lines are read back afterwards.
+        Rows of match ids that aren't in the input file are skipped and collected in unknown.'''
+        with open(partial_file, 'rb') as f:
+            header = f.readline()
+            id_column = next(csv.reader([header.decode()], delimiter=';')).index('id')
+            rows = []
+            offset = len(header)
+            for line in f:
+                match_id = line.split(b';')[id_column].strip().decode()
+                position = self.positions.get(match_id)
+                if position is None:
+                    unknown.setdefault(partial_file, []).append(match_id)
+                else:
+                    rows.append((position, offset, len(line)))
+                offset += len(line)
+            rows.sort()
+            for position, offset, length in rows:
+                f.seek(offset)
+                yield position, f.read(length).decode()
+
+
+if __name__ == '__main__':
+    inputfile = sys.argv[1] if len(sys.argv) > 1 else 'manymatches.txt'
+    outputfile = sys.argv[2] if len(sys.argv) > 2 else f'output_{int(time.time())}.csv'
+    ShardedBuilder().run(inputfile, outputfile)
@@ -0,0 +1,263 @@
+'''
+Structured telemetry for the data collection.
+
+The Telemetry object collects counters and histograms with labels, e.g.
+
+    api_requests_total{endpoint="match.by_id",status="200"}
+    api_request_seconds{endpoint="match.by_id"}          (latency histogram)
+    api_retries_total{endpoint="match.by_id"}
+    api_backoff_seconds_total{endpoint="match.by_id"}
+    rate_limit_wait_seconds{endpoint="match.by_id"}      (histogram)
+    game_stage_seconds{stage="history"}                  (histogram, one value per game)
+
+and the stats() of registered sources like the match and mastery caches,
+which are read only when the metrics are exported.
+
+Recording a value takes a lock and a dict lookup, so the telemetry is meant to
+stay on. The request latency excludes the time the RateLimitScheduler held the
+request back, that time is recorded in rate_limit_wait_seconds instead.
+
+Metrics are exported to a Prometheus textfile (filename ending with .prom,
+replaced atomically for the node exporter's textfile collector) or appended as
+JSON lines. JSON lines files also receive one line per game (or window of
+games) with the timings of its stages.
+
+Usage:
+    telemetry = Telemetry('metrics.prom')
+    telemetry.register('match_cache', match_cache.stats)
+    with telemetry.timed('api_request_seconds', endpoint='match.by_id'):
+        ...
+    stages = StageTimer()
+    with stages('history'):
+        ...
+    telemetry.record_stages('game', match_id, stages)
+    telemetry.export()
+'''
+
+import os
+import re
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def endpoint_name(func):
+    '''Returns 'match.by_id' for lol_watcher.match.by_id, named like the methods seen by the RateLimitScheduler'''
+    owner = getattr(func, '__self__', None)
+    if owner is None:
+        return getattr(func, '__name__', str(func))
+    api = re.sub(r'Api(V\d+)?$', '', type(owner).__name__)
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', api).lower() + '.' + func.__name__
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last count holds the values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        '''Returns the upper bound of the bucket holding the q-quantile'''
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': round(self.sum, 6), 'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts))}
+
+
+class StageTimer:
+    '''Sums up the time spent in the stages of one game or window of games'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+class Telemetry:
+    # Metric names are prefixed with this in the Prometheus textfile
+    PREFIX = 'lop_'
+
+    def __init__(self, filename=None, export_interval=15, buckets=LATENCY_BUCKETS):
+        # None only collects the metrics, export() is a no-op then
+        self.FILENAME = filename
+        self.EXPORT_INTERVAL = export_interval
+        self.BUCKETS = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.sources = {}
+        self._events = []
+        self._last_export = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        '''Adds value to the counter name{labels}'''
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        '''Adds a value to the histogram name{labels}'''
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.BUCKETS)
+            histogram.observe(value)
+
+    def histogram(self, name, **labels):
+        '''Returns the histogram name{labels}, None if nothing was observed yet'''
+        with self._lock:
+            return self.histograms.get(self._key(name, labels))
+
+    @contextmanager
+    def timed(self, name, **labels):
+        '''Observes the seconds spent in the with block'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def rate_limit_wait(self, seconds, endpoint):
+        '''Records the time a request is held back by the rate limiter, also summed up per thread'''
+        self.observe('rate_limit_wait_seconds', seconds, endpoint=endpoint)
+        self._local.wait = self.thread_wait() + seconds
+
+    def thread_wait(self):
+        '''Returns the rate limit wait of all requests of the calling thread so far'''
+        return getattr(self._local, 'wait', 0.0)
+
+    def record_request(self, endpoint, status, seconds):
+        '''Records one attempt of an API request, status is the HTTP status or the name of the exception'''
+        self.inc('api_requests_total', endpoint=endpoint, status=status)
+        self.observe('api_request_seconds', seconds, endpoint=endpoint)
+
+    def record_stages(self, kind, key, stages, **fields):
+        '''Records the stage timings of a game or window, e.g. game_stage_seconds{stage="history"}'''
+        elapsed = stages.elapsed()
+        self.observe(f'{kind}_seconds', elapsed)
+        for stage, seconds in stages.stages.items():
+            self.observe(f'{kind}_stage_seconds', seconds, stage=stage)
+        if self.FILENAME is not None and not self.FILENAME.endswith('.prom'):
+            event = {'type': kind, 'id': key, 'time': round(time.time(), 3), 'seconds': round(elapsed, 6),
+                     'stages': {stage: round(seconds, 6) for stage, seconds in stages.stages.items()}}
+            event.update(fields)
+            with self._lock:
+                self._events.append(event)
+
+    def register(self, name, stats):
+        '''Exports the numeric values of the dict returned by stats() as gauges name_<key>'''
+        self.sources[name] = stats
+
+    def gauges(self):
+        values = {}
+        for name, stats in list(self.sources.items()):
+            for key, value in stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f'{name}_{key}'] = value
+        return values
+
+    def snapshot(self):
+        '''Returns all metrics as a json serializable dict'''
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())]
+            histograms = [dict(name=name, labels=dict(labels), **histogram.snapshot()) for (name, labels), histogram in sorted(self.histograms.items())]
+        return {'counters': counters, 'histograms': histograms, 'gauges': self.gauges()}
+
+    def maybe_export(self):
+        '''Exports if the last export is more than export_interval seconds ago'''
+        if time.time() - self._last_export >= self.EXPORT_INTERVAL:
+            self.export()
+
+    def export(self):
+        '''Writes the metrics to the Prometheus textfile or appends them to the JSON lines file'''
+        self._last_export = time.time()
+        if self.FILENAME is None:
+            return
+        if self.FILENAME.endswith('.prom'):
+            self.write_prometheus(self.FILENAME)
+        else:
+            self.write_json_lines(self.FILENAME)
+
+    def write_json_lines(self, filename):
+        with self._lock:
+            events, self._events = self._events, []
+        with open(filename, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+            f.write(json.dumps(dict(type='metrics', time=round(time.time(), 3), **self.snapshot())) + '\n')
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{value}"' for label, value in pairs) + '}'
+
+    def prometheus_text(self):
+        '''Returns the metrics in the Prometheus text format'''
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (histogram.counts[:], histogram.sum, histogram.count)) for key, histogram in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {self.PREFIX}{name} counter')
+            lines.append(f'{self.PREFIX}{name}{self._labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {self.PREFIX}{name} histogram')
+            cumulative = 0
+            for bound, bucket_count in zip([str(bound) for bound in self.BUCKETS] + ['+Inf'], counts):
+                cumulative += bucket_count
+                lines.append(f'{self.PREFIX}{name}_bucket{self._labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.PREFIX}{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{self.PREFIX}{name}_count{self._labels(labels)} {count}')
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f'# TYPE {self.PREFIX}{name} gauge')
+            lines.append(f'{self.PREFIX}{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        '''Writes the metrics in the Prometheus text format, the file is replaced atomically'''
+        temporary = f'{filename}.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary, filename)
@@ -1 +1,356 @@
-# Follows soon
+'''
+Predicts the outcome of a game during champ-select.
+
+The ChampSelectPredictor is a long-running process that keeps the model, the
+caches of the LeagueAnalyzer and the recent histories of the players of open
+lobbies in memory. Champ-select takes seconds, so the work is split in two:
+
+1. as soon as the lobby forms, the matchlists, the past matches and the
+   mastery lists of the 5 allied summoners are prefetched in the background
+2. once the picks are locked, only the features of the picked champions are
+   computed from the prefetched histories (the same get_performance() the
+   LeagueAnalyzer uses for the training data) and the model is evaluated
+
+The predictor is served over a local HTTP endpoint:
+
+    POST /lobby     {"puuids": [5 puuids]}                        -> 202, starts the prefetch
+    POST /predict   {"puuids": [...], "champions": [5 champ ids]} -> features and win probability
+    POST /what-if   {"puuids": [...], "champions": [champ id or null], "candidates": {"position": [champ ids]}}
+                    -> win probability of every combination of the candidate picks
+    GET  /metrics   Prometheus text of the telemetry, including the prediction latency
+    GET  /health    p50/p99 latency of the predictions against the target
+
+The model is a pickled classifier with predict_proba() trained on the team
+rows of separate_teams_and_outcomes.py (summoner_1_winrate ... summoner_5_champMastery,
+win = 1 if the team won), or the compiled model artifact directory written
+by train.py (model_artifact.py), which loads in milliseconds and only needs
+numpy. Without a model only the features are returned.
+Like in the training data, teams with 'EMPTY' summoners get no probability.
+
+What-if scoring (score_picks()) answers how the win probability changes with
+the picks of the players that are still picking, or with a different pick of
+your own. The history of every player is reduced to its padded arrays once,
+the champion-specific features of all candidate champions are computed in one
+vectorized call (batch_features.py, identical to get_collected_info_by_champ())
+and all team variants are scored with a single predict_proba() call.
+
+Usage:
+    python prediction.py --port 8765 --model model
+'''
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_collection'))
+# models trained by train.py are pickled boosting.TreeEnsemble objects
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'training_and_validation'))
+
+import numpy as np
+from riotwatcher import ApiError
+
+from batch_features import batch_features, pad_histories
+from build_training_data import LeagueAnalyzer
+from model_artifact import CompiledModel
+
+
+def load_model(filename):
+    '''Loads a compiled model artifact directory or a pickled classifier with predict_proba(), None if no filename is given'''
+    if filename is None:
+        return None
+    if os.path.isdir(filename):
+        return CompiledModel.load(filename)
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+class PlayerHistory:
+    '''Everything about a summoner that doesn't depend on the champion, fetched once per lobby'''
+
+    def __init__(self, puuid, summoner_id, details, masteries, as_of):
+        self.puuid = puuid
+        self.summoner_id = summoner_id
+        # [{'champ', 'kda', 'win'}] of the recent matches, newest first
+        self.details = details
+        # champion id -> mastery points, champions without mastery are missing
+        self.masteries = masteries
+        self.as_of = as_of
+
+
+class ChampSelectPredictor:
+    TEAM_SIZE = 5
+    # Upper limit of the team variants scored by one what-if request
+    MAX_VARIANTS = 100000
+
+    def __init__(self, analyzer=None, model=None, history_ttl_minutes=20, workers=16, p99_target_ms=250):
+        self.analyzer = analyzer if analyzer is not None else LeagueAnalyzer(debug_level=LeagueAnalyzer.DEBUG_LEVEL_WARNING)
+        self.telemetry = self.analyzer.telemetry
+        self.model = model
+        # models trained by train.py know their columns, a different order would silently mix up the features
+        columns = [f'summoner_{summoner}_{attribute}' for summoner in range(1, self.TEAM_SIZE + 1) for attribute in self.analyzer.PLAYER_ATTRIBUTES]
+        if getattr(model, 'columns', None) is not None and list(model.columns) != columns:
+            raise ValueError(f'The model expects the columns {model.columns}, the predictor computes {columns}')
+        # prefetched histories are reused by later lobbies until they are older than this
+        self.HISTORY_TTL = history_ttl_minutes * 60
+        self.P99_TARGET = p99_target_ms / 1000
+        self.executor = ThreadPoolExecutor(workers)
+        self._lock = threading.Lock()
+        # puuid -> future of the PlayerHistory
+        self.histories = {}
+
+    def prefetch(self, puuids):
+        '''Starts fetching the histories of the players of a lobby and returns immediately'''
+        return [self._history_future(puuid) for puuid in puuids]
+
+    def _history_future(self, puuid):
+        now = time.time()
+        with self._lock:
+            future = self.histories.get(puuid)
+            expired = future is not None and future.done() and (future.exception() is not None or now - future.result().as_of > self.HISTORY_TTL)
+            if future is None or expired:
+                future = self.histories[puuid] = self.executor.submit(self.fetch_history, puuid, int(now))
+                self.telemetry.inc('prediction_prefetches_total')
+            else:
+                self.telemetry.inc('prediction_prefetch_hits_total')
+            return future
+
+    def fetch_history(self, puuid, as_of):
+        '''Fetches matchlist, past matches and mastery list of a summoner as of now'''
+        analyzer = self.analyzer
+        with self.telemetry.timed('prediction_prefetch_seconds'):
+            summoner_id = analyzer.call_api(analyzer.lol_watcher.summoner.by_puuid, analyzer.SERVER_REGION, puuid)['id']
+            # the look-back window of the training features, counted from the request and not from the start of the service
+            past_match_ids = analyzer.get_past_match_ids(puuid, [], as_of, analyzer.age_cutoff(analyzer.MAX_AGE_DAYS, as_of))
+            details = analyzer.get_details_by_matchlist(past_match_ids, puuid)
+            masteries = analyzer.call_api(analyzer.lol_watcher.champion_mastery.by_summoner, analyzer.SERVER_REGION, summoner_id)
+            if analyzer.mastery_cache is not None:
+                analyzer.mastery_cache.put_list(summoner_id, masteries)
+        return PlayerHistory(puuid, summoner_id, details, {mastery['championId']: mastery['championPoints'] for mastery in masteries}, as_of)
+
+    def summoner_features(self, history, champ_id):
+        '''Returns the PLAYER_ATTRIBUTES of a summoner on a champion, like LeagueAnalyzer.analyze_summoner()'''
+        features = self.analyzer.get_performance(history.details, champ_id)
+        # the mastery list leaves out champions that were never played
+        features['champMastery'] = history.masteries.get(champ_id, 0)
+        return features
+
+    def team_row(self, summoners):
+        '''Returns the feature row of a team in the column order of separate_teams_and_outcomes.py'''
+        return [summoner[attribute] for summoner in summoners for attribute in self.analyzer.PLAYER_ATTRIBUTES]
+
+    def predict(self, puuids, champ_ids, timeout=30):
+        '''Returns the features of the team and its win probability (None without model or with EMPTY summoners)'''
+        if len(puuids) != self.TEAM_SIZE or len(champ_ids) != self.TEAM_SIZE:
+            raise ValueError(f'Expected {self.TEAM_SIZE} puuids and champions')
+        start = time.perf_counter()
+        futures = self.prefetch(puuids)
+        # waiting for a prefetch that is still running counts into the latency
+        histories = [future.result(timeout) for future in futures]
+        with self.telemetry.timed('prediction_features_seconds'):
+            summoners = [self.summoner_features(history, champ_id) for history, champ_id in zip(histories, champ_ids)]
+            row = self.team_row(summoners)
+        probability = None
+        if self.model is not None and 'EMPTY' not in row:
+            with self.telemetry.timed('prediction_model_seconds'):
+                probability = float(self.model.predict_proba([row])[0][1])
+        seconds = time.perf_counter() - start
+        self.telemetry.observe('prediction_seconds', seconds)
+        return {'win_probability': probability, 'features': summoners, 'latency_ms': round(seconds * 1000, 3)}
+
+    def candidate_features(self, history, champ_ids):
+        '''Returns the PLAYER_ATTRIBUTES of a summoner on every champion of champ_ids as a
+        [champions, attributes] float matrix, None if the summoner has no past matches'''
+        if not history.details:
+            return None
+        champs, kdas, wins, lengths = pad_histories([history.details])
+        repeat = np.zeros(len(champ_ids), dtype=np.int64)
+        masteries = [history.masteries.get(champ_id, 0) for champ_id in champ_ids]
+        features = batch_features(champs[repeat], kdas[repeat], wins[repeat], lengths[repeat], champ_ids, masteries)
+        return np.column_stack([features[attribute].astype(np.float64) for attribute in self.analyzer.PLAYER_ATTRIBUTES])
+
+    def champion_pool(self, history, size):
+        '''Returns the size champions a summoner has the most mastery on, plus the champions of the recent matches'''
+        pool = sorted(history.masteries, key=lambda champ_id: -history.masteries[champ_id])[:size]
+        return pool + [match['champ'] for match in history.details if match['champ'] not in pool]
+
+    def score_picks(self, puuids, champ_ids, candidates=None, pool_size=10, timeout=30):
+        '''Scores every combination of candidate picks of a team in one model call.
+
+        Args:
+            puuids (list): the 5 puuids of the team.
+            champ_ids (list): the locked champion of every position, None for players still picking.
+            candidates (dict, optional): position (0-4) -> champion ids to try there. Positions
+                without candidates keep their locked champion, players still picking try the
+                pool_size champions they have the most mastery on.
+
+        Returns:
+            dict: 'variants', a list of {'champions', 'win_probability'} sorted by the
+            probability (None without model or with EMPTY summoners), best first.
+        '''
+        if len(puuids) != self.TEAM_SIZE or len(champ_ids) != self.TEAM_SIZE:
+            raise ValueError(f'Expected {self.TEAM_SIZE} puuids and champions')
+        start = time.perf_counter()
+        histories = [future.result(timeout) for future in self.prefetch(puuids)]
+        candidates = candidates or {}
+        options = []
+        for position, (history, champ_id) in enumerate(zip(histories, champ_ids)):
+            if position in candidates:
+                options.append([int(candidate) for candidate in candidates[position]])
+            elif champ_id is not None:
+                options.append([int(champ_id)])
+            else:
+                options.append(self.champion_pool(history, pool_size))
+        if any(not champions for champions in options):
+            raise ValueError('Every position needs at least one candidate champion')
+        total = int(np.prod([len(champions) for champions in options]))
+        if total > self.MAX_VARIANTS:
+            raise ValueError(f'{total} team variants, at most {self.MAX_VARIANTS} are allowed')
+
+        with self.telemetry.timed('prediction_what_if_features_seconds'):
+            features = [self.candidate_features(history, champions) for history, champions in zip(histories, options)]
+            # index of the candidate of every position in every variant
+            variants = np.array(list(itertools.product(*(range(len(champions)) for champions in options))), dtype=np.int64).reshape(total, self.TEAM_SIZE)
+        probabilities = [None] * total
+        if self.model is not None and all(matrix is not None for matrix in features):
+            rows = np.hstack([matrix[variants[:, position]] for position, matrix in enumerate(features)])
+            with self.telemetry.timed('prediction_model_seconds'):
+                probabilities = self.model.predict_proba(rows)[:, 1].tolist()
+        scored = [{'champions': [options[position][index] for position, index in enumerate(variant)], 'win_probability': probability}
+                  for variant, probability in zip(variants.tolist(), probabilities)]
+        scored.sort(key=lambda variant: -(variant['win_probability'] or 0))
+        seconds = time.perf_counter() - start
+        self.telemetry.observe('prediction_what_if_seconds', seconds)
+        self.telemetry.inc('prediction_what_if_variants_total', total)
+        return {'variants': scored, 'latency_ms': round(seconds * 1000, 3)}
+
+    def health(self):
+        '''Returns the latency percentiles of the predictions so far and whether the p99 target is met'''
+        histogram = self.telemetry.histogram('prediction_seconds')
+        if histogram is None:
+            return {'predictions': 0, 'p99_target_ms': self.P99_TARGET * 1000}
+        p99 = histogram.quantile(0.99)
+        return {'predictions': histogram.count, 'p50_ms': histogram.quantile(0.5) * 1000, 'p99_ms': p99 * 1000,
+                'p99_target_ms': self.P99_TARGET * 1000, 'p99_target_met': p99 <= self.P99_TARGET,
+                'cached_histories': len(self.histories)}
+
+    def evict_expired(self):
+        '''Drops the histories that are older than the TTL'''
+        now = time.time()
+        with self._lock:
+            for puuid, future in list(self.histories.items()):
+                if future.done() and (future.exception() is not None or now - future.result().as_of > self.HISTORY_TTL):
+                    del self.histories[puuid]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, predictor, host='127.0.0.1', port=8765):
+        self.predictor = predictor
+        super().__init__((host, port), PredictionHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, with Nagle's algorithm every reused connection waits for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        predictor = self.server.predictor
+        if self.path == '/health':
+            self.send_json(200, predictor.health())
+        elif self.path == '/metrics':
+            body = predictor.telemetry.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        predictor = self.server.predictor
+        try:
+            request = self.read_json()
+            if self.path == '/lobby':
+                predictor.prefetch(request['puuids'])
+                self.send_json(202, {'prefetching': len(request['puuids'])})
+            elif self.path == '/predict':
+                self.send_json(200, predictor.predict(request['puuids'], [int(champ) for champ in request['champions']]))
+            elif self.path == '/what-if':
+                candidates = {int(position): champions for position, champions in request.get('candidates', {}).items()}
+                champions = [int(champ) if champ is not None else None for champ in request['champions']]
+                self.send_json(200, predictor.score_picks(request['puuids'], champions, candidates, request.get('pool_size', 10)))
+            else:
+                self.send_json(404, {'error': 'not found'})
+        except (KeyError, ValueError) as err:
+            self.send_json(400, {'error': str(err)})
+        except ApiError as err:
+            self.send_json(502, {'error': str(err)})
+        except (TimeoutError, FutureTimeoutError):
+            self.send_json(504, {'error': 'the match histories were not fetched in time'})
+        except Exception as err:
+            # the client always gets a json error instead of a dropped connection
+            self.send_json(500, {'error': f'{type(err).__name__}: {err}'})
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predicts the outcome of a game during champ-select')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--model', help='compiled model artifact directory of train.py or pickled classifier with predict_proba()')
+    parser.add_argument('--region', default='euw1')
+    parser.add_argument('--p99-target-ms', type=float, default=250)
+    args = parser.parse_args()
+
+    analyzer = LeagueAnalyzer(server_region=args.region, debug_level=LeagueAnalyzer.DEBUG_LEVEL_WARNING)
+    predictor = ChampSelectPredictor(analyzer, load_model(args.model), p99_target_ms=args.p99_target_ms)
+    server = PredictionServer(predictor, args.host, args.port)
+    print(f'Serving predictions on {server.url}')
+    threading.Thread(target=evict_periodically, args=(predictor,), daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    predictor.close()
+
+
+def evict_periodically(predictor, interval=60):
+    while True:
+        time.sleep(interval)
+        predictor.evict_expired()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+'''
+Histogram based gradient boosting of decision trees on a binned TeamDataset.
+
+The binned features (bins.u8, see team_dataset.py) are read through np.memmap
+in chunks of CHUNK_ROWS rows by a pool of worker processes. The per-row state
+of the training (prediction, gradient, hessian and the tree node of the row)
+lives in memory-mapped files next to the dataset as well, so the memory use
+depends on the chunk size and the number of workers, not on the number of
+rows.
+
+Every tree is grown level by level. For each level the workers route their
+rows one level down and return the gradient/hessian/count histograms of the
+open nodes for their chunk, the main process sums them up in chunk order and
+finds the best split of every node. Missing values ('EMPTY', bin 0) always go
+left, so a split at bin 0 separates them from the known values.
+
+The result only depends on the seed and the chunk size, not on the number of
+workers: chunks are fixed, their histograms are summed in the same order and
+row sampling draws from a generator seeded with (seed, tree, chunk).
+
+The trained TreeEnsemble works on the raw float features (NaN for missing),
+a drop-in for the sklearn classifiers used by prediction.py.
+
+Usage:
+    booster = HistogramBoosting(trees=300, max_depth=6, workers=8, seed=0)
+    model = booster.fit(dataset)
+    model.predict_proba(X)[:, 1]
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from team_dataset import CHUNK_ROWS, FEATURE_DTYPE, TeamDataset
+
+
+class TreeEnsemble:
+    '''Boosted trees stored as flat node arrays, leaves point to themselves'''
+
+    def __init__(self, columns, base_score, roots, feature, threshold, left, right, value, max_depth, importances=None):
+        self.columns = list(columns)
+        self.base_score = base_score
+        self.roots = roots
+        # feature -1 marks a leaf
+        self.feature = feature
+        # go left if value <= threshold or value is NaN
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.max_depth = max_depth
+        self.importances = importances or {}
+        self.classes_ = np.array([0, 1])
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def decision_function(self, X):
+        '''Returns the log-odds of a win of every row of X'''
+        X = np.asarray(X, dtype=FEATURE_DTYPE)
+        if X.ndim == 1:
+            X = X[None, :]
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.max_depth):
+            values = X[rows, self.feature[nodes]]
+            go_left = np.isnan(values) | (values <= self.threshold[nodes])
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return self.base_score + self.value[nodes].sum(axis=1)
+
+    def predict_proba(self, X):
+        p = 1 / (1 + np.exp(-self.decision_function(X)))
+        return np.column_stack([1 - p, p])
+
+    def predict(self, X):
+        return (self.decision_function(X) > 0).astype(np.int8)
+
+
+# State of a worker process, opened once by _open_state()
+_state = {}
+
+
+def _open_state(dataset_dir, work_dir):
+    dataset = TeamDataset(dataset_dir)
+    shape = (dataset.rows,)
+    _state.update(
+        bins=dataset.bins, y=dataset.y,
+        pred=np.memmap(os.path.join(work_dir, 'pred.f64'), dtype=np.float64, mode='r+', shape=shape),
+        grad=np.memmap(os.path.join(work_dir, 'grad.f32'), dtype=np.float32, mode='r+', shape=shape),
+        hess=np.memmap(os.path.join(work_dir, 'hess.f32'), dtype=np.float32, mode='r+', shape=shape),
+        node=np.memmap(os.path.join(work_dir, 'node.i32'), dtype=np.int32, mode='r+', shape=shape))
+
+
+def _histograms(bins, node, grad, hess, open_nodes, features, n_bins):
+    '''Returns the gradient, hessian and count histograms [open_nodes, features, n_bins, 3] of the rows'''
+    active = node >= 0
+    # one contiguous row per feature is much faster to gather from than the columns of the chunk
+    columns = np.ascontiguousarray(bins[active][:, features].T)
+    offsets = node[active] * n_bins
+    grad, hess = np.asarray(grad[active], dtype=np.float64), np.asarray(hess[active], dtype=np.float64)
+    size = open_nodes * n_bins
+    histogram = np.empty((3, len(features), size))
+    for index in range(len(features)):
+        slots = offsets + columns[index]
+        histogram[0, index] = np.bincount(slots, weights=grad, minlength=size)
+        histogram[1, index] = np.bincount(slots, weights=hess, minlength=size)
+        histogram[2, index] = np.bincount(slots, minlength=size)
+    return histogram.reshape(3, len(features), open_nodes, n_bins).transpose(2, 1, 3, 0)
+
+
+def _sample(start, end, subsample, seed, tree):
+    '''Returns the node of the rows of a chunk at the root of a tree: 0, or -1 if the row is left out'''
+    if subsample >= 1:
+        return np.zeros(end - start, dtype=np.int32)
+    rng = np.random.default_rng([seed, tree, start])
+    return np.where(rng.random(end - start) < subsample, 0, -1).astype(np.int32)
+
+
+def _gradients(start, end, pred):
+    y = np.asarray(_state['y'][start:end], dtype=np.float64)
+    p = 1 / (1 + np.exp(-pred))
+    _state['grad'][start:end] = p - y
+    _state['hess'][start:end] = np.maximum(p * (1 - p), 1e-16)
+    eps = 1e-15
+    loss = -np.sum(y * np.log(np.maximum(p, eps)) + (1 - y) * np.log(np.maximum(1 - p, eps)))
+    return loss, int(np.sum((p > 0.5) == (y == 1)))
+
+
+def _start_tree(args):
+    '''Applies the previous tree (if any) to the chunk, computes the gradients and the root histogram of the next tree'''
+    start, end, tree, previous, features, n_bins, subsample, seed, max_depth, base_score = args
+    bins = np.asarray(_state['bins'][start:end])
+    if previous is None:
+        pred = np.full(end - start, base_score)
+    else:
+        feature, split_bin, left, right, value = previous
+        nodes = np.zeros(end - start, dtype=np.int32)
+        rows = np.arange(end - start)
+        for _ in range(max_depth):
+            go_left = bins[rows, np.maximum(feature[nodes], 0)] <= split_bin[nodes]
+            nodes = np.where(go_left, left[nodes], right[nodes])
+        pred = np.asarray(_state['pred'][start:end]) + value[nodes]
+    _state['pred'][start:end] = pred
+    loss, correct = _gradients(start, end, pred)
+    node = _sample(start, end, subsample, seed, tree)
+    _state['node'][start:end] = node
+    if features is None:
+        return loss, correct, None
+    return loss, correct, _histograms(bins, node, _state['grad'][start:end], _state['hess'][start:end], 1, features, n_bins)
+
+
+def _grow_level(args):
+    '''Routes the rows of the chunk through the splits of the last level and returns the histograms of the new open nodes'''
+    start, end, split_feature, split_bin, children, built, features, n_bins = args
+    bins = np.asarray(_state['bins'][start:end])
+    node = np.asarray(_state['node'][start:end])
+    active = np.flatnonzero(node >= 0)
+    parent = node[active]
+    go_right = bins[active, np.maximum(split_feature[parent], 0)] > split_bin[parent]
+    # children[parent] is the index of the left child among the new open nodes, -1 if the parent became a leaf
+    child = children[parent]
+    node[active] = np.where(child >= 0, child + go_right, -1)
+    _state['node'][start:end] = node
+    # only the histograms of the smaller children are built, built[node] is their index or -1
+    slot = np.where(node >= 0, built[np.maximum(node, 0)], -1)
+    return _histograms(bins, slot, _state['grad'][start:end], _state['hess'][start:end], int(built.max()) + 1, features, n_bins)
+
+
+class HistogramBoosting:
+    def __init__(self, trees=200, max_depth=6, learning_rate=0.1, l2=1.0, min_child_samples=50, colsample=1.0,
+                 subsample=1.0, seed=0, workers=1, chunk_rows=CHUNK_ROWS):
+        self.TREES = trees
+        self.MAX_DEPTH = max_depth
+        self.LEARNING_RATE = learning_rate
+        # L2 regularization of the leaf values
+        self.L2 = l2
+        self.MIN_CHILD_SAMPLES = min_child_samples
+        # Share of the features considered by one tree
+        self.COLSAMPLE = colsample
+        # Share of the rows used to grow one tree
+        self.SUBSAMPLE = subsample
+        self.SEED = seed
+        self.WORKERS = workers
+        # Changing the chunk size changes the summation order and thus the model in the last bits
+        self.CHUNK_ROWS = chunk_rows
+        self.history = []
+
+    def _map(self, pool, func, tasks):
+        '''Yields func(task) in task order'''
+        if pool is None:
+            return map(func, tasks)
+        return pool.imap(func, tasks)
+
+    def _sum(self, results):
+        total = None
+        for result in results:
+            total = result if total is None else total + result
+        return total
+
+    def _best_splits(self, histogram, features):
+        '''Returns feature, bin and gain of the best split of every open node, feature -1 if it can't be split'''
+        cumulative = np.cumsum(histogram, axis=2)
+        total = cumulative[:, :1, -1:, :]
+        left, right = cumulative[:, :, :-1, :], total - cumulative[:, :, :-1, :]
+        l2 = self.L2
+        gain = (left[..., 0] ** 2 / (left[..., 1] + l2) + right[..., 0] ** 2 / (right[..., 1] + l2)
+                - total[..., 0] ** 2 / (total[..., 1] + l2))
+        allowed = (left[..., 2] >= self.MIN_CHILD_SAMPLES) & (right[..., 2] >= self.MIN_CHILD_SAMPLES)
+        gain = np.where(allowed, gain, -np.inf).reshape(len(histogram), -1)
+        best = np.argmax(gain, axis=1)
+        best_gain = gain[np.arange(len(histogram)), best]
+        n_bins = histogram.shape[2] - 1
+        split_feature = np.where(best_gain > 1e-12, np.asarray(features)[best // n_bins], -1).astype(np.int32)
+        return split_feature, (best % n_bins).astype(np.int32), best_gain
+
+    def fit(self, dataset, log=None):
+        '''Trains on a binned TeamDataset (see team_dataset.bin_dataset()) and returns a TreeEnsemble'''
+        edges = dataset.edges()
+        if edges is None:
+            raise ValueError(f'{dataset.DIRNAME} is not binned, call bin_dataset() first')
+        n_features = len(dataset.columns)
+        n_bins = 1 + max(1, max(len(feature_edges) + 1 for feature_edges in edges))
+        chunks = [(start, min(dataset.rows, start + self.CHUNK_ROWS)) for start in range(0, dataset.rows, self.CHUNK_ROWS)]
+        positives = sum(int(np.sum(dataset.y[start:end])) for start, end in chunks)
+        mean = min(max(positives / max(1, dataset.rows), 1e-6), 1 - 1e-6)
+        base_score = float(np.log(mean / (1 - mean)))
+        rng = np.random.default_rng(self.SEED)
+
+        work_dir = tempfile.mkdtemp(prefix='train_', dir=dataset.DIRNAME)
+        for filename, dtype in (('pred.f64', np.float64), ('grad.f32', np.float32), ('hess.f32', np.float32), ('node.i32', np.int32)):
+            np.memmap(os.path.join(work_dir, filename), dtype=dtype, mode='w+', shape=(max(1, dataset.rows),)).flush()
+        pool = None
+        if self.WORKERS > 1:
+            pool = multiprocessing.Pool(self.WORKERS, initializer=_open_state, initargs=(dataset.DIRNAME, work_dir))
+        else:
+            _open_state(dataset.DIRNAME, work_dir)
+
+        trees, importances = [], {}
+        previous = None
+        self.history = []
+        try:
+            for tree in range(self.TREES + 1):
+                start_time = time.perf_counter()
+                if tree < self.TREES:
+                    n_sampled = max(1, int(round(self.COLSAMPLE * n_features)))
+                    features = np.sort(rng.choice(n_features, n_sampled, replace=False)) if n_sampled < n_features else np.arange(n_features)
+                else:
+                    features = None
+                # the pass applying the previous tree also computes the root histogram of the next one
+                tasks = [(start, end, tree, previous, features, n_bins, self.SUBSAMPLE, self.SEED, self.MAX_DEPTH, base_score) for start, end in chunks]
+                loss, correct, histogram = 0.0, 0, None
+                for chunk_loss, chunk_correct, chunk_histogram in self._map(pool, _start_tree, tasks):
+                    loss += chunk_loss
+                    correct += chunk_correct
+                    if chunk_histogram is not None:
+                        histogram = chunk_histogram if histogram is None else histogram + chunk_histogram
+                if tree > 0:
+                    self.history[-1].update(logloss=loss / dataset.rows, accuracy=correct / dataset.rows)
+                    if log is not None:
+                        log(self.history[-1])
+                if features is None:
+                    break
+
+                nodes, tree_importances = self._grow_tree(pool, chunks, histogram, features, n_bins)
+                trees.append(nodes)
+                for feature, gain in tree_importances.items():
+                    importances[feature] = importances.get(feature, 0.0) + gain
+                previous = tuple(np.array([node[key] for node in nodes], dtype=dtype) for key, dtype in
+                                 (('feature', np.int32), ('bin', np.int32), ('left', np.int32), ('right', np.int32), ('value', np.float64)))
+                self.history.append({'tree': tree + 1, 'nodes': len(nodes), 'seconds': time.perf_counter() - start_time})
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _state.clear()
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return self._ensemble(dataset.columns, base_score, trees, edges, importances)
+
+    def _grow_tree(self, pool, chunks, histogram, features, n_bins):
+        '''Grows one tree level by level, returns its nodes and the gain of its splits per feature'''
+        nodes = [None]
+        # tree index of every open node of the current level
+        open_ids = [0]
+        importances = {}
+        for depth in range(self.MAX_DEPTH + 1):
+            sums = histogram[:, 0, :, :].sum(axis=1)
+            values = -sums[:, 0] / (sums[:, 1] + self.L2) * self.LEARNING_RATE
+            if depth < self.MAX_DEPTH:
+                split_feature, split_bin, gain = self._best_splits(histogram, features)
+            else:
+                split_feature = np.full(len(open_ids), -1, dtype=np.int32)
+                split_bin, gain = np.zeros(len(open_ids), dtype=np.int32), np.zeros(len(open_ids))
+            children = np.full(len(open_ids), -1, dtype=np.int32)
+            next_ids, smaller, larger, parents = [], [], [], []
+            for index, node_id in enumerate(open_ids):
+                # leaves point to themselves, inner nodes don't add a value
+                node = {'feature': int(split_feature[index]), 'bin': int(split_bin[index]), 'left': node_id, 'right': node_id, 'value': float(values[index])}
+                if node['feature'] >= 0:
+                    children[index] = len(next_ids)
+                    node['left'], node['right'], node['value'] = len(nodes), len(nodes) + 1, 0.0
+                    nodes.extend([None, None])
+                    next_ids.extend([node['left'], node['right']])
+                    position = np.searchsorted(features, node['feature'])
+                    left_rows = histogram[index, position, :node['bin'] + 1, 2].sum()
+                    small = 0 if 2 * left_rows <= histogram[index, position, :, 2].sum() else 1
+                    smaller.append(children[index] + small)
+                    larger.append(children[index] + 1 - small)
+                    parents.append(index)
+                    importances[node['feature']] = importances.get(node['feature'], 0.0) + float(gain[index])
+                nodes[node_id] = node
+            if not next_ids:
+                break
+            built = np.full(len(next_ids), -1, dtype=np.int32)
+            built[smaller] = np.arange(len(smaller))
+            tasks = [(start, end, split_feature, split_bin, children, built, features, n_bins) for start, end in chunks]
+            small_histogram = self._sum(self._map(pool, _grow_level, tasks))
+            # the larger child is the parent without the smaller one
+            next_histogram = np.empty((len(next_ids),) + histogram.shape[1:])
+            next_histogram[smaller] = small_histogram
+            next_histogram[larger] = histogram[parents] - small_histogram
+            histogram = next_histogram
+            open_ids = next_ids
+        return nodes, importances
+
+    def _ensemble(self, columns, base_score, trees, edges, importances):
+        '''Concatenates the trees and translates the bin splits into thresholds on the raw values'''
+        roots, feature, threshold, left, right, value = [], [], [], [], [], []
+        for nodes in trees:
+            offset = len(feature)
+            roots.append(offset)
+            for node in nodes:
+                feature.append(node['feature'])
+                # bin <= b  <=>  value <= edges[b - 1], bin 0 only holds the missing values
+                if node['feature'] < 0:
+                    threshold.append(np.inf)
+                elif node['bin'] == 0:
+                    threshold.append(-np.inf)
+                else:
+                    threshold.append(edges[node['feature']][node['bin'] - 1])
+                left.append(offset + node['left'])
+                right.append(offset + node['right'])
+                value.append(node['value'])
+        total_gain = sum(importances.values()) or 1.0
+        return TreeEnsemble(columns, base_score, np.array(roots, dtype=np.int32), np.array(feature, dtype=np.int32),
+                            np.array(threshold, dtype=FEATURE_DTYPE), np.array(left, dtype=np.int32), np.array(right, dtype=np.int32),
+                            np.array(value, dtype=np.float64), self.MAX_DEPTH,
+                            {columns[index]: gain / total_gain for index, gain in sorted(importances.items(), key=lambda item: -item[1])})
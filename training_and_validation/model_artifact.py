@@ -0,0 +1,195 @@
+'''
+Compiled model artifact and scoring kernel for the trees of boosting.py.
+
+Unpickling a model needs the modules it was pickled from (and everything they
+import) and every call goes through the generic node arrays of the
+TreeEnsemble. export() compiles the trees into a directory of plain .npy
+arrays and a schema that CompiledModel loads memory-mapped, depending on
+nothing but numpy:
+
+    model/
+        schema.json         format version, model id, column order
+                            (summoner_1_winrate ... summoner_5_champMastery),
+                            depth, base score and the files of the arrays
+        feature.npy         int32 [trees, 2^depth - 1]  feature of every inner node
+        threshold.npy       float32 [trees, 2^depth - 1] go right if value > threshold
+        leaf_value.npy      float64 [trees, 2^depth]    value of every leaf
+
+Every tree is padded to a complete tree of the model depth: the children of
+node i are 2i+1 and 2i+2, and a leaf above the last level becomes an inner
+node with threshold +inf whose descendants all carry its value. Scoring is
+then one gather and one compare per level for all trees and rows at once,
+without any branching. Missing values (NaN) always go left, NaN > x is False.
+
+The predictions are identical to TreeEnsemble.predict_proba().
+
+Usage:
+    export(model, 'model')
+    model = CompiledModel.load('model')
+    model.predict_proba(rows)[:, 1]
+    model.score_team({'summoner_1_winrate': 55, ...})
+'''
+
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import numpy as np
+
+FORMAT = 'lop-trees'
+FORMAT_VERSION = 1
+ARRAYS = {'feature': np.int32, 'threshold': np.float32, 'leaf_value': np.float64}
+# Values written as 'EMPTY' in the datasets
+MISSING = 'EMPTY'
+# Rows scored together, keeps the [rows, trees] index arrays in the CPU cache
+BLOCK_ROWS = 1024
+
+
+def compile_trees(model):
+    '''Returns the feature, threshold and leaf value arrays of the complete trees of a TreeEnsemble'''
+    depth = model.max_depth
+    inner, leaves = 2 ** depth - 1, 2 ** depth
+    feature = np.zeros((model.n_trees, inner), dtype=np.int32)
+    threshold = np.full((model.n_trees, inner), np.inf, dtype=np.float32)
+    leaf_value = np.zeros((model.n_trees, leaves), dtype=np.float64)
+    for tree, root in enumerate(model.roots):
+        # (node of the TreeEnsemble, position in the complete tree, level)
+        stack = [(root, 0, 0)]
+        while stack:
+            node, position, level = stack.pop()
+            if model.feature[node] < 0:
+                # all leaves below the position carry the value
+                first = position
+                for _ in range(depth - level):
+                    first = 2 * first + 1
+                first -= inner
+                leaf_value[tree, first:first + 2 ** (depth - level)] = model.value[node]
+                continue
+            feature[tree, position] = model.feature[node]
+            threshold[tree, position] = model.threshold[node]
+            stack.append((model.left[node], 2 * position + 1, level + 1))
+            stack.append((model.right[node], 2 * position + 2, level + 1))
+    return {'feature': feature, 'threshold': threshold, 'leaf_value': leaf_value}
+
+
+def export(model, dirname, metadata=None):
+    '''Writes a TreeEnsemble as compiled artifact, an existing artifact in dirname is replaced'''
+    arrays = compile_trees(model)
+    digest = hashlib.sha1(json.dumps([model.columns, model.base_score]).encode())
+    for name in ARRAYS:
+        digest.update(arrays[name].tobytes())
+    schema = {
+        'format': FORMAT,
+        'version': FORMAT_VERSION,
+        # identifies the trained model, e.g. to tell which model made a prediction
+        'model_id': digest.hexdigest()[:16],
+        'created': int(time.time()),
+        'columns': model.columns,
+        'trees': model.n_trees,
+        'depth': model.max_depth,
+        'base_score': model.base_score,
+        'arrays': {name: {'file': f'{name}.npy', 'dtype': np.dtype(dtype).name, 'shape': list(arrays[name].shape)} for name, dtype in ARRAYS.items()},
+        'importances': model.importances,
+        'metadata': metadata or {}
+    }
+    temporary = f'{dirname.rstrip(os.sep)}.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    for name, dtype in ARRAYS.items():
+        np.save(os.path.join(temporary, f'{name}.npy'), np.ascontiguousarray(arrays[name], dtype=dtype))
+    with open(os.path.join(temporary, 'schema.json'), 'w') as f:
+        json.dump(schema, f, indent=1)
+    # the old artifact is replaced as a whole, a reader never sees a mix of both
+    previous = f'{dirname.rstrip(os.sep)}.old'
+    if os.path.exists(dirname):
+        shutil.rmtree(previous, ignore_errors=True)
+        os.replace(dirname, previous)
+    os.replace(temporary, dirname)
+    shutil.rmtree(previous, ignore_errors=True)
+    return schema
+
+
+class CompiledModel:
+    def __init__(self, schema, arrays):
+        self.schema = schema
+        self.columns = schema['columns']
+        self.model_id = schema['model_id']
+        self.depth = schema['depth']
+        self.base_score = schema['base_score']
+        self.trees = schema['trees']
+        # flat ndarray views of the (memory-mapped) arrays, np.memmap adds overhead to every indexing
+        self.feature = np.asarray(arrays['feature']).reshape(-1)
+        self.threshold = np.asarray(arrays['threshold']).reshape(-1)
+        self.leaf_value = np.asarray(arrays['leaf_value']).reshape(-1)
+        self.classes_ = np.array([0, 1])
+        inner = 2 ** self.depth - 1
+        # index of the root of every tree in the flat inner node and leaf arrays
+        self._roots = np.arange(self.trees, dtype=np.intp) * inner
+        self._leaves = np.arange(self.trees, dtype=np.intp) * (inner + 1) - inner
+        self._column_index = {column: index for index, column in enumerate(self.columns)}
+
+    @classmethod
+    def load(cls, dirname, mmap=True):
+        '''Loads an artifact written by export(), the arrays are memory-mapped unless mmap is False'''
+        with open(os.path.join(dirname, 'schema.json')) as f:
+            schema = json.load(f)
+        if schema.get('format') != FORMAT or schema.get('version') != FORMAT_VERSION:
+            raise ValueError(f'{dirname} is no {FORMAT} artifact of version {FORMAT_VERSION}')
+        arrays = {}
+        for name, spec in schema['arrays'].items():
+            arrays[name] = np.load(os.path.join(dirname, spec['file']), mmap_mode='r' if mmap else None)
+            if list(arrays[name].shape) != spec['shape'] or arrays[name].dtype.name != spec['dtype']:
+                raise ValueError(f'{spec["file"]} doesn\'t match the schema of {dirname}')
+        return cls(schema, arrays)
+
+    @staticmethod
+    def as_matrix(X):
+        '''Converts rows (lists, possibly with 'EMPTY') or an array into a float32 matrix with NaN for missing values'''
+        if not isinstance(X, np.ndarray):
+            X = list(X)
+            if X and not isinstance(X[0], (list, tuple, np.ndarray)):
+                X = [X]
+            X = [[np.nan if value is None or isinstance(value, str) and value == MISSING else value for value in row] for row in X]
+        X = np.asarray(X, dtype=np.float32)
+        return X[None, :] if X.ndim == 1 else X
+
+    def decision_function(self, X):
+        '''Returns the log-odds of a win of every row of X'''
+        X = self.as_matrix(X)
+        if X.shape[1] != len(self.columns):
+            raise ValueError(f'Expected {len(self.columns)} columns, got {X.shape[1]}')
+        if len(X) > BLOCK_ROWS:
+            return np.concatenate([self._score(X[start:start + BLOCK_ROWS]) for start in range(0, len(X), BLOCK_ROWS)])
+        return self._score(X)
+
+    def _score(self, X):
+        values = X.reshape(-1)
+        row_start = np.arange(len(X), dtype=np.intp)[:, None] * X.shape[1]
+        position = np.zeros((len(X), self.trees), dtype=np.intp)
+        for _ in range(self.depth):
+            node = position + self._roots
+            go_right = values.take(row_start + self.feature.take(node)) > self.threshold.take(node)
+            position = 2 * position + 1 + go_right
+        return self.base_score + self.leaf_value.take(position + self._leaves).sum(axis=1)
+
+    def predict_proba(self, X):
+        p = 1 / (1 + np.exp(-self.decision_function(X)))
+        return np.column_stack([1 - p, p])
+
+    def predict(self, X):
+        return (self.decision_function(X) > 0).astype(np.int8)
+
+    def row(self, features):
+        '''Returns the row of a dict of column -> value in the column order of the model, NaN for missing columns'''
+        row = np.full(len(self.columns), np.nan, dtype=np.float32)
+        for column, value in features.items():
+            index = self._column_index.get(column)
+            if index is not None and value != MISSING and value is not None:
+                row[index] = value
+        return row
+
+    def score_team(self, features):
+        '''Returns the win probability of a single team given as dict of column -> value'''
+        return float(self.predict_proba(self.row(features))[0, 1])
@@ -0,0 +1,333 @@
+'''
+Binary, memory-mapped team dataset for training and validation.
+
+The team-separated csv of separate_teams_and_outcomes.py is text with 'EMPTY'
+mixed into numeric columns and doesn't fit into memory once it has millions of
+rows. prepare() converts it once into a directory of raw arrays:
+
+    prepared/
+        meta.json       columns, rows and the source file it was built from
+        X.f32           float32 [rows, features], NaN where the value was 'EMPTY'
+        y.i8            int8 [rows], 1 if the team won
+        id.S32          team ids (<match id>_A / <match id>_B)
+        bins.u8         uint8 [rows, features], see bin_dataset()
+        edges.json      bin edges of every feature
+
+The csv is split into byte ranges of PART_BYTES that are parsed in parallel
+by a process pool. A columnar dataset directory of the LeagueAnalyzer
+(columnar_dataset.py) can be used as source as well, its games are split into
+team rows like separate_teams_and_outcomes.py does. The prepared directory is
+reused as long as the source file doesn't change.
+
+bin_dataset() maps every feature onto at most 255 quantile bins (bin 0 holds
+the missing values), the input of the histogram based boosting in
+boosting.py. Both files are read through np.memmap in chunks, so no step
+holds the whole table in memory.
+
+write_subset() copies a selection of rows, e.g. the folds of validate.py,
+into a dataset directory of its own. The subset is not binned, validate.py
+bins the training rows of every split separately, so the quantile edges never
+see the test rows.
+
+Usage:
+    dataset = prepare('new.csv', 'new.prepared', workers=8)
+    bin_dataset(dataset, workers=8)
+    X, y = dataset.X, dataset.y
+'''
+
+import io
+import os
+import sys
+import json
+import shutil
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data_collection'))
+
+from columnar_dataset import ColumnarDataset
+
+FORMAT_VERSION = 1
+FEATURE_DTYPE = np.float32
+ID_DTYPE = 'S32'
+MISSING = 'EMPTY'
+# Size of the byte ranges of the csv parsed by one task
+PART_BYTES = 32 * 1024 * 1024
+# Games of a columnar dataset converted by one task
+PART_GAMES = 200000
+# Rows binned by one task
+CHUNK_ROWS = 1 << 18
+
+
+class TeamDataset:
+    '''Read-only view of a prepared dataset directory'''
+
+    def __init__(self, dirname):
+        self.DIRNAME = dirname
+        with open(self._path('meta.json')) as f:
+            self.meta = json.load(f)
+        self.columns = self.meta['columns']
+        self.rows = self.meta['rows']
+
+    def __len__(self):
+        return self.rows
+
+    def _path(self, filename):
+        return os.path.join(self.DIRNAME, filename)
+
+    def _map(self, filename, dtype, shape):
+        if self.rows == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self._path(filename), dtype=dtype, mode='r', shape=shape)
+
+    @property
+    def X(self):
+        return self._map('X.f32', FEATURE_DTYPE, (self.rows, len(self.columns)))
+
+    @property
+    def y(self):
+        return self._map('y.i8', np.int8, (self.rows,))
+
+    @property
+    def ids(self):
+        return self._map('id.S32', ID_DTYPE, (self.rows,))
+
+    @property
+    def bins(self):
+        return self._map('bins.u8', np.uint8, (self.rows, len(self.columns)))
+
+    def edges(self):
+        '''Returns the bin edges of every feature, None if the dataset isn't binned yet'''
+        if not os.path.exists(self._path('edges.json')):
+            return None
+        with open(self._path('edges.json')) as f:
+            return [np.array(edges, dtype=FEATURE_DTYPE) for edges in json.load(f)['edges']]
+
+    def match_ids(self, start=0, end=None):
+        '''Returns the match id of every row (the team id without _A/_B)'''
+        return np.char.rpartition(np.asarray(self.ids[start:end]), b'_')[:, 0]
+
+
+def source_signature(source):
+    '''Identifies the version of a source file or columnar directory'''
+    path = os.path.join(source, 'schema.json') if os.path.isdir(source) else source
+    stat = os.stat(path)
+    return {'path': os.path.abspath(source), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def csv_ranges(filename, part_bytes):
+    '''Returns the header and (start, end) byte ranges of the csv, aligned to line starts'''
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        header = f.readline().decode().rstrip('\r\n').split(';')
+        starts = [f.tell()]
+        while starts[-1] + part_bytes < size:
+            f.seek(starts[-1] + part_bytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            starts.append(f.tell())
+    return header, list(zip(starts, starts[1:] + [size]))
+
+
+def write_part(prefix, X, y, ids):
+    X.astype(FEATURE_DTYPE).tofile(f'{prefix}.X.f32')
+    y.astype(np.int8).tofile(f'{prefix}.y.i8')
+    np.asarray(ids, dtype=ID_DTYPE).tofile(f'{prefix}.id.S32')
+    return len(y)
+
+
+def parse_csv_part(args):
+    '''Converts one byte range of the team csv into part files and returns its number of rows'''
+    filename, start, end, header, prefix = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    features = [column for column in header if column not in ('id', 'win')]
+    df = pd.read_csv(io.BytesIO(data), sep=';', header=None, names=header, dtype={'id': str},
+                     na_values=[MISSING], keep_default_na=False)
+    return write_part(prefix, df[features].to_numpy(dtype=FEATURE_DTYPE), df['win'].to_numpy(), df['id'].str.encode('utf-8'))
+
+
+def team_columns(columns):
+    '''Returns the feature columns of team A and team B of a game dataset, B renamed like A'''
+    team_a = [column for column in columns if column.startswith('summoner_') and int(column.split('_')[1]) <= 5]
+    team_b = [column for column in columns if column.startswith('summoner_') and int(column.split('_')[1]) > 5]
+    return team_a, team_b
+
+
+def convert_columnar_part(args):
+    '''Splits the games [start, end) of a columnar dataset into team rows (A before B) and writes part files'''
+    dirname, start, end, prefix = args
+    dataset = ColumnarDataset(dirname)
+    team_a, team_b = team_columns(list(dataset.columns))
+
+    def features(columns):
+        return np.column_stack([np.where(dataset.mask(name)[start:end], np.nan, dataset[name][start:end]).astype(FEATURE_DTYPE) for name in columns])
+
+    # games with an unknown outcome ('ERR') are dropped
+    known = ~np.asarray(dataset.mask('win')[start:end])
+    win = np.asarray(dataset['win'][start:end])[known]
+    ids = np.char.decode(np.asarray(dataset['id'][start:end])[known])
+    X = np.empty((2 * len(win), len(team_a)), dtype=FEATURE_DTYPE)
+    X[0::2] = features(team_a)[known]
+    X[1::2] = features(team_b)[known]
+    # win == 0: Team A wins, win == 1: Team B wins
+    y = np.empty(2 * len(win), dtype=np.int8)
+    y[0::2] = win == 0
+    y[1::2] = win == 1
+    team_ids = np.column_stack([np.char.add(ids, '_A'), np.char.add(ids, '_B')]).ravel()
+    return write_part(prefix, X, y, np.char.encode(team_ids))
+
+
+def run_tasks(func, tasks, workers):
+    '''Returns [func(task) for task in tasks], computed by `workers` processes in task order'''
+    if workers <= 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+    with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+        return pool.map(func, tasks, chunksize=1)
+
+
+def concatenate_parts(prefixes, dirname):
+    '''Appends the part files to the dataset files in order and removes them'''
+    for suffix in ('X.f32', 'y.i8', 'id.S32'):
+        with open(os.path.join(dirname, suffix), 'wb') as out:
+            for prefix in prefixes:
+                with open(f'{prefix}.{suffix}', 'rb') as part:
+                    shutil.copyfileobj(part, out, 16 * 1024 * 1024)
+                os.remove(f'{prefix}.{suffix}')
+
+
+def prepare(source, dirname=None, workers=1, part_bytes=PART_BYTES):
+    '''Converts a team csv or a columnar game dataset into a TeamDataset directory.
+    An existing directory built from the same version of the source is reused.'''
+    dirname = dirname or os.path.splitext(source.rstrip('/'))[0] + '.prepared'
+    signature = source_signature(source)
+    meta_file = os.path.join(dirname, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta.get('version') == FORMAT_VERSION and meta.get('source') == signature:
+            return TeamDataset(dirname)
+        os.remove(meta_file)
+    os.makedirs(dirname, exist_ok=True)
+    for filename in ('bins.u8', 'edges.json'):
+        if os.path.exists(os.path.join(dirname, filename)):
+            os.remove(os.path.join(dirname, filename))
+
+    if os.path.isdir(source):
+        games = len(ColumnarDataset(source))
+        tasks = [(source, start, min(games, start + PART_GAMES), os.path.join(dirname, f'part_{index}'))
+                 for index, start in enumerate(range(0, games, PART_GAMES))]
+        columns = team_columns(list(ColumnarDataset(source).columns))[0]
+        counts = run_tasks(convert_columnar_part, tasks, workers)
+        prefixes = [task[3] for task in tasks]
+    else:
+        header, ranges = csv_ranges(source, part_bytes)
+        columns = [column for column in header if column not in ('id', 'win')]
+        tasks = [(source, start, end, header, os.path.join(dirname, f'part_{index}')) for index, (start, end) in enumerate(ranges) if end > start]
+        counts = run_tasks(parse_csv_part, tasks, workers)
+        prefixes = [task[4] for task in tasks]
+    concatenate_parts(prefixes, dirname)
+
+    # meta.json is written last, a directory without it is never used
+    meta = {'version': FORMAT_VERSION, 'columns': columns, 'rows': int(sum(counts)), 'source': signature}
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(meta_file + '.tmp', meta_file)
+    return TeamDataset(dirname)
+
+
+def quantile_edges(values, max_bins):
+    '''Returns at most max_bins - 2 edges splitting the non-missing values into quantiles'''
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return np.empty(0, dtype=FEATURE_DTYPE)
+    quantiles = np.linspace(0, 1, max_bins - 1)[1:-1]
+    return np.unique(np.quantile(values, quantiles, method='lower').astype(FEATURE_DTYPE))
+
+
+def digitize(X, edges):
+    '''Maps raw values onto bins: 0 for NaN, 1 + the number of edges smaller than the value otherwise'''
+    bins = np.empty(X.shape, dtype=np.uint8)
+    for feature, feature_edges in enumerate(edges):
+        values = X[:, feature]
+        bins[:, feature] = np.where(np.isnan(values), 0, 1 + np.searchsorted(feature_edges, values, side='left'))
+    return bins
+
+
+def bin_chunk(args):
+    dirname, start, end, edges = args
+    dataset = TeamDataset(dirname)
+    bins = np.memmap(dataset._path('bins.u8'), dtype=np.uint8, mode='r+', shape=(dataset.rows, len(dataset.columns)))
+    bins[start:end] = digitize(np.asarray(dataset.X[start:end]), edges)
+    bins.flush()
+
+
+def bin_dataset(dataset, max_bins=256, sample_rows=500000, workers=1):
+    '''Writes bins.u8 and edges.json unless the dataset is already binned with max_bins'''
+    edges_file = dataset._path('edges.json')
+    if os.path.exists(edges_file) and os.path.exists(dataset._path('bins.u8')):
+        with open(edges_file) as f:
+            if json.load(f)['max_bins'] == max_bins:
+                return dataset
+    if max_bins > 256:
+        raise ValueError('At most 256 bins fit into uint8')
+    # evenly spaced rows are a deterministic sample of the whole file
+    step = max(1, dataset.rows // sample_rows)
+    sample = np.asarray(dataset.X[::step])
+    edges = [quantile_edges(sample[:, feature], max_bins) for feature in range(len(dataset.columns))]
+    if os.path.exists(edges_file):
+        os.remove(edges_file)
+    if dataset.rows:
+        np.memmap(dataset._path('bins.u8'), dtype=np.uint8, mode='w+', shape=(dataset.rows, len(dataset.columns))).flush()
+        run_tasks(bin_chunk, [(dataset.DIRNAME, start, min(dataset.rows, start + CHUNK_ROWS), edges) for start in range(0, dataset.rows, CHUNK_ROWS)], workers)
+    # edges.json marks the bins as complete
+    with open(edges_file + '.tmp', 'w') as f:
+        json.dump({'max_bins': max_bins, 'edges': [feature_edges.tolist() for feature_edges in edges]}, f)
+    os.replace(edges_file + '.tmp', edges_file)
+    return dataset
+
+
+def match_numbers(match_ids):
+    '''Returns the number of every match id (EUW1_6412345 -> 6412345), which grows with the start of the game'''
+    return np.char.rpartition(match_ids, b'_')[:, 2].astype(np.int64)
+
+
+def match_platforms(match_ids):
+    '''Returns the platform of every match id (EUW1_6412345 -> EUW1), the numbers count up per platform'''
+    return np.char.rpartition(match_ids, b'_')[:, 0]
+
+
+def write_subset(dataset, dirname, select, key):
+    '''Writes the rows of a dataset for which select(start, end) is True into a new, unbinned dataset directory.
+    An existing directory written with the same key is reused.'''
+    meta_file = os.path.join(dirname, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            if json.load(f).get('subset') == key:
+                return TeamDataset(dirname)
+        os.remove(meta_file)
+    os.makedirs(dirname, exist_ok=True)
+    for filename in ('bins.u8', 'edges.json'):
+        if os.path.exists(os.path.join(dirname, filename)):
+            os.remove(os.path.join(dirname, filename))
+    rows = 0
+    files = {suffix: open(os.path.join(dirname, suffix), 'wb') for suffix in ('X.f32', 'y.i8', 'id.S32')}
+    try:
+        for start in range(0, dataset.rows, CHUNK_ROWS):
+            end = min(dataset.rows, start + CHUNK_ROWS)
+            mask = select(start, end)
+            for suffix, array in (('X.f32', dataset.X), ('y.i8', dataset.y), ('id.S32', dataset.ids)):
+                np.ascontiguousarray(array[start:end][mask]).tofile(files[suffix])
+            rows += int(np.sum(mask))
+    finally:
+        for f in files.values():
+            f.close()
+    meta = dict(dataset.meta, rows=rows, subset=key)
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(meta_file + '.tmp', meta_file)
+    return TeamDataset(dirname)
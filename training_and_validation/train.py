@@ -1 +1,119 @@
-# Follows soon
+'''
+Trains the win/loss classifier on the team-separated dataset.
+
+The dataset is the csv written by separate_teams_and_outcomes.py or a
+columnar dataset directory of the LeagueAnalyzer. It is converted once into
+a memory-mapped TeamDataset (team_dataset.py) and binned, then a histogram
+gradient boosting model (boosting.py) is fitted by a pool of --workers
+processes that read the dataset in chunks. 'EMPTY' values are kept as
+missing values, the trees learn where to send them. Neither step holds the
+whole table in memory, which keeps millions of rows trainable on a laptop.
+
+With the same --seed (and the same dataset) the model is identical for any
+number of workers.
+
+Reported: rows/s of the conversion and of the training (rows x trees per
+second), the training log-loss and accuracy, the peak memory of the main
+process and of the largest worker, and the most important features. The
+model is pickled and exported as compiled artifact (model_artifact.py),
+either one can be loaded by prediction.py --model.
+
+Usage:
+    python train.py new.csv --model model.pkl --artifact model --workers 8
+    python train.py output_dir/ --trees 500 --depth 8 --learning-rate 0.05 --seed 1
+'''
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import resource
+import multiprocessing
+
+from boosting import HistogramBoosting
+from model_artifact import export
+from team_dataset import bin_dataset, prepare
+
+
+def peak_memory_mb():
+    '''Returns the peak resident memory of this process and of its largest finished child process in MB'''
+    # ru_maxrss is in KB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def train(source, model_file, prepared_dir=None, workers=None, max_bins=256, artifact_dir=None, log=print, **params):
+    '''Prepares the dataset, trains the model, pickles it (and exports the artifact) and returns (model, report)'''
+    workers = workers or multiprocessing.cpu_count()
+    start = time.perf_counter()
+    dataset = prepare(source, prepared_dir, workers=workers)
+    bin_dataset(dataset, max_bins=max_bins, workers=workers)
+    prepare_seconds = time.perf_counter() - start
+    log(f'Prepared {dataset.rows} rows with {len(dataset.columns)} features in {prepare_seconds:.1f}s ({dataset.DIRNAME})')
+
+    booster = HistogramBoosting(workers=workers, **params)
+    start = time.perf_counter()
+    model = booster.fit(dataset, log=lambda entry: log(
+        f"Tree {entry['tree']}/{booster.TREES}: logloss {entry['logloss']:.5f}, accuracy {entry['accuracy']:.4f}, {entry['seconds']:.2f}s"))
+    train_seconds = time.perf_counter() - start
+    with open(model_file, 'wb') as f:
+        pickle.dump(model, f)
+    schema = None
+    if artifact_dir is not None:
+        schema = export(model, artifact_dir, metadata={'rows': dataset.rows, 'source': dataset.meta['source'], 'params': params})
+
+    main_mb, worker_mb = peak_memory_mb()
+    last = booster.history[-1] if booster.history else {}
+    report = {
+        'rows': dataset.rows,
+        'features': len(dataset.columns),
+        'trees': model.n_trees,
+        'workers': workers,
+        'prepare_seconds': round(prepare_seconds, 2),
+        'prepare_rows_per_second': round(dataset.rows / max(prepare_seconds, 1e-9)),
+        'train_seconds': round(train_seconds, 2),
+        'train_rows_per_second': round(dataset.rows * model.n_trees / max(train_seconds, 1e-9)),
+        'train_logloss': round(last.get('logloss', float('nan')), 5),
+        'train_accuracy': round(last.get('accuracy', float('nan')), 4),
+        'peak_memory_mb': round(main_mb, 1),
+        'peak_worker_memory_mb': round(worker_mb, 1),
+        'top_features': {name: round(share, 4) for name, share in list(model.importances.items())[:10]},
+        'model': model_file,
+        'artifact': artifact_dir,
+        'model_id': schema['model_id'] if schema is not None else None
+    }
+    return model, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trains the win/loss classifier on a team-separated dataset')
+    parser.add_argument('dataset', help='team csv of separate_teams_and_outcomes.py or a columnar dataset directory')
+    parser.add_argument('--model', default='model.pkl', help='the trained model is pickled to this file')
+    parser.add_argument('--artifact', default='model', help='directory of the compiled model artifact, empty to skip it')
+    parser.add_argument('--prepared-dir', help='directory of the converted dataset, defaults to <dataset>.prepared')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, defaults to the number of cores')
+    parser.add_argument('--trees', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--learning-rate', type=float, default=0.1)
+    parser.add_argument('--l2', type=float, default=1.0)
+    parser.add_argument('--min-child-samples', type=int, default=50)
+    parser.add_argument('--colsample', type=float, default=1.0, help='share of the features considered by each tree')
+    parser.add_argument('--subsample', type=float, default=1.0, help='share of the rows used to grow each tree')
+    parser.add_argument('--max-bins', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='append the report to this file as json lines')
+    args = parser.parse_args()
+
+    _, report = train(args.dataset, args.model, prepared_dir=args.prepared_dir, workers=args.workers, max_bins=args.max_bins, artifact_dir=args.artifact or None,
+                      trees=args.trees, max_depth=args.depth, learning_rate=args.learning_rate, l2=args.l2,
+                      min_child_samples=args.min_child_samples, colsample=args.colsample, subsample=args.subsample, seed=args.seed)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(dict(report, options=vars(args), timestamp=int(time.time()))) + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
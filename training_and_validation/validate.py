@@ -1 +1,218 @@
-# Follows soon
+'''
+Validates the win/loss classifier with k-fold cross-validation and a time
+based holdout.
+
+Every split is evaluated by its own process of a pool (--workers), which
+trains the model of train.py on the training rows and scores the test rows.
+Splits are made by match id, so the _A and _B rows of a game always end up
+on the same side:
+
+    fold-<i>    the matches are hashed into --folds folds (seeded with --seed)
+                and fold i is the test set
+    holdout     the newest --holdout share of the matches of every platform is
+                the test set. Match ids count up per platform (EUW1_6412345),
+                so a higher number means a later game of the same platform;
+                numbers of different platforms can't be compared.
+
+The training and test rows of every split are written to the --cache-dir
+(team_dataset.write_subset()) and reused as long as the dataset and the split
+options don't change, so repeated experiments with other model parameters
+only retrain. The bin edges of a split are fitted on its training rows only,
+edges fitted on all rows would leak the value distribution of the test rows
+into the model.
+
+Reported per split: accuracy, log-loss, Brier score, expected calibration
+error with a calibration table (predicted vs. observed win rate per
+probability bin) and the wall time of preparing, training and scoring.
+
+Usage:
+    python validate.py new.csv --folds 5 --holdout 0.2 --workers 6
+    python validate.py new.csv --folds 10 --no-holdout --trees 500 --json validation.jsonl
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import multiprocessing
+
+import numpy as np
+
+from boosting import HistogramBoosting
+from team_dataset import CHUNK_ROWS, TeamDataset, bin_dataset, match_numbers, match_platforms, prepare, write_subset
+
+# Rows scored at once, the scoring works on [rows, trees] arrays
+SCORE_ROWS = 1 << 14
+CALIBRATION_BINS = 10
+
+
+def fold_of(numbers, folds, seed):
+    '''Assigns match numbers to folds with a seeded hash (splitmix64), both teams of a match share the number'''
+    with np.errstate(over='ignore'):
+        x = numbers.astype(np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return (x % np.uint64(folds)).astype(np.int64)
+
+
+def is_test_row(dataset, split, start, end):
+    '''Returns whether the rows [start, end) belong to the test set of the split'''
+    match_ids = dataset.match_ids(start, end)
+    numbers = match_numbers(match_ids)
+    if split['kind'] == 'holdout':
+        platforms = match_platforms(match_ids)
+        test = np.zeros(len(numbers), dtype=bool)
+        for platform, threshold in split['thresholds'].items():
+            test |= (platforms == platform.encode()) & (numbers >= threshold)
+        return test
+    return fold_of(numbers, split['folds'], split['seed']) == split['fold']
+
+
+def holdout_thresholds(dataset, share):
+    '''Returns the smallest match number of the newest share of the matches of every platform'''
+    numbers = {}
+    for start in range(0, dataset.rows, CHUNK_ROWS):
+        match_ids = dataset.match_ids(start, start + CHUNK_ROWS)
+        platforms, chunk_numbers = match_platforms(match_ids), match_numbers(match_ids)
+        for platform in np.unique(platforms):
+            numbers.setdefault(platform.decode(), []).append(np.unique(chunk_numbers[platforms == platform]))
+    thresholds = {}
+    for platform, chunks in numbers.items():
+        platform_numbers = np.unique(np.concatenate(chunks))
+        thresholds[platform] = int(platform_numbers[min(len(platform_numbers) - 1, int(len(platform_numbers) * (1 - share)))])
+    return thresholds
+
+
+def predict(model, dataset):
+    '''Returns the win probability of every row of the dataset'''
+    return np.concatenate([model.predict_proba(dataset.X[start:start + SCORE_ROWS])[:, 1] for start in range(0, dataset.rows, SCORE_ROWS)] or [np.empty(0)])
+
+
+def evaluate(y, p):
+    '''Returns accuracy, log-loss, Brier score and calibration of the predicted probabilities p'''
+    y = np.asarray(y, dtype=np.float64)
+    clipped = np.clip(p, 1e-15, 1 - 1e-15)
+    bins = np.minimum((p * CALIBRATION_BINS).astype(int), CALIBRATION_BINS - 1)
+    calibration, ece = [], 0.0
+    for index in range(CALIBRATION_BINS):
+        in_bin = bins == index
+        if not in_bin.any():
+            continue
+        predicted, observed = float(p[in_bin].mean()), float(y[in_bin].mean())
+        ece += in_bin.sum() / len(y) * abs(predicted - observed)
+        calibration.append({'bin': f'{index / CALIBRATION_BINS:.1f}-{(index + 1) / CALIBRATION_BINS:.1f}', 'rows': int(in_bin.sum()),
+                            'predicted': round(predicted, 4), 'observed': round(observed, 4)})
+    return {
+        'accuracy': round(float(np.mean((p > 0.5) == (y == 1))), 4),
+        'logloss': round(float(-np.mean(y * np.log(clipped) + (1 - y) * np.log(1 - clipped))), 5),
+        'brier': round(float(np.mean((p - y) ** 2)), 5),
+        'ece': round(float(ece), 4),
+        'calibration': calibration
+    }
+
+
+def run_split(task):
+    '''Prepares (or reuses) the training and test data of one split, trains and scores. Runs in a pool process.'''
+    dataset_dir, cache_dir, name, split, key, max_bins, params = task
+    start = time.perf_counter()
+    dataset = TeamDataset(dataset_dir)
+    test_rows = functools.partial(is_test_row, dataset, split)
+    cached = os.path.exists(os.path.join(cache_dir, name, 'test', 'meta.json'))
+    train = write_subset(dataset, os.path.join(cache_dir, name, 'train'), lambda a, b: ~test_rows(a, b), key)
+    # the edges are fitted on the training rows only, the test rows are scored on their raw values
+    bin_dataset(train, max_bins=max_bins)
+    test = write_subset(dataset, os.path.join(cache_dir, name, 'test'), test_rows, key)
+    prepare_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = HistogramBoosting(workers=1, **params).fit(train)
+    train_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    p = predict(model, test)
+    score_seconds = time.perf_counter() - start
+    result = {'split': name, 'train_rows': train.rows, 'test_rows': test.rows, 'cached': cached}
+    result.update(evaluate(test.y, p) if test.rows else {})
+    result.update(prepare_seconds=round(prepare_seconds, 2), train_seconds=round(train_seconds, 2), score_seconds=round(score_seconds, 2),
+                  seconds=round(prepare_seconds + train_seconds + score_seconds, 2))
+    return result
+
+
+def splits(dataset, folds, holdout, seed):
+    '''Returns (name, split) of every split to evaluate'''
+    result = [(f'fold-{fold}', {'kind': 'fold', 'fold': fold, 'folds': folds, 'seed': seed}) for fold in range(folds if folds > 1 else 0)]
+    if holdout:
+        result.append(('holdout', {'kind': 'holdout', 'thresholds': holdout_thresholds(dataset, holdout)}))
+    return result
+
+
+def summary(results):
+    '''Returns mean and standard deviation of the metrics over the folds'''
+    folds = [result for result in results if result['split'].startswith('fold-') and 'accuracy' in result]
+    values = {}
+    for metric in ('accuracy', 'logloss', 'brier', 'ece', 'seconds'):
+        scores = [result[metric] for result in folds]
+        if scores:
+            values[metric] = {'mean': round(float(np.mean(scores)), 5), 'std': round(float(np.std(scores)), 5)}
+    return values
+
+
+def validate(source, folds=5, holdout=0.2, seed=0, workers=None, cache_dir=None, prepared_dir=None, max_bins=256, log=print, **params):
+    '''Evaluates every split in a process pool and returns the report'''
+    workers = workers or multiprocessing.cpu_count()
+    start = time.perf_counter()
+    dataset = prepare(source, prepared_dir, workers=workers)
+    cache_dir = cache_dir or os.path.join(dataset.DIRNAME, 'folds')
+    # the cached splits are only valid for the same data, binning and split options
+    key = {'source': dataset.meta['source'], 'max_bins': max_bins, 'folds': folds, 'holdout': holdout, 'seed': seed}
+    tasks = [(dataset.DIRNAME, cache_dir, name, split, key, max_bins, dict(params, seed=seed)) for name, split in splits(dataset, folds, holdout, seed)]
+    log(f'Evaluating {len(tasks)} splits of {dataset.rows} rows with {min(workers, len(tasks))} workers')
+
+    results = []
+    if workers <= 1 or len(tasks) <= 1:
+        for result in map(run_split, tasks):
+            log(json.dumps({key: value for key, value in result.items() if key != 'calibration'}))
+            results.append(result)
+    else:
+        with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+            for result in pool.imap(run_split, tasks):
+                log(json.dumps({key: value for key, value in result.items() if key != 'calibration'}))
+                results.append(result)
+    return {'rows': dataset.rows, 'splits': results, 'folds': summary(results), 'seconds': round(time.perf_counter() - start, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross-validates the win/loss classifier on a team-separated dataset')
+    parser.add_argument('dataset', help='team csv of separate_teams_and_outcomes.py or a columnar dataset directory')
+    parser.add_argument('--folds', type=int, default=5, help='number of folds of the cross-validation, 0 to skip it')
+    parser.add_argument('--holdout', type=float, default=0.2, help='share of the newest matches used as holdout')
+    parser.add_argument('--no-holdout', action='store_true')
+    parser.add_argument('--cache-dir', help='directory of the cached splits, defaults to <prepared dir>/folds')
+    parser.add_argument('--prepared-dir', help='directory of the converted dataset, defaults to <dataset>.prepared')
+    parser.add_argument('--workers', type=int, default=None, help='splits evaluated at the same time, defaults to the number of cores')
+    parser.add_argument('--trees', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--learning-rate', type=float, default=0.1)
+    parser.add_argument('--l2', type=float, default=1.0)
+    parser.add_argument('--min-child-samples', type=int, default=50)
+    parser.add_argument('--colsample', type=float, default=1.0)
+    parser.add_argument('--subsample', type=float, default=1.0)
+    parser.add_argument('--max-bins', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='append the report to this file as json lines')
+    args = parser.parse_args()
+
+    report = validate(args.dataset, folds=args.folds, holdout=None if args.no_holdout else args.holdout, seed=args.seed, workers=args.workers,
+                      cache_dir=args.cache_dir, prepared_dir=args.prepared_dir, max_bins=args.max_bins, trees=args.trees, max_depth=args.depth,
+                      learning_rate=args.learning_rate, l2=args.l2, min_child_samples=args.min_child_samples, colsample=args.colsample,
+                      subsample=args.subsample)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(dict(report, options=vars(args), timestamp=int(time.time()))) + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())